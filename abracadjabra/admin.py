@@ -1,19 +1,55 @@
 from django.contrib import admin
-from models import Experiment, ExperimentUser
+from django.core.urlresolvers import reverse
+
+from models import Bucket, Conversion, Experiment, ExperimentUser, Exposure
+from utils.admin import HugeTableAdmin
 
 class ExperimentAdmin(admin.ModelAdmin):
-    list_display = ('name', 'cre',)
+    list_display = ('name', 'cre', 'mod', 'exptusers_link',)
     search_fields = ('name',)
-    readonly_fields=('cre',)
+    readonly_fields=('cre', 'mod', 'salt',)
 
-class ExperimentUserAdmin(admin.ModelAdmin): 
-    list_display = ('experiment', 'user', 'bucket', 'cre',)
+    def exptusers_link(self, expt):
+        # ExperimentUserAdmin doesn't have a list_filter for experiment
+        return '<a href="%s?experiment__id__exact=%i">users</a>' % (
+            reverse('admin:abracadjabra_experimentuser_changelist'), expt.id)
+    exptusers_link.allow_tags = True
+    exptusers_link.short_description = 'Users'
+
+class BucketAdmin(admin.ModelAdmin):
+    list_display = ('name', 'experiment', 'weight', 'cre',)
+    list_editable = ('weight',)
     list_filter = ('experiment',)
-    search_fields = ('experiment__name', 'user__username', 'bucket',)
-    raw_id_fields = ('user',) # add 'experiment' if slow
+    search_fields = ('name', 'experiment__name',)
     readonly_fields=('cre',)
 
+class ExperimentUserAdmin(HugeTableAdmin, admin.ModelAdmin): 
+    """
+    Filter by experiment with ?experiment__id__exact=ID (see
+    the links in ExperimentAdmin).
+    """
+    list_display = ('experiment', 'user', 'bucket', 'cre',)
+    select_related_fields = ('experiment', 'user', 'bucket',)
+    search_fields = ('experiment__name', 'user__username', 'bucket__name',)
+    raw_id_fields = ('user', 'experiment', 'bucket',)
+    readonly_fields=('cre', 'date_joined',)
+
+class ConversionAdmin(HugeTableAdmin, admin.ModelAdmin):
+    list_display = ('user', 'name', 'value', 'cre',)
+    select_related_fields = ('user',)
+    search_fields = ('name', 'user__username',)
+    raw_id_fields = ('user',)
+
+class ExposureAdmin(admin.ModelAdmin):
+    list_display = ('day', 'experiment', 'bucket', 'n',)
+    list_select_related = True
+    raw_id_fields = ('experiment', 'bucket',)
+    date_hierarchy = 'day'
+
 
 admin.site.register(Experiment, ExperimentAdmin)
+admin.site.register(Bucket, BucketAdmin)
 admin.site.register(ExperimentUser, ExperimentUserAdmin)
+admin.site.register(Exposure, ExposureAdmin)
+admin.site.register(Conversion, ConversionAdmin)
 
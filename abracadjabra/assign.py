@@ -0,0 +1,135 @@
+"""
+A bare WSGI app that assigns a user to buckets, for services
+that aren't Django views. It skips the middleware, sessions,
+url resolving and templates, so a request whose Experiments
+and ExperimentUsers are already cached costs two cache
+GET_MANYs and no queries (see Experiment.setup_many).
+
+Run it as its own app alongside wsgi.py, e.g.
+
+    gunicorn abracadjabra.assign:application
+
+then
+
+    POST /
+    X-Abracadjabra-Secret: <settings.ASSIGN_SECRET>
+
+    {"user_id": 123,
+     "experiments": {"E1": ["control", "test"], "E2": ["a", "b"]}}
+
+returns
+
+    {"user_id": 123, "buckets": {"E1": "test", "E2": "a"}}
+
+Responses always have a Content-Length, so clients can keep
+the connection alive between requests.
+"""
+import json
+import logging
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "abracadjabra.settings")
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_connection
+from django.utils.crypto import constant_time_compare
+
+from abracadjabra.models import Bucket, Experiment
+
+logger = logging.getLogger(__name__)
+
+# bytes - a request this big would be a very odd one
+MAX_BODY = 65536
+
+# the longest Experiment or Bucket name that fits in the db
+MAX_NAME_LENGTH = min(Experiment._meta.get_field('name').max_length,
+                      Bucket._meta.get_field('name').max_length)
+
+STATUSES = {
+    200: '200 OK',
+    400: '400 Bad Request',
+    403: '403 Forbidden',
+    404: '404 Not Found',
+    405: '405 Method Not Allowed',
+    413: '413 Request Entity Too Large',
+    500: '500 Internal Server Error',
+}
+
+
+def check_secret(meta):
+    """
+    True if META (a WSGI environ or request.META) has the
+    X-Abracadjabra-Secret header matching
+    settings.ASSIGN_SECRET. Also used by views.config_vw.
+    """
+    secret = settings.ASSIGN_SECRET
+    return bool(secret) and constant_time_compare(meta.get('HTTP_X_ABRACADJABRA_SECRET', ''), secret)
+
+
+def respond(start_response, status, d):
+    body = json.dumps(d)
+    start_response(STATUSES[status], [('Content-Type', 'application/json'),
+                                      ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def content_length(environ):
+    """
+    Returns the request's Content-Length, raising ValueError
+    if it's malformed.
+    """
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    if length < 0:
+        raise ValueError('negative Content-Length')
+    return length
+
+
+def valid_name(name):
+    return isinstance(name, basestring) and 0 < len(name) <= MAX_NAME_LENGTH
+
+
+def parse(environ):
+    """
+    Returns (user_id, {expt name: [bucket names]}) from the
+    request body, raising ValueError if it's malformed.
+    """
+    d = json.loads(environ['wsgi.input'].read(content_length(environ)))
+    user_id = d['user_id']
+    expts_buckets = d['experiments']
+    # N.B. not isinstance, since True is an int too
+    if type(user_id) not in (int, long) or not isinstance(expts_buckets, dict):
+        raise ValueError('user_id must be an integer, and experiments an object')
+    for name, buckets in expts_buckets.items():
+        if not valid_name(name):
+            raise ValueError('experiment names must be 1-%i characters' % MAX_NAME_LENGTH)
+        if not isinstance(buckets, list) or not buckets:
+            raise ValueError('no buckets for %s' % name)
+        if not all(valid_name(bucket) for bucket in buckets):
+            raise ValueError('bucket names for %s must be 1-%i characters' % (name, MAX_NAME_LENGTH))
+    return user_id, expts_buckets
+
+
+def application(environ, start_response):
+    if environ['REQUEST_METHOD'] != 'POST':
+        return respond(start_response, 405, {'error': 'POST only'})
+    if not check_secret(environ):
+        return respond(start_response, 403, {'error': 'bad secret'})
+    try:
+        if content_length(environ) > MAX_BODY:
+            return respond(start_response, 413, {'error': 'request too big'})
+        user_id, expts_buckets = parse(environ)
+    except (ValueError, KeyError, TypeError), e:
+        return respond(start_response, 400, {'error': 'bad request: %s' % e})
+
+    try:
+        buckets = Experiment.setup_many(user_id, expts_buckets)
+    except User.DoesNotExist:
+        return respond(start_response, 404, {'error': 'no user %i' % user_id})
+    except Exception:
+        logger.exception('Failed to assign buckets')
+        return respond(start_response, 500, {'error': 'server error'})
+    finally:
+        # there's no request_finished signal to do this for us
+        close_connection()
+    return respond(start_response, 200, {'user_id': user_id, 'buckets': buckets})
@@ -0,0 +1,183 @@
+import binascii
+import zlib
+
+from utils.models import queryset_iterator
+
+"""
+Per-bucket bitmaps of User ids, for comparing the populations
+of different Experiments without shipping big lists of ids
+back and forth with id__in.
+
+Bit N of a Bitmap is set if User N is in it. The bits live in
+a Python long, so AND/OR/etc. run in C, a word at a time. They
+pickle (e.g. into the cache) zlib-compressed, which makes even
+sparse bitmaps small.
+
+See Experiment.get_cache_bucket_bitmaps, and views.overlap_vw
+for the overlap matrix across the active Experiments.
+"""
+
+
+# bits - LEN counts this many at a time
+POPCOUNT_CHUNK_SIZE = 65536 * 8
+
+
+class Bitmap(object):
+    """
+    A set of (non-negative integer) ids, e.g.
+
+        both = Bitmap.from_ids([1, 2, 3]) & Bitmap.from_ids([2, 3, 4])
+        len(both) # 2
+        list(both) # [2, 3]
+    """
+    __slots__ = ('bits', '_len')
+
+    def __init__(self, bits=0L):
+        self.bits = bits
+        self._len = None
+
+    @staticmethod
+    def from_ids(ids):
+        # setting bits one at a time on a long would copy the
+        # whole long each time, so set them in a bytearray
+        # (little-endian) and convert once
+        bytes_ = bytearray()
+        for id_ in ids:
+            idx = id_ >> 3
+            if idx >= len(bytes_):
+                bytes_.extend('\0' * (max(idx + 1, 2 * len(bytes_)) - len(bytes_)))
+            bytes_[idx] |= 1 << (id_ & 7)
+        return Bitmap.from_bytes(str(bytes_[::-1]))
+
+    @staticmethod
+    def from_bytes(s):
+        """
+        The opposite of TO_BYTES.
+        """
+        return Bitmap(long(binascii.hexlify(s), 16) if s else 0L)
+
+    def to_bytes(self):
+        """
+        Returns the bits as a big-endian string.
+        """
+        hex_ = '%x' % self.bits
+        if len(hex_) % 2:
+            hex_ = '0' + hex_
+        return binascii.unhexlify(hex_)
+
+    @staticmethod
+    def decompress(s):
+        return Bitmap.from_bytes(zlib.decompress(s))
+
+    def compress(self):
+        return zlib.compress(self.to_bytes())
+
+    def __reduce__(self):
+        return (_unpickle_bitmap, (self.compress(),))
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits)
+
+    def __sub__(self, other):
+        return Bitmap(self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        # counted once, since Bitmaps never change (e.g. each
+        # row of OVERLAP_MATRIX uses the same ones), with bin()
+        # a chunk at a time so that its string stays small
+        if self._len is None:
+            n = 0
+            bits = self.bits
+            mask = (1L << POPCOUNT_CHUNK_SIZE) - 1
+            while bits:
+                n += bin(bits & mask).count('1')
+                bits >>= POPCOUNT_CHUNK_SIZE
+            self._len = n
+        return self._len
+
+    def __nonzero__(self):
+        return bool(self.bits)
+
+    def __contains__(self, id_):
+        return bool(self.bits >> id_ & 1)
+
+    def __iter__(self):
+        """
+        Yields the ids in ascending order.
+        """
+        for idx, byte in enumerate(bytearray(self.to_bytes()[::-1])):
+            if byte:
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        yield idx * 8 + bit
+
+    def __repr__(self):
+        return '<Bitmap: %i ids>' % len(self)
+
+
+def _unpickle_bitmap(s):
+    # staticmethods can't be pickled by name
+    return Bitmap.decompress(s)
+
+
+def union(bitmaps):
+    result = Bitmap()
+    for bitmap in bitmaps:
+        result = result | bitmap
+    return result
+
+
+def build_bucket_bitmaps(expt, chunk_size=10000):
+    """
+    Returns {bucket name: Bitmap of User ids} for Experiment
+    EXPT, from one (chunked) pass over its ExperimentUsers.
+    """
+    names = dict(expt.buckets.values_list('id', 'name'))
+    user_ids = dict((bucket_id, []) for bucket_id in names)
+    eus = expt.exptusers.values_list('id', 'bucket', 'user')
+    for eu_id, bucket_id, user_id in queryset_iterator(eus, chunk_size):
+        user_ids[bucket_id].append(user_id)
+    return dict((names[bucket_id], Bitmap.from_ids(ids))
+                for bucket_id, ids in user_ids.items())
+
+
+def overlap_matrix(expts_bitmaps):
+    """
+    Takes [(Experiment, {bucket name: Bitmap})], and returns
+    a row per Experiment of (Experiment, nUsers, [number of
+    its Users also in each Experiment]), i.e. the diagonal
+    is everyone in that Experiment.
+    """
+    users = [union(bitmaps.values()) for expt, bitmaps in expts_bitmaps]
+    return [(expt, len(users[idx]), [len(users[idx] & other) for other in users])
+            for idx, (expt, bitmaps) in enumerate(expts_bitmaps)]
+
+
+def crosstab(bitmaps1, bitmaps2):
+    """
+    Returns [(bucket name 1, bucket name 2, nUsers,
+    nExpected)] for every pair of buckets from two
+    Experiments' {bucket name: Bitmap}s, for the Users in
+    both Experiments.
+
+    NEXPECTED is how many Users would be in both buckets if
+    the two Experiments' assignments were independent, so a
+    big difference between them means the Experiments
+    interact.
+    """
+    both = union(bitmaps1.values()) & union(bitmaps2.values())
+    nBoth = len(both)
+    sizes1 = dict((name, len(bitmap & both)) for name, bitmap in bitmaps1.items())
+    sizes2 = dict((name, len(bitmap & both)) for name, bitmap in bitmaps2.items())
+    return [(name1, name2, len(bitmaps1[name1] & bitmaps2[name2]),
+             float(sizes1[name1]) * sizes2[name2] / nBoth if nBoth else 0.)
+            for name1 in sorted(bitmaps1) for name2 in sorted(bitmaps2)]
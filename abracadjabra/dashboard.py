@@ -0,0 +1,134 @@
+import logging
+import time
+import Queue
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import close_connection
+
+from models import Experiment
+from utils.dt import dt_ranges
+from utils.utils import cmcd
+
+"""
+Computes the report for lots of Experiments at once, for the
+dashboard (see views.dashboard_vw), by fanning them out across
+a pool of settings.DASHBOARD_THREADS threads rather than one
+after another. The db does the heavy lifting, so threads are
+enough - the GIL gets released while each one waits on its
+queries.
+
+Each thread has its own db connection (Django's connections
+are per-thread), closed as soon as its Experiment is done.
+
+Results come back in the order they finish, so the view can
+stream each one to the page straight away. Anything still
+running after settings.DASHBOARD_TIMEOUT seconds (for the
+lot) gets reported as timed out.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def _call(func, item):
+    try:
+        return func(item), None
+    except Exception, e:
+        logger.exception('Failed to compute %r', item)
+        return None, e
+
+
+def _call_and_close(func, item):
+    try:
+        return _call(func, item)
+    finally:
+        close_connection()
+
+
+def fan_out(func, items, threads=None, timeout=None):
+    """
+    Calls FUNC(item) for each of ITEMS in a pool of THREADS
+    threads, and yields (item, result, exception) as each
+    one finishes, with EXCEPTION None if it worked.
+
+    Once TIMEOUT seconds have passed, stops waiting, and
+    yields the rest with a multiprocessing.TimeoutError. They
+    keep running in the background, but their results get
+    thrown away.
+
+    THREADS=0 calls FUNC for each item in turn in this
+    thread, e.g. for debugging.
+    """
+    threads = settings.DASHBOARD_THREADS if threads is None else threads
+    timeout = settings.DASHBOARD_TIMEOUT if timeout is None else timeout
+    items = list(items)
+    deadline = time.time() + timeout
+    done = set()
+
+    if not threads:
+        for idx, item in enumerate(items):
+            if time.time() > deadline:
+                break
+            done.add(idx)
+            yield (item,) + _call(func, item)
+    elif items:
+        finished = Queue.Queue()
+        pool = ThreadPool(min(threads, len(items)))
+        for idx, item in enumerate(items):
+            pool.apply_async(_call_and_close, (func, item),
+                             callback=lambda result, idx=idx: finished.put((idx, result)))
+        # let the threads exit once they've run out of work,
+        # even if we give up on them
+        pool.close()
+        while len(done) < len(items):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                idx, (result, exception) = finished.get(timeout=remaining)
+            except Queue.Empty:
+                break
+            done.add(idx)
+            yield items[idx], result, exception
+
+    for idx, item in enumerate(items):
+        if idx not in done:
+            yield item, None, TimeoutError('Gave up after %is' % timeout)
+
+
+def experiment_summary(expt, dt_joined=None):
+    """
+    The per-bucket stats for the dashboard row for EXPT
+    (see Experiment.compute_buckets).
+    """
+    buckets, dt_joined = expt.compute_buckets(dt_joined=dt_joined, incl_all=True,
+                                              use_snapshot=bool(settings.SNAPSHOT_DIR))
+    return {'buckets': buckets,
+            'dt_joined': dt_joined,}
+
+
+@cmcd(prefix='dashboard_summary', arg_names=('expt_id', 'dt_joined_str',),
+      soft_expiry=settings.DASHBOARD_SOFT_EXPIRY)
+def get_cache_summary(expt_id, dt_joined_str):
+    """
+    EXPERIMENT_SUMMARY for Experiment EXPT_ID over
+    dt_ranges[DT_JOINED_STR]. Once it's older than
+    settings.DASHBOARD_SOFT_EXPIRY, it still gets returned
+    straight away, but recomputed in the background, so
+    the dashboard only waits for Experiments it's never
+    seen.
+    """
+    return experiment_summary(Experiment.objects.get(id=expt_id), dt_ranges[dt_joined_str][0])
+
+
+def experiment_summaries(expts=None, dt_joined_str='recent_week', threads=None, timeout=None):
+    """
+    Yields (Experiment, summary, exception) for each of
+    EXPTS (defaulting to all the active ones), as they
+    finish. See FAN_OUT and GET_CACHE_SUMMARY.
+    """
+    if expts is None:
+        expts = Experiment.active.all()
+    return fan_out(lambda expt: get_cache_summary(expt.id, dt_joined_str), expts,
+                   threads=threads, timeout=timeout)
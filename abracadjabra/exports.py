@@ -0,0 +1,140 @@
+import csv
+import json
+
+from django.conf import settings
+
+from models import report_sample
+from routers import reporting
+from utils.models import queryset_chunks
+
+"""
+Streams an Experiment's assignments (ExperimentUser rows) and
+per-bucket stats out as CSV or NDJSON (one JSON object per
+line), e.g. for loading into a notebook, without ever holding
+the whole table in memory.
+
+The rows come from queryset_chunks, i.e. pk-ordered chunks,
+and each format yields a line at a time, so feed them
+straight into a StreamingHttpResponse (see
+views.experiment_export_vw) or a file (see the
+export_experiment management command).
+
+Like the other reports, the reads go to the reporting
+replica (see routers.py).
+"""
+
+ASSIGNMENT_COLUMNS = ('id', 'user_id', 'bucket', 'cre', 'date_joined')
+
+BUCKET_COLUMNS = ('bucket', 'nUsers', 'nExposures', 'conversion', 'nConverted',
+                  'pct', 'pct_low', 'pct_high', 'total', 'per_user')
+
+FORMATS = {'csv': 'text/csv',
+           'ndjson': 'application/x-ndjson',}
+
+
+def assignment_rows(expt, dt_joined=None, chunk_size=10000):
+    """
+    Yields a tuple of ASSIGNMENT_COLUMNS for each of EXPT's
+    ExperimentUsers (who joined after DT_JOINED, if you
+    give one), in order of id.
+    """
+    def bucket_names():
+        with reporting():
+            return dict(expt.buckets.values_list('id', 'name'))
+
+    names = bucket_names()
+    eus = expt.exptusers.all()
+    if dt_joined:
+        eus = eus.filter(date_joined__gte=expt.check_dt_joined(expt.cre, dt_joined))
+    eus = eus.values_list('id', 'user', 'bucket', 'cre', 'date_joined')
+    chunks = queryset_chunks(eus, chunk_size)
+    while True:
+        # only around the query, since this generator can sit
+        # between yields for as long as the client takes
+        with reporting():
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        for eu_id, user_id, bucket_id, cre, date_joined in chunk:
+            if bucket_id not in names:
+                # a Bucket added since the export started
+                names = bucket_names()
+            yield eu_id, user_id, names[bucket_id], cre, date_joined
+
+
+def bucket_rows(expt, dt_joined=None):
+    """
+    Yields a tuple of BUCKET_COLUMNS for each bucket (and
+    'All') and kind of Conversion in EXPT's exact report, or
+    one with blank Conversion columns for a bucket without
+    any. Uses the cached report if it's exact and up to date
+    (see Experiment.get_cache_report).
+    """
+    use_snapshot = bool(settings.SNAPSHOT_DIR)
+    version, dt_joined, report, report_version, samples = expt.cached_report(dt_joined, True, use_snapshot)
+    if report is None or report_version != version or report_sample(report) < 1:
+        report = expt.compute_buckets(dt_joined, True, use_snapshot)
+    for bucket in report[0]:
+        start = (bucket['name'], bucket['nUsers'], bucket['nExposures'])
+        if not bucket['conversions']:
+            yield start + (None,) * (len(BUCKET_COLUMNS) - len(start))
+        for conversion in bucket['conversions']:
+            yield start + tuple(conversion[column] for column in
+                                ('name', 'nConverted', 'pct', 'pct_low', 'pct_high', 'total', 'per_user'))
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        # the csv module only does bytes
+        return value.encode('utf-8')
+    return value
+
+
+class _Line(object):
+    # csv.writer writes to this, and we take each line back
+    def write(self, line):
+        return line
+
+
+def to_csv(columns, rows):
+    """
+    Yields COLUMNS, then each of ROWS, as lines of CSV.
+    """
+    writer = csv.writer(_Line())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([_cell(value) for value in row])
+
+
+def to_ndjson(columns, rows):
+    """
+    Yields each of ROWS as a line of JSON, with COLUMNS as
+    the keys.
+    """
+    for row in rows:
+        yield json.dumps(dict(zip(columns, [value.isoformat() if hasattr(value, 'isoformat') else value
+                                            for value in row])),
+                         sort_keys=True) + '\n'
+
+
+def export(what, expt, fmt, dt_joined=None):
+    """
+    Returns an iterator over the lines of EXPT's WHAT
+    ('assignments' or 'buckets') in format FMT (one of
+    FORMATS).
+    """
+    if what == 'assignments':
+        columns, rows = ASSIGNMENT_COLUMNS, assignment_rows(expt, dt_joined)
+    elif what == 'buckets':
+        columns, rows = BUCKET_COLUMNS, bucket_rows(expt, dt_joined)
+    else:
+        raise ValueError('Unknown export %r' % what)
+    if fmt == 'csv':
+        return to_csv(columns, rows)
+    elif fmt == 'ndjson':
+        return to_ndjson(columns, rows)
+    raise ValueError('Unknown format %r' % fmt)
@@ -0,0 +1,169 @@
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+"""
+Records an exposure every time a user is shown a bucket (see
+Experiment.setup), without a db write per exposure:
+
+- log_exposure() just appends to an in-memory buffer
+
+- a background thread writes the buffer out every
+  settings.EXPOSURE_FLUSH_SECONDS, appending NDJSON lines of
+  [expt_id, bucket_id, unix time] to a segment file in
+  settings.EXPOSURE_LOG_DIR, named *.ndjson.tmp while it's
+  being written
+
+- once a segment is old or big enough, it gets renamed to
+  *.ndjson, and the ingest_exposures management command can
+  then load it into the (daily, per-bucket) Exposure table
+
+Each process writes its own segments, so there's no locking
+between processes. Set EXPOSURE_LOG_DIR to None to turn all
+this off.
+"""
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.ndjson'
+TMP_SUFFIX = '.tmp'
+
+# bounded, so that a stuck writer can't eat all the memory - if
+# it fills up, the oldest exposures get dropped
+_buffer = deque(maxlen=100000)
+# (pid, thread) - see _ensure_writer
+_writer = None
+_writer_lock = threading.Lock()
+# the segment currently being written, as a dict with FILE,
+# PATH, OPENED and NBYTES
+_segment = None
+_segment_lock = threading.Lock()
+_nsegments = 0
+
+
+def log_exposure(expt_id, bucket_id, when=None):
+    """
+    Records that someone was shown Bucket BUCKET_ID of
+    Experiment EXPT_ID at WHEN (a unix time, defaulting to
+    now). Doesn't block on any IO.
+    """
+    if not settings.EXPOSURE_LOG_DIR:
+        return
+    _ensure_writer()
+    _buffer.append((expt_id, bucket_id, int(when or time.time())))
+
+
+def _ensure_writer():
+    global _writer, _segment
+    if _writer is not None and _writer[0] == os.getpid():
+        return
+    with _writer_lock:
+        if _writer is not None and _writer[0] == os.getpid():
+            return
+        if _writer is not None:
+            # we've been forked - the parent still owns
+            # anything it buffered, and its segment
+            _buffer.clear()
+            _segment = None
+        thread = threading.Thread(target=_run, name='exposure-writer')
+        thread.daemon = True
+        thread.start()
+        _writer = (os.getpid(), thread)
+        atexit.register(flush, rotate=True)
+
+
+def _run():
+    while True:
+        time.sleep(settings.EXPOSURE_FLUSH_SECONDS)
+        try:
+            flush()
+        except Exception:
+            logger.exception('Failed to write exposures')
+
+
+def flush(rotate=False):
+    """
+    Writes everything buffered so far to the current
+    segment. Then closes the segment off for
+    ingest_exposures if ROTATE, or if it's older than
+    settings.EXPOSURE_SEGMENT_SECONDS or bigger than
+    settings.EXPOSURE_SEGMENT_BYTES.
+
+    Returns the number of exposures written.
+    """
+    with _segment_lock:
+        exposures = []
+        while True:
+            try:
+                exposures.append(_buffer.popleft())
+            except IndexError:
+                break
+        if exposures:
+            segment = _open_segment()
+            data = ''.join('[%i,%i,%i]\n' % exposure for exposure in exposures)
+            segment['file'].write(data)
+            segment['file'].flush()
+            segment['nbytes'] += len(data)
+        if _segment is not None and (rotate or
+                                     time.time() - _segment['opened'] > settings.EXPOSURE_SEGMENT_SECONDS or
+                                     _segment['nbytes'] > settings.EXPOSURE_SEGMENT_BYTES):
+            _close_segment()
+        return len(exposures)
+
+
+def _open_segment():
+    global _segment, _nsegments
+    if _segment is None:
+        log_dir = settings.EXPOSURE_LOG_DIR
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        _nsegments += 1
+        name = 'exposures-%s-%i-%i-%i%s' % (socket.gethostname(), os.getpid(), int(time.time()),
+                                           _nsegments, SEGMENT_SUFFIX)
+        path = os.path.join(log_dir, name + TMP_SUFFIX)
+        _segment = {'file': open(path, 'ab'), 'path': path, 'opened': time.time(), 'nbytes': 0}
+    return _segment
+
+
+def _close_segment():
+    global _segment
+    _segment['file'].close()
+    # renaming is atomic, so ingest_exposures never sees half a segment
+    os.rename(_segment['path'], _segment['path'][:-len(TMP_SUFFIX)])
+    _segment = None
+
+
+def complete_segments(log_dir=None):
+    """
+    Returns the paths of all the segments that have been
+    closed off, oldest first.
+    """
+    log_dir = log_dir or settings.EXPOSURE_LOG_DIR
+    if not log_dir or not os.path.isdir(log_dir):
+        return []
+    paths = [os.path.join(log_dir, name) for name in os.listdir(log_dir)
+             if name.endswith(SEGMENT_SUFFIX)]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def read_segment(path):
+    """
+    Yields (expt_id, bucket_id, unix time) for each
+    exposure in the segment at PATH, skipping (and logging)
+    any lines that aren't valid.
+    """
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                expt_id, bucket_id, when = json.loads(line)
+            except (ValueError, TypeError):
+                logger.warning('Skipping bad exposure line in %s: %r', path, line)
+                continue
+            yield expt_id, bucket_id, when
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from abracadjabra.models import Bucket, Experiment, generate_salt
+from abracadjabra.utils.models import table_columns
+
+
+class Command(BaseCommand):
+    """
+    Adds the columns that the client config needs (see
+    Experiment.get_cache_config) to existing tables:
+
+    - Experiment.mod, set to CRE
+    - Experiment.salt, a new random one for each Experiment
+    - Bucket.weight, set to 1
+
+    Existing assignments don't change, since they're stored
+    - the salt only decides where new users go. It's safe to
+    run this more than once.
+    """
+    help = 'Adds Experiment.mod, Experiment.salt and Bucket.weight to existing tables.'
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        expt_table = Experiment._meta.db_table
+        bucket_table = Bucket._meta.db_table
+        # check them all before ALTERing anything, since on
+        # SQLite introspecting commits
+        expt_columns = table_columns(expt_table)
+        bucket_columns = table_columns(bucket_table)
+
+        if 'mod' not in expt_columns:
+            field = Experiment._meta.get_field('mod')
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NULL' %
+                           (qn(expt_table), qn('mod'), field.db_type(connection)))
+            cursor.execute('UPDATE %s SET %s = %s' % (qn(expt_table), qn('mod'), qn('cre')))
+            self.stdout.write('Added %s.mod' % expt_table)
+
+        if 'salt' not in expt_columns:
+            field = Experiment._meta.get_field('salt')
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NULL' %
+                           (qn(expt_table), qn('salt'), field.db_type(connection)))
+            # one UPDATE per Experiment, but there aren't many
+            cursor.execute('SELECT %s FROM %s' % (qn('id'), qn(expt_table)))
+            for (expt_id,) in cursor.fetchall():
+                cursor.execute('UPDATE %s SET %s = %%s WHERE %s = %%s' %
+                               (qn(expt_table), qn('salt'), qn('id')), [generate_salt(), expt_id])
+            self.stdout.write('Added %s.salt' % expt_table)
+
+        if 'weight' not in bucket_columns:
+            field = Bucket._meta.get_field('weight')
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT 1' %
+                           (qn(bucket_table), qn('weight'), field.db_type(connection)))
+            self.stdout.write('Added %s.weight' % bucket_table)
+
+        Experiment.invalidate_config()
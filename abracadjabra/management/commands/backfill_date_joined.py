@@ -0,0 +1,65 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max, Min
+
+from abracadjabra.models import Experiment, ExperimentUser, experiment_data_changed
+from abracadjabra.utils.models import table_columns
+
+
+class Command(BaseCommand):
+    """
+    ExperimentUser.date_joined is copied from User.date_joined
+    when a User is assigned, so that reports don't need to
+    join auth_user. This fills it in for rows from before it
+    existed, adding the column and its (experiment,
+    date_joined) index first if they're missing.
+
+    Updates in batches of ids, committing after each, so it
+    doesn't hold a lock on the whole table. It's safe to run
+    this more than once.
+    """
+    help = 'Copies User.date_joined onto ExperimentUsers that are missing it.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=10000,
+                    help='Number of ExperimentUser ids to update per transaction'),
+        )
+
+    def handle(self, *args, **options):
+        table = ExperimentUser._meta.db_table
+        qn = connection.ops.quote_name
+
+        if 'date_joined' not in table_columns(table):
+            with transaction.commit_on_success():
+                field = ExperimentUser._meta.get_field('date_joined')
+                cursor = connection.cursor()
+                cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NULL' %
+                               (qn(table), qn('date_joined'), field.db_type(connection)))
+                cursor.execute('CREATE INDEX %s ON %s (%s, %s)' %
+                               (qn(table + '_experiment_id_date_joined'), qn(table),
+                                qn('experiment_id'), qn('date_joined')))
+
+        bounds = ExperimentUser.objects.filter(date_joined__isnull=True) \
+            .aggregate(Min('id'), Max('id'))
+        if bounds['id__min'] is None:
+            self.stdout.write('Nothing to do')
+            return
+
+        sql = 'UPDATE %s SET %s = (SELECT %s FROM %s WHERE %s.%s = %s.%s) ' \
+            'WHERE %s IS NULL AND %s >= %%s AND %s < %%s' % (
+            qn(table), qn('date_joined'), qn('date_joined'), qn(User._meta.db_table),
+            qn(User._meta.db_table), qn('id'), qn(table), qn('user_id'),
+            qn('date_joined'), qn('id'), qn('id'))
+        nUpdated = 0
+        for start in range(bounds['id__min'], bounds['id__max'] + 1, options['batch_size']):
+            with transaction.commit_on_success():
+                cursor = connection.cursor()
+                cursor.execute(sql, [start, start + options['batch_size']])
+                nUpdated += cursor.rowcount
+        # the reports scoped by date_joined will have changed
+        experiment_data_changed.send(sender=ExperimentUser,
+                                     experiment_ids=Experiment.objects.values_list('id', flat=True))
+        self.stdout.write('Filled in date_joined for %i experiment users' % nUpdated)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import get_models
+
+from abracadjabra.utils.models import SoftDeletable, create_status_indexes
+
+
+class Command(BaseCommand):
+    """
+    SoftDeletable.status used to be unindexed, and syncdb
+    won't add indexes to tables that already exist. This
+    adds the status index, plus the partial indexes that
+    the ACTIVE and INACTIVE managers use, to every
+    SoftDeletable table.
+
+    It's safe to run this more than once.
+    """
+    help = 'Adds the status indexes to existing SoftDeletable tables.'
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        for model in get_models():
+            if not issubclass(model, SoftDeletable):
+                continue
+            for name in create_status_indexes(model):
+                self.stdout.write('Created index %s' % name)
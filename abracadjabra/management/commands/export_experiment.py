@@ -0,0 +1,41 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from abracadjabra import exports
+from abracadjabra.models import Experiment
+from abracadjabra.utils.dt import dt_ranges
+
+
+class Command(BaseCommand):
+    """
+    Writes an Experiment's assignments (or, with --buckets,
+    its per-bucket stats) to stdout as CSV or NDJSON, a line
+    at a time, so it runs in flat memory however big the
+    Experiment is. See exports.py.
+
+        ./manage.py export_experiment 12 --format=ndjson > expt_12.ndjson
+    """
+    args = '<experiment id>'
+    help = "Streams an Experiment's assignments or bucket stats as CSV or NDJSON."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default='csv', choices=sorted(exports.FORMATS),
+                    help='csv (default) or ndjson'),
+        make_option('--buckets', action='store_true', default=False,
+                    help='Export the per-bucket stats rather than the assignments'),
+        make_option('--dt-joined', default=None, choices=sorted(dt_ranges),
+                    help='Only Users who joined in this range, e.g. recent_week'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give one Experiment id')
+        try:
+            expt = Experiment.objects.get(id=args[0])
+        except (Experiment.DoesNotExist, ValueError):
+            raise CommandError('No Experiment %s' % args[0])
+        dt_joined = dt_ranges[options['dt_joined']][0] if options['dt_joined'] else None
+        what = 'buckets' if options['buckets'] else 'assignments'
+        for line in exports.export(what, expt, options['format'], dt_joined):
+            self.stdout.write(line, ending='')
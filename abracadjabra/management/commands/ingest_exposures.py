@@ -0,0 +1,60 @@
+import os
+from collections import defaultdict
+from datetime import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from abracadjabra.exposures import complete_segments, read_segment
+from abracadjabra.models import Exposure
+
+INGESTING_SUFFIX = '.ingesting'
+
+
+class Command(BaseCommand):
+    """
+    Loads the closed-off exposure log segments (see
+    exposures.py) into the Exposure table, as one count per
+    bucket per day, then deletes them. Run it from cron.
+
+    Each segment is renamed to *.ingesting while it's being
+    loaded, and committed in its own transaction. If this
+    dies half-way, the *.ingesting segment gets left alone
+    from then on (so it can't be counted twice) - check
+    whether it made it into the db, then rename it back to
+    *.ndjson or delete it.
+    """
+    help = 'Loads exposure log segments into the Exposure table.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dir', default=None,
+                    help='Directory of segments, if not settings.EXPOSURE_LOG_DIR'),
+        make_option('--keep', action='store_true', default=False,
+                    help='Rename loaded segments to *.done rather than deleting them'),
+        )
+
+    def handle(self, *args, **options):
+        log_dir = options['dir'] or settings.EXPOSURE_LOG_DIR
+        if not log_dir:
+            raise CommandError('Set settings.EXPOSURE_LOG_DIR, or pass --dir')
+
+        if os.path.isdir(log_dir):
+            for name in os.listdir(log_dir):
+                if name.endswith(INGESTING_SUFFIX):
+                    self.stderr.write('Skipping %s, left over from a run that died' % name)
+
+        for path in complete_segments(log_dir):
+            ingesting = path + INGESTING_SUFFIX
+            os.rename(path, ingesting)
+            counts = defaultdict(int)
+            for expt_id, bucket_id, when in read_segment(ingesting):
+                counts[(bucket_id, datetime.utcfromtimestamp(when).date())] += 1
+            with transaction.commit_on_success():
+                nAdded = Exposure.add_counts(counts)
+            if options['keep']:
+                os.rename(ingesting, path + '.done')
+            else:
+                os.remove(ingesting)
+            self.stdout.write('%s: %i exposures' % (os.path.basename(path), nAdded))
@@ -0,0 +1,120 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from abracadjabra.models import Bucket, ExperimentUser
+from abracadjabra.utils.models import table_columns
+
+# how to change whether a column is NULLable on each backend
+# (MySQL needs its type too). SQLite can't, so there the table
+# gets rebuilt instead, see Command.rebuild_sqlite
+ALTER_NULL_SQL = {'postgresql': 'ALTER TABLE %(table)s ALTER COLUMN %(column)s %(set_or_drop)s NOT NULL',
+                  'mysql': 'ALTER TABLE %(table)s MODIFY %(column)s %(type)s %(null)s',}
+
+
+class Command(BaseCommand):
+    """
+    ExperimentUser.bucket used to be a varchar with the
+    bucket name on every row. This moves existing data over
+    to the Bucket table:
+
+    - adds the ExperimentUser.bucket_id column
+    - creates a Bucket for each distinct (experiment, bucket name)
+    - points each ExperimentUser at its Bucket, with one UPDATE per Bucket
+    - drops the old varchar column, or with --keep-old-column,
+      just its NOT NULL, so that new rows can leave it out
+
+    SQLite can't drop columns, so there the table gets
+    rebuilt from the model instead, copying the rows across.
+    Otherwise it needs PostgreSQL or MySQL (see
+    ALTER_NULL_SQL), and checks before it changes anything,
+    since MySQL commits each ALTER TABLE as it goes.
+
+    Run syncdb first, so that the Bucket table exists. It's
+    safe to run this more than once.
+    """
+    help = 'Moves ExperimentUser bucket names over to the Bucket table.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--keep-old-column', action='store_true', default=False,
+                    help='Keep the old varchar ExperimentUser.bucket column, but make it NULLable (not on SQLite)'),
+        )
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        table = ExperimentUser._meta.db_table
+        qn = connection.ops.quote_name
+        if options['keep_old_column'] and connection.vendor == 'sqlite':
+            raise CommandError('SQLite can\'t change a column - leave out --keep-old-column to rebuild %s' % table)
+        if connection.vendor != 'sqlite' and connection.vendor not in ALTER_NULL_SQL:
+            raise CommandError('Can\'t change columns on %s - only on %s or SQLite' %
+                               (connection.vendor, ', '.join(sorted(ALTER_NULL_SQL))))
+        columns = table_columns(table)
+        if 'bucket' not in columns:
+            self.stdout.write('Nothing to do - %s.bucket has already been dropped' % table)
+            return
+
+        cursor = connection.cursor()
+        if 'bucket_id' not in columns:
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s integer NULL REFERENCES %s (%s)' %
+                           (qn(table), qn('bucket_id'), qn(Bucket._meta.db_table), qn('id')))
+            cursor.execute('CREATE INDEX %s ON %s (%s)' %
+                           (qn(table + '_bucket_id'), qn(table), qn('bucket_id')))
+
+        cursor.execute('SELECT DISTINCT %s, %s FROM %s WHERE %s IS NULL' %
+                       (qn('experiment_id'), qn('bucket'), qn(table), qn('bucket_id')))
+        for expt_id, name in cursor.fetchall():
+            bucket, created = Bucket.objects.get_or_create(experiment_id=expt_id, name=name)
+            cursor.execute('UPDATE %s SET %s = %%s WHERE %s = %%s AND %s = %%s AND %s IS NULL' %
+                           (qn(table), qn('bucket_id'), qn('experiment_id'), qn('bucket'), qn('bucket_id')),
+                           [bucket.id, expt_id, name])
+            self.stdout.write('%s: %i users in bucket %s' % (bucket.experiment, cursor.rowcount, name))
+
+        if connection.vendor == 'sqlite':
+            self.rebuild_sqlite(cursor, table)
+        else:
+            if options['keep_old_column']:
+                cursor.execute(self.alter_null_sql(connection.vendor, table, 'bucket', 'varchar(100)', True))
+            else:
+                cursor.execute('ALTER TABLE %s DROP COLUMN %s' % (qn(table), qn('bucket')))
+            cursor.execute(self.alter_null_sql(connection.vendor, table, 'bucket_id', 'integer', False))
+
+    def alter_null_sql(self, vendor, table, column, db_type, null):
+        """
+        Returns the SQL to make COLUMN (of type DB_TYPE) in
+        TABLE NULLable, or NOT NULL if NULL is False, on
+        VENDOR's backend (see ALTER_NULL_SQL).
+        """
+        qn = connection.ops.quote_name
+        return ALTER_NULL_SQL[vendor] % {'table': qn(table),
+                                         'column': qn(column),
+                                         'type': db_type,
+                                         'set_or_drop': 'DROP' if null else 'SET',
+                                         'null': 'NULL' if null else 'NOT NULL',}
+
+    def rebuild_sqlite(self, cursor, table):
+        """
+        Recreates TABLE from the ExperimentUser model, i.e.
+        without the old column and with bucket_id NOT NULL,
+        and copies the rows into it.
+        """
+        qn = connection.ops.quote_name
+        columns = table_columns(table)
+        old = table + '__old'
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (qn(table), qn(old)))
+        # index names are global in SQLite, so they'd clash with
+        # the new table's
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s "
+                       "AND sql IS NOT NULL", [old])
+        for (name,) in cursor.fetchall():
+            cursor.execute('DROP INDEX %s' % qn(name))
+        style = no_style()
+        statements, pending = connection.creation.sql_create_model(ExperimentUser, style)
+        for sql in statements + connection.creation.sql_indexes_for_model(ExperimentUser, style):
+            cursor.execute(sql)
+        keep = ', '.join(qn(field.column) for field in ExperimentUser._meta.fields
+                         if field.column in columns)
+        cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (qn(table), keep, keep, qn(old)))
+        cursor.execute('DROP TABLE %s' % qn(old))
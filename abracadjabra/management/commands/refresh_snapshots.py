@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from abracadjabra import snapshots
+from abracadjabra.models import Experiment
+
+
+class Command(BaseCommand):
+    """
+    Brings the columnar ExperimentUser snapshots (see
+    snapshots.py) up to date, by appending the rows added
+    since each one was last refreshed. Run it from cron.
+    """
+    help = 'Refreshes the ExperimentUser snapshots in settings.SNAPSHOT_DIR.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--experiment', type='int', default=None,
+                    help='Only refresh this Experiment id (including inactive ones)'),
+        make_option('--full', action='store_true', default=False,
+                    help='Rebuild the snapshots from scratch, e.g. after backfill_date_joined'),
+        )
+
+    def handle(self, *args, **options):
+        if snapshots.np is None:
+            raise CommandError('Snapshots need numpy')
+        if not settings.SNAPSHOT_DIR:
+            raise CommandError('Set settings.SNAPSHOT_DIR')
+
+        if options['experiment']:
+            expts = Experiment.objects.filter(id=options['experiment'])
+        else:
+            expts = Experiment.active.all()
+        for expt in expts:
+            nAdded = snapshots.refresh_snapshot(expt, full=options['full'])
+            self.stdout.write('%s: %i new rows' % (expt.name, nAdded))
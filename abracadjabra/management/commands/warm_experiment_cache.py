@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from abracadjabra.models import Experiment
+from abracadjabra.utils.dt import recent_day
+
+
+class Command(BaseCommand):
+    help = 'Primes the cache with all the active Experiments (and their recent ExperimentUsers).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=1,
+                    help='Also prime ExperimentUsers assigned in the last DAYS days (0 for none)'),
+        )
+
+    def handle(self, *args, **options):
+        days = options['days']
+        exptusers_since = recent_day(days) if days else None
+        nExpts, nExptUsers = Experiment.warm_cache(exptusers_since=exptusers_since)
+        self.stdout.write('Cached %i experiments and %i experiment users' % (nExpts, nExptUsers))
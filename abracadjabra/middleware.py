@@ -0,0 +1,63 @@
+import re
+import uuid
+
+from django.conf import settings
+from django.core import signing
+
+"""
+Lets Experiment.setup() bucket anonymous visitors, e.g.
+
+    bucket = Experiment.setup(request.user, 'E1', ['control', 'test'], request=request)
+
+Add 'abracadjabra.middleware.AnonymousIdMiddleware' to
+MIDDLEWARE_CLASSES, after AuthenticationMiddleware.
+"""
+
+ANON_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class AnonymousIdMiddleware(object):
+    """
+    Gives every visitor a random id in a long-lived cookie
+    (as REQUEST.ANON_ID), for Experiment.setup() to hash
+    anonymous visitors into buckets with.
+
+    Also keeps the buckets they've been put in while
+    anonymous in a second, signed cookie (as
+    REQUEST.ANON_BUCKETS, {expt_id: (bucket_id, bucket name)}),
+    so that they can be kept when they log in (see
+    ExperimentUser.merge_anonymous) even if the bucket
+    weights have changed since. Neither needs the db.
+    """
+    def process_request(self, request):
+        anon_id = request.COOKIES.get(settings.ANON_ID_COOKIE_NAME, '')
+        request.anon_id_new = not ANON_ID_RE.match(anon_id)
+        request.anon_id = uuid.uuid4().hex if request.anon_id_new else anon_id
+
+        request.anon_buckets = {}
+        request.anon_buckets_changed = False
+        cookie = request.COOKIES.get(settings.ANON_BUCKETS_COOKIE_NAME)
+        if cookie:
+            try:
+                # JSON keys are always strings
+                request.anon_buckets = dict((int(expt_id), tuple(val)) for expt_id, val in
+                                            signing.loads(cookie, salt=settings.ANON_BUCKETS_COOKIE_NAME).items())
+            except (signing.BadSignature, ValueError, TypeError, AttributeError):
+                pass
+
+    def process_response(self, request, response):
+        if not hasattr(request, 'anon_id'):
+            # process_request didn't run, e.g. a CommonMiddleware redirect
+            return response
+        if request.anon_id_new:
+            response.set_cookie(settings.ANON_ID_COOKIE_NAME, request.anon_id,
+                                max_age=settings.ANON_COOKIE_AGE, httponly=True)
+        if request.anon_buckets_changed:
+            if request.anon_buckets:
+                response.set_cookie(settings.ANON_BUCKETS_COOKIE_NAME,
+                                    signing.dumps(request.anon_buckets, salt=settings.ANON_BUCKETS_COOKIE_NAME,
+                                                  compress=True),
+                                    max_age=settings.ANON_COOKIE_AGE, httponly=True)
+            else:
+                response.delete_cookie(settings.ANON_BUCKETS_COOKIE_NAME)
+        return response
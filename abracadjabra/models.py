@@ -1,23 +1,35 @@
+import hashlib
+import json
+import math
 import random
+import time
 import types
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.conf import settings as sett
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db import models
-from django.db.models import Q
+from django.db import IntegrityError, connection, connections, models, router, transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.signals import post_delete, post_save
 from django.db.models.query import QuerySet
+from django.dispatch import Signal
 from django.http import Http404
 from django.utils import timezone
 
+from bitmaps import build_bucket_bitmaps
 from exceptions import SlugAttributeError
-from utils.dt import days_in_range, dt_ranges, dt_str, \
+from exposures import log_exposure
+from routers import for_reporting, reporting
+import snapshots
+from utils.dt import days_in_range, db_date, dt_ranges, dt_str, \
     recent_day, recent_week, recent_month, recent_6months, recent_year
-from utils.models import QuerySetManager, SoftDeletable, SoftDeletableQuerySet
-from utils.utils import isnum, percent, generate_mckey, as_ids
+from utils.models import QuerySetManager, SoftDeletable, SoftDeletableQuerySet, \
+    queryset_iterator
+from utils.utils import isnum, percent, cmcd, generate_mckey, as_ids, run_in_background
 
 
 """
@@ -25,33 +37,145 @@ An Experiment is an AB test (e.g. comparing multiple
 designs, variants on an algorithm).
 
 For an Experiment, you assign Users randomly to buckets
-(variants) by creating an ExperimentUser with the bucket as
-a named string. This way, no work is needed to create an
+(variants) by creating an ExperimentUser pointing to a
+Bucket. Buckets get created by name the first time anyone is
+assigned to them. This way, no work is needed to create an
 Experiment in advance - just call Experiment.setup().
 
 N.B. Once (randomly assigned to an Experiment bucket), a
 user will always be assigned to that bucket.
 
-There are no integrity constraints on bucket types, just strings in
-ExperimentUser, to keep things simple.
+There are no constraints on which bucket names an Experiment
+can have - whatever gets passed to setup() - to keep things
+simple.
 """
 
-# xxx what to do if user is not authenticated??? currently
-# returns None. better to default to first bucket??? no, i
-# think this is better. though it might be useful to know
-# that this is happening... assertEmail(user.is_authenticated) in
-# setup()?
-#
-# xxx - ideally, memcache to avoid the Experiment get() in setup()
+# Anonymous visitors get bucketed by hashing the id in their
+# AnonymousIdMiddleware cookie, without writing anything to the
+# db, and their buckets get turned into ExperimentUsers when
+# they log in (see ExperimentUser.merge_anonymous).
 #
 # xxx - perhaps have the buckets in Experiment.setup()
 # default to ['control','test']???
 
 
+# We cache small tuples rather than pickled Model instances, so
+# that each cache hit is cheap to unpickle:
+#
+#   Experiment:     (version, id, name, status, cre, salt)
+#   ExperimentUser: (version, id, bucket name, bucket id)
+#
+# Bump the version if you change what goes in them, so that
+# entries from before the change get treated as misses rather
+# than misread.
+EXPERIMENT_CACHE_VERSION = 2
+EXPERIMENTUSER_CACHE_VERSION = 2
+
+# bump if the shape of Experiment.get_cache_config()'s JSON changes
+CONFIG_VERSION = 1
+
+
+def is_cache_tuple(cached, version):
+    return isinstance(cached, tuple) and cached[0] == version
+
+
+def generate_salt():
+    return '%016x' % random.getrandbits(64)
+
+
+def hash_bucket(salt, user_key, buckets):
+    """
+    Picks one of BUCKETS, a list of (name, weight) pairs
+    sorted by name, for USER_KEY (e.g. a user id). The same
+    arguments always give the same bucket, so clients can
+    assign users themselves from the config (see
+    Experiment.get_cache_config), as long as they do exactly
+    this:
+
+    - take the SHA1 hex digest of '<salt>.<user_key>' (UTF-8)
+    - take the integer value of its first 15 hex digits,
+      modulo the sum of the weights
+    - walk the buckets in name order (by Unicode code point,
+      i.e. case-sensitive), subtracting each one's weight,
+      until that would go below zero
+
+    Buckets with a weight of 0 never get picked.
+    """
+    total = sum(weight for name, weight in buckets)
+    assert total > 0, 'all the buckets have zero weight'
+    digest = hashlib.sha1((u'%s.%s' % (salt, user_key)).encode('utf-8')).hexdigest()
+    point = int(digest[:15], 16) % total
+    for name, weight in buckets:
+        if point < weight:
+            return name
+        point -= weight
+
+
+def report_sample(report):
+    """
+    The SAMPLE a (buckets, dt_joined) report was computed
+    from, see Experiment.get_cache_report.
+    """
+    buckets, dt_joined = report
+    return buckets[0]['sample'] if buckets else 1
+
+
+# {expt_id: the last assignment period this process has written
+# to the cache}, see Experiment.note_assignments
+_assigned_periods = {}
+
+
+# Knuth's multiplicative hash, for picking the same sample of
+# Users every time - see sample_sql
+SAMPLE_HASH_MULTIPLIER = 2654435761
+SAMPLE_HASH_MODULUS = 2 ** 32
+# for 95% confidence intervals
+CI_Z = 1.96
+
+
+def sample_sql(column, sample):
+    """
+    Returns SQL that's true for a fraction SAMPLE (e.g. 0.01)
+    of the User ids in COLUMN. It's always the same Users
+    for a given SAMPLE, in every Experiment, and every
+    smaller sample is a subset of a bigger one.
+    """
+    return '((%s * %i) %%%% %i) < %i' % (column, SAMPLE_HASH_MULTIPLIER, SAMPLE_HASH_MODULUS,
+                                         int(sample * SAMPLE_HASH_MODULUS))
+
+
+def count_ci(nSampled, sample):
+    """
+    Returns (estimate, low, high) for the number of Users in
+    total, if NSAMPLED were in a SAMPLE fraction of them.
+    """
+    estimate = nSampled / float(sample)
+    spread = CI_Z * math.sqrt(nSampled * (1 - sample)) / sample
+    return estimate, max(estimate - spread, 0), estimate + spread
+
+
+def percent_ci(nSampled, nUsersSampled):
+    """
+    Returns (low, high) for the 95% interval of a percentage
+    measured as NSAMPLED out of NUSERSSAMPLED.
+    """
+    if not nUsersSampled:
+        return 0, 0
+    p = nSampled / float(nUsersSampled)
+    spread = CI_Z * math.sqrt(p * (1 - p) / nUsersSampled)
+    return 100 * max(p - spread, 0), 100 * min(p + spread, 1)
+
+
 class Experiment(SoftDeletable):
     # e.g. 'E1234 - new next button' (where 1234 = Unfuddle ticket)
     name = models.CharField(max_length=100, unique=True, db_index=True)
     cre = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
+    # also touched when any of its Buckets change (see
+    # bucket_changed), for the config's Last-Modified
+    mod = models.DateTimeField(auto_now=True)
+    # see hash_bucket. Changing it would reshuffle where new
+    # users get assigned, so it can't be edited
+    salt = models.CharField(max_length=32, default=generate_salt, editable=False)
 
     users = models.ManyToManyField('auth.User', through='ExperimentUser', related_name='experiments')
 
@@ -69,18 +193,76 @@ class Experiment(SoftDeletable):
         return reverse('experiment_detail', kwargs={'experiment_id': self.id,})
 
     @staticmethod
-    def get_cache_create(name):
-        mckey = generate_mckey('experiment', locals())
+    def mckey(name):
+        return generate_mckey('experiment', {'name': name})
+
+    def as_cache_tuple(self):
+        return (EXPERIMENT_CACHE_VERSION, self.id, self.name, self.status, self.cre, self.salt)
+
+    @staticmethod
+    def get_cache_create_tuple(name):
+        """
+        Returns the cached (version, id, name, status, cre,
+        salt) tuple for the Experiment called NAME, creating it if
+        need be. See GET_CACHE_CREATE.
+        """
+        mckey = Experiment.mckey(name)
         cached = cache.get(mckey)
-        if cached:
+        if is_cache_tuple(cached, EXPERIMENT_CACHE_VERSION):
             return cached
         expt, created = Experiment.objects.get_or_create(name=name)
-        cache.set(mckey, expt, sett.CACHE_EXPIRY['EXPERIMENT'])
-        return expt
+        cached = expt.as_cache_tuple()
+        cache.set(mckey, cached, sett.CACHE_EXPIRY['EXPERIMENT'])
+        return cached
+
+    @staticmethod
+    def get_cache_create(name):
+        version, id, name, status, cre, salt = Experiment.get_cache_create_tuple(name)
+        return Experiment(id=id, name=name, status=status, cre=cre, salt=salt)
+
+    @staticmethod
+    def warm_cache(exptusers_since=None, chunk_size=1000):
+        """
+        Primes the cache for all the active Experiments, so
+        that after a deploy or a memcached restart, the first
+        wave of traffic doesn't all miss in GET_CACHE_CREATE
+        at once. Run at worker startup (see wsgi.py) and by
+        the warm_experiment_cache management command.
+
+        If EXPTUSERS_SINCE, also primes the ExperimentUsers
+        assigned to those Experiments since then.
+
+        Uses one query for the Experiments, plus one per
+        CHUNK_SIZE ExperimentUsers, and one SET_MANY for each.
+
+        Returns (nExperiments, nExperimentUsers).
+        """
+        expts = list(Experiment.active.all())
+        cache.set_many(dict((Experiment.mckey(expt.name), expt.as_cache_tuple()) for expt in expts),
+                       sett.CACHE_EXPIRY['EXPERIMENT'])
+
+        nExptUsers = 0
+        if exptusers_since and expts:
+            eus = ExperimentUser.objects.filter(experiment__in=expts).select_related('bucket')
+            mckeys_eus = {}
+            # newest first, so we can stop as soon as we get past
+            # EXPTUSERS_SINCE (ids go up with CRE, which isn't indexed)
+            for eu in queryset_iterator(eus, chunk_size, reverse=True):
+                if eu.cre < exptusers_since:
+                    break
+                mckeys_eus[ExperimentUser.mckey(eu.experiment_id, eu.user_id)] = eu.as_cache_tuple()
+                if len(mckeys_eus) >= chunk_size:
+                    cache.set_many(mckeys_eus, sett.CACHE_EXPIRY['EXPERIMENTUSER'])
+                    nExptUsers += len(mckeys_eus)
+                    mckeys_eus = {}
+            cache.set_many(mckeys_eus, sett.CACHE_EXPIRY['EXPERIMENTUSER'])
+            nExptUsers += len(mckeys_eus)
+
+        return len(expts), nExptUsers
 
 
     @staticmethod
-    def setup(user, name, buckets):
+    def setup(user, name, buckets, request=None):
         """
         bucket = Experiment.setup(user,
                                   'E1234 - new next button',
@@ -105,43 +287,272 @@ class Experiment(SoftDeletable):
         - If the User is not part of this Experiment yet, pick a bucket and create an ExperimentUser.
         - Return bucket name.
 
-        Return None for AnonymousUser.
+        For an AnonymousUser, pass in the REQUEST, and they'll
+        be bucketed by their AnonymousIdMiddleware cookie id
+        instead, with no db writes (beyond creating the
+        Experiment and Buckets the first time anyone sees
+        them). Returns None for an AnonymousUser without a
+        REQUEST.
         """
         if not user.is_authenticated():
-            assert False, 'shouldn\'t be running experiment for unauthenticated user'
-            return None
+            anon_buckets = getattr(request, 'anon_buckets', None)
+            if anon_buckets is None:
+                # no AnonymousIdMiddleware, so nothing to hash
+                return None
+            expt = Experiment.get_cache_create_tuple(name)
+            if expt[1] not in anon_buckets:
+                anon_buckets[expt[1]] = Bucket.get_cache_create_hashed(expt[1], expt[5], request.anon_id, buckets)
+                request.anon_buckets_changed = True
+            log_exposure(expt[1], anon_buckets[expt[1]][0])
+            return anon_buckets[expt[1]][1]
 
-        expt = Experiment.get_cache_create(name)
-        exptuser = ExperimentUser.get_cache_create(expt, user, buckets)
+        expt = Experiment.get_cache_create_tuple(name)
+        exptuser = ExperimentUser.get_cache_create_tuple(expt[1], user, buckets, expt[5])
+        log_exposure(expt[1], exptuser[3])
+        bucket = exptuser[2]
 
-        assert exptuser.bucket is not None, 'no bucket assigned for %s' % expt.name
+        assert bucket is not None, 'no bucket assigned for %s' % name
         
-        # will return already-assigned bucket if existing, otherwise the random one we just picked
-        return exptuser.bucket
+        # will return already-assigned bucket if existing, otherwise the one we just hashed them to
+        return bucket
+
+    @staticmethod
+    def setup_many(user, expts_buckets):
+        """
+        Like SETUP, but for lots of Experiments at once, e.g.
+
+          Experiment.setup_many(user, {'E1': ['control', 'test'],
+                                       'E2': ['a', 'b', 'c']})
+          -> {'E1': 'test', 'E2': 'a'}
+
+        Looks up all the Experiments with one GET_MANY, and all
+        of USER's ExperimentUsers with another, so if they're
+        all cached, there are no queries at all.
+
+        USER can be a User, or just a user id, in which case
+        the User only gets fetched if they need assigning to
+        a bucket (raising User.DoesNotExist if there isn't one).
+        """
+        if isinstance(user, (int, long)):
+            user_id = user
+            user = None
+        else:
+            if not user.is_authenticated():
+                return None
+            user_id = user.id
+
+        mckeys = dict((Experiment.mckey(name), name) for name in expts_buckets)
+        cached = cache.get_many(mckeys.keys())
+        expts = {}
+        for mckey, name in mckeys.items():
+            expt = cached.get(mckey)
+            if not is_cache_tuple(expt, EXPERIMENT_CACHE_VERSION):
+                expt = Experiment.get_cache_create_tuple(name)
+            expts[name] = expt
+
+        mckeys = dict((ExperimentUser.mckey(expts[name][1], user_id), name) for name in expts_buckets)
+        cached = cache.get_many(mckeys.keys())
+        buckets = {}
+        for mckey, name in mckeys.items():
+            exptuser = cached.get(mckey)
+            if not is_cache_tuple(exptuser, EXPERIMENTUSER_CACHE_VERSION):
+                if user is None:
+                    user = User.objects.get(id=user_id)
+                exptuser = ExperimentUser.get_cache_create_tuple(expts[name][1], user, expts_buckets[name],
+                                                                 expts[name][5])
+            log_exposure(expts[name][1], exptuser[3])
+            buckets[name] = exptuser[2]
+        return buckets
+
+    @staticmethod
+    @cmcd(prefix='experiment_config', memo=True)
+    def get_cache_config():
+        """
+        Returns (etag, last_modified, json) for a snapshot of
+        all the active Experiments, with everything a client
+        needs to assign users to buckets itself (see
+        hash_bucket), e.g.
+
+          {"version": 1,
+           "experiments": [{"id": 1, "name": "E1", "salt": "8f0c...",
+                            "buckets": [["control", 1], ["test", 1]]}]}
+
+        with the buckets sorted by name. Served by config_vw.
+
+        Regenerated only after an Experiment or Bucket has
+        changed (see experiment_changed and bucket_changed).
+        """
+        expts = list(Experiment.active.order_by('id'))
+        buckets = dict((expt.id, []) for expt in expts)
+        for expt_id, name, weight in Bucket.objects.filter(experiment__in=expts) \
+                .values_list('experiment', 'name', 'weight'):
+            buckets[expt_id].append([name, weight])
+        # sorted the way hash_bucket does, rather than by the
+        # db's collation, which may ignore case etc.
+        for expt_buckets in buckets.values():
+            expt_buckets.sort()
+        config = {'version': CONFIG_VERSION,
+                  'experiments': [{'id': expt.id,
+                                   'name': expt.name,
+                                   'salt': expt.salt,
+                                   'buckets': buckets[expt.id],} for expt in expts],}
+        body = json.dumps(config, sort_keys=True, separators=(',', ':'))
+        # from all the Experiments, so that deactivating one counts too
+        last_modified = Experiment.objects.aggregate(Max('mod'))['mod__max']
+        return hashlib.md5(body).hexdigest(), last_modified, body
+
+    @staticmethod
+    def invalidate_config():
+        cache.delete(generate_mckey('EXPERIMENT_CONFIG', {}))
+
+
+    @staticmethod
+    def version_mckey(expt_id):
+        return generate_mckey('EXPERIMENT_VERSION', {'expt_id': expt_id})
 
+    @staticmethod
+    def assigned_mckey(expt_id):
+        return generate_mckey('EXPERIMENT_ASSIGNED', {'expt_id': expt_id})
+
+    @staticmethod
+    def assignment_period(t=None):
+        return int((time.time() if t is None else t) // sett.VERSION_ASSIGNMENT_SECONDS)
+
+    @staticmethod
+    def get_cache_versions(expt_ids):
+        """
+        Returns {expt_id: version} for EXPT_IDS. Put the
+        version in the cache key of anything computed from an
+        Experiment's ExperimentUsers, Conversions etc., and
+        it'll get invalidated when it needs to be.
+
+        A version is (CHANGED, ASSIGNED), where CHANGED is
+        when anything other than an assignment last changed
+        (in microseconds, see bump_versions), and ASSIGNED is
+        the period of settings.VERSION_ASSIGNMENT_SECONDS when
+        someone was last assigned (see note_assignments).
+        While that period is still going, ASSIGNED is the
+        period + 0.5, so that anything computed during it gets
+        computed once more after it's over, to take in
+        everyone assigned in the rest of it.
+
+        So reports can lag new assignments by up to
+        VERSION_ASSIGNMENT_SECONDS, but assigning Users hardly
+        ever touches the cache.
+        """
+        expt_ids = list(expt_ids)
+        changed_mckeys = dict((expt_id, Experiment.version_mckey(expt_id)) for expt_id in expt_ids)
+        assigned_mckeys = dict((expt_id, Experiment.assigned_mckey(expt_id)) for expt_id in expt_ids)
+        cached = cache.get_many(changed_mckeys.values() + assigned_mckeys.values())
+        current = Experiment.assignment_period()
+        versions = {}
+        for expt_id in expt_ids:
+            changed = cached.get(changed_mckeys[expt_id])
+            if changed is None:
+                # start from now rather than 0, so that if it gets
+                # evicted, it can't come back round to a version
+                # that things are still cached under
+                cache.add(changed_mckeys[expt_id], int(time.time() * 1000000),
+                          sett.CACHE_EXPIRY['EXPERIMENT_VERSION'])
+                changed = cache.get(changed_mckeys[expt_id])
+            assigned = cached.get(assigned_mckeys[expt_id])
+            if assigned is not None and assigned >= current:
+                assigned += 0.5
+            versions[expt_id] = (changed, assigned)
+        return versions
+
+    @staticmethod
+    def get_cache_version(expt_id):
+        return Experiment.get_cache_versions([expt_id])[expt_id]
+
+    @staticmethod
+    def version_time(version):
+        """
+        Returns the latest time anything could have changed
+        in VERSION (see GET_CACHE_VERSIONS), e.g. for a
+        Last-Modified header.
+        """
+        changed, assigned = version
+        t = changed / 1000000. if changed else 0
+        if assigned is not None:
+            # up to the end of the period, or now if it's still going
+            t = max(t, min(time.time(), (int(assigned) + 1) * sett.VERSION_ASSIGNMENT_SECONDS))
+        return datetime.fromtimestamp(t, timezone.utc)
 
+    @staticmethod
+    def bump_versions(expt_ids):
+        """
+        Invalidates everything cached under the current
+        versions of EXPT_IDS, with one cache round-trip. See
+        GET_CACHE_VERSIONS.
+        """
+        changed = int(time.time() * 1000000)
+        cache.set_many(dict((Experiment.version_mckey(expt_id), changed) for expt_id in set(expt_ids)),
+                       sett.CACHE_EXPIRY['EXPERIMENT_VERSION'])
+
+    @staticmethod
+    def note_assignments(expt_ids):
+        """
+        Records that Users have just been assigned to
+        EXPT_IDS, for GET_CACHE_VERSIONS. Each process only
+        writes to the cache the first time in each period of
+        settings.VERSION_ASSIGNMENT_SECONDS, so for nearly
+        every assignment, this is free.
+        """
+        period = Experiment.assignment_period()
+        expt_ids = [expt_id for expt_id in set(expt_ids) if _assigned_periods.get(expt_id) != period]
+        if expt_ids:
+            cache.set_many(dict((Experiment.assigned_mckey(expt_id), period) for expt_id in expt_ids),
+                           sett.CACHE_EXPIRY['EXPERIMENT_VERSION'])
+            for expt_id in expt_ids:
+                _assigned_periods[expt_id] = period
+
+    @staticmethod
+    @cmcd(prefix='bucket_bitmaps', arg_names=('expt_id', 'version',))
+    def get_cache_bucket_bitmaps(expt_id, version):
+        """
+        Returns {bucket name: Bitmap of User ids} for
+        Experiment EXPT_ID (see bitmaps.py). Pass in its
+        current VERSION (see GET_CACHE_VERSIONS).
+        """
+        with reporting():
+            return build_bucket_bitmaps(Experiment.objects.get(id=expt_id))
+
+    @for_reporting
     def users_in_bucket(self, bucket=None):
         eus = ExperimentUser.objects.filter(experiment=self)
         if bucket:
-            eus = eus.filter(bucket=bucket)
+            eus = eus.filter(bucket__in=self.buckets.filter(name=bucket))
         return User.objects.filter(id__in=list(eus.values_list('user__id', flat=True)))
         
     
+    @for_reporting
     def bucket_names(self):
         """
         Returns a sorted list of bucket names for this Experiment.
         """
-        # xxx - there has to be a way to get the database to do the set()...?
-        names = set(self.exptusers.values_list('bucket', flat=True))
+        names = list(self.buckets.order_by('name').values_list('name', flat=True))
         # since we're going to use 'All' below in COMPUTE_BUCKET
         assert 'All' not in names
-        return sorted(list(names))
+        return names
 
-    def compute_bucket(self, name, dt_joined=None, users=None):
+    @for_reporting
+    def compute_bucket(self, name, dt_joined=None, users=None, sample=None):
         """
         Computes statistics for the Users in thie
-        Experiment, in this BUCKET_NAME, who joined after
-        DT_JOINED.
+        Experiment, in this BUCKET_NAME (or 'All' of them), who
+        joined after DT_JOINED.
+
+        Uses the DATE_JOINED copied onto ExperimentUser, so
+        it's a single range scan on the (experiment,
+        date_joined) index, rather than a scan of auth_user.
+
+        If USERS, only counts those Users.
+
+        If SAMPLE (a fraction, e.g. 0.01), only looks at that
+        sample of Users (see sample_sql), and scales NUSERS up
+        to an estimate, with a 95% interval from NUSERS_LOW to
+        NUSERS_HIGH. Otherwise, those are just NUSERS.
 
         Excludes staff. Currently includes both anons and signups.
         
@@ -149,18 +560,47 @@ class Experiment(SoftDeletable):
 
         Expects you to have already run CHECK_DT_JOINED().
         """
-        if users is None: users = User.objects.all()
+        eus = ExperimentUser.objects.filter(experiment=self)
         if dt_joined:
-            users = users.filter(date_joined__gte=dt_joined)
-
+            eus = eus.filter(date_joined__gte=dt_joined)
         if name != 'All':
-            expt_users = ExperimentUser.objects \
-                .filter(experiment=self, bucket=name) \
-                .values_list('user', flat=True)
-            users = users.filter(id__in=list(expt_users))
+            # compare Bucket ids rather than names on the big table
+            eus = eus.filter(bucket__in=self.buckets.filter(name=name))
+        if sample and sample < 1:
+            qn = connection.ops.quote_name
+            eus = eus.extra(where=[sample_sql('%s.%s' % (qn(ExperimentUser._meta.db_table), qn('user_id')),
+                                              sample)])
+
+        user_ids = list(eus.values_list('user', flat=True))
+        if users is not None:
+            user_ids = as_ids(users.filter(id__in=user_ids))
+        bucket = Experiment.compute_metric(name, user_ids)
+        bucket['sample'] = sample or 1
+        bucket['nUsersSampled'] = bucket['nUsers']
+        if sample and sample < 1:
+            estimate, bucket['nUsers_low'], bucket['nUsers_high'] = count_ci(bucket['nUsers'], sample)
+            bucket['nUsers'] = int(round(estimate))
+        else:
+            bucket['nUsers_low'] = bucket['nUsers_high'] = bucket['nUsers']
+        return bucket
 
-        user_ids = list(users.values_list('id', flat=True))
-        return Experiment.compute_metric(name, user_ids)
+    def count_exposures(self, since=None):
+        """
+        Returns {bucket name: number of times anyone has been
+        shown it} (plus 'All') since the day of SINCE, from the
+        Exposure table (see exposures.py), in one grouped
+        query.
+
+        N.B. that's anyone who saw it since then, not just the
+        Users who joined since then, so it's not comparable
+        with a bucket's NUSERS.
+        """
+        exposures = Exposure.objects.filter(experiment=self)
+        if since:
+            exposures = exposures.filter(day__gte=since.date())
+        counts = dict(exposures.values_list('bucket__name').annotate(Sum('n')).order_by())
+        counts['All'] = sum(counts.values())
+        return counts
 
 
     @staticmethod
@@ -236,21 +676,357 @@ class Experiment(SoftDeletable):
             dt_joined = max(dt_joined, cre)
         return dt_joined
 
-    def compute_buckets(self, dt_joined=None, incl_all=False):
+    @for_reporting
+    def compute_buckets(self, dt_joined=None, incl_all=False, use_snapshot=False, sample=None):
         """
         Returns statistics for each BUCKET (including 'All')
         in this Experiment. See COMPUTE_BUCKET.
+
+        If USE_SNAPSHOT, counts the Users in each bucket from
+        this Experiment's snapshot (see snapshots.py) rather
+        than the db, falling back to the db if there isn't
+        one. Those buckets have an empty USERS_STR.
+
+        If SAMPLE, estimates everything from that fraction of
+        the Users - see COMPUTE_BUCKET and GET_CACHE_REPORT. A
+        snapshot is exact and fast anyway, so it ignores
+        SAMPLE.
+
+        Each bucket's NEXPOSURES is always exact, and counts
+        everyone shown it since the day of DT_JOINED - see
+        COUNT_EXPOSURES.
         """
         dt_joined = Experiment.check_dt_joined(self.cre, dt_joined)
         
         bucket_names = self.bucket_names()
         if incl_all:
             bucket_names += ['All']
-        buckets = [self.compute_bucket(bucket_name, dt_joined)
-                   for bucket_name in bucket_names]
+        counts = snapshots.count_buckets(self.id, dt_joined) if use_snapshot else None
+        if counts is None:
+            buckets = [self.compute_bucket(bucket_name, dt_joined, sample=sample)
+                       for bucket_name in bucket_names]
+        else:
+            sample = None
+            bucket_ids = dict(self.buckets.values_list('name', 'id'))
+            buckets = []
+            for bucket_name in bucket_names:
+                nUsers = (sum(counts.values()) if bucket_name == 'All'
+                          else counts.get(bucket_ids.get(bucket_name), 0))
+                buckets.append({'name': bucket_name,
+                                'users_str': '',
+                                'nUsers': nUsers,
+                                'sample': 1,
+                                'nUsersSampled': nUsers,
+                                'nUsers_low': nUsers,
+                                'nUsers_high': nUsers,})
+        exposures = self.count_exposures(dt_joined)
+        for bucket in buckets:
+            bucket['nExposures'] = exposures.get(bucket['name'], 0)
         buckets = Experiment.calc_maxes(buckets)
+        self.add_conversions(buckets, dt_joined, sample=sample)
         return buckets, dt_joined
 
+    # fractions of Users for GET_CACHE_REPORT to sample, roughest
+    # first, ending with everyone
+    REPORT_SAMPLES = (0.01, 0.1, 1)
+
+    def report_mckey(self, version, dt_joined, sample, incl_all=False, use_snapshot=False):
+        return generate_mckey('EXPERIMENT_REPORT', {'expt_id': self.id,
+                                                    'version': version,
+                                                    'dt_joined': dt_str(dt_joined),
+                                                    'sample': sample,
+                                                    'incl_all': incl_all,
+                                                    'use_snapshot': use_snapshot,})
+
+    def report_mckeys(self, dt_joined=None, incl_all=False, use_snapshot=False):
+        """
+        Returns (version, rounded DT_JOINED, [report_mckey for
+        each of REPORT_SAMPLES]) for GET_CACHE_REPORT.
+        """
+        dt_joined = Experiment.check_dt_joined(self.cre, dt_joined)
+        dt_joined = dt_joined.replace(minute=0, second=0, microsecond=0)
+        version = Experiment.get_cache_version(self.id)
+        return version, dt_joined, [self.report_mckey(version, dt_joined, sample, incl_all, use_snapshot)
+                                    for sample in Experiment.REPORT_SAMPLES]
+
+    def latest_report_mckey(self, dt_joined, incl_all=False, use_snapshot=False):
+        # the latest report of any version, see CACHE_REPORT
+        return self.report_mckey(None, dt_joined, 'latest', incl_all, use_snapshot)
+
+    def cached_report(self, dt_joined=None, incl_all=False, use_snapshot=False):
+        """
+        Returns (version, rounded DT_JOINED, the report
+        GET_CACHE_REPORT would return right now or None if it
+        would have to compute one, that report's version, the
+        samples it would still need to refine it). Only looks
+        in the cache.
+        """
+        version, dt_joined, mckeys = self.report_mckeys(dt_joined, incl_all, use_snapshot)
+        latest_mckey = self.latest_report_mckey(dt_joined, incl_all, use_snapshot)
+        cached = cache.get_many(mckeys + [latest_mckey])
+        done = [idx for idx, mckey in enumerate(mckeys) if mckey in cached]
+        if done:
+            return (version, dt_joined, cached[mckeys[done[-1]]], version,
+                    Experiment.REPORT_SAMPLES[done[-1] + 1:])
+        if latest_mckey in cached:
+            # an older version's, until this one's catches up -
+            # and no rougher than it
+            report_version, report = cached[latest_mckey]
+            return (version, dt_joined, report, report_version,
+                    [sample for sample in Experiment.REPORT_SAMPLES
+                     if sample > report_sample(report) or
+                     (sample == report_sample(report) and report_version != version)])
+        return version, dt_joined, None, None, None
+
+    def cache_report(self, version, dt_joined, incl_all, use_snapshot, report):
+        """
+        Caches REPORT under VERSION, and as the latest report,
+        for GET_CACHE_REPORT.
+        """
+        cache.set_many({self.report_mckey(version, dt_joined, report_sample(report),
+                                          incl_all, use_snapshot): report,
+                        self.latest_report_mckey(dt_joined, incl_all, use_snapshot): (version, report),},
+                       sett.CACHE_EXPIRY['EXPERIMENT_REPORT'])
+
+    def get_cache_report(self, dt_joined=None, incl_all=False, use_snapshot=False):
+        """
+        Returns COMPUTE_BUCKETS(), as exactly as it can
+        without keeping you waiting for a huge Experiment.
+
+        The first time, it only looks at a small sample of
+        the Users (REPORT_SAMPLES[0]), unless that shows there
+        are fewer than settings.APPROX_REPORT_MIN_USERS, in
+        which case it computes the exact report straight away.
+        Bigger samples, and then the exact report, get
+        computed in the background (see run_in_background) and
+        cached, so each load returns the most exact one so
+        far. Check the buckets' SAMPLE.
+
+        Reports are cached under this Experiment's version
+        (see GET_CACHE_VERSIONS), so they only get recomputed
+        once something in them has changed. Until the new
+        version's report is ready, it returns the latest one
+        of any version, so a busy Experiment never makes you
+        wait twice. DT_JOINED gets rounded down to the hour, so
+        that sliding ranges like recent_week() move on once an
+        hour.
+        """
+        version, dt_joined, report, report_version, samples = self.cached_report(dt_joined, incl_all,
+                                                                                 use_snapshot)
+        if report is None:
+            report = self.compute_buckets(dt_joined, incl_all, use_snapshot,
+                                          sample=Experiment.REPORT_SAMPLES[0])
+            buckets = report[0]
+            nUsers = sum(bucket['nUsers'] for bucket in buckets if bucket['name'] != 'All')
+            if buckets and buckets[0]['sample'] < 1 and nUsers < sett.APPROX_REPORT_MIN_USERS:
+                report = self.compute_buckets(dt_joined, incl_all, use_snapshot)
+            self.cache_report(version, dt_joined, incl_all, use_snapshot, report)
+            samples = [sample for sample in Experiment.REPORT_SAMPLES if sample > report_sample(report)]
+        if samples:
+            # one refinement at a time per report, so however
+            # often the version moves on, there's never a queue
+            # of them. The next load after it's done starts on
+            # the next version
+            run_in_background(self.report_mckey(None, dt_joined, 'refine', incl_all, use_snapshot),
+                              self.refine_report, version, dt_joined, incl_all, use_snapshot, samples)
+        return report
+
+    def refine_report(self, version, dt_joined, incl_all, use_snapshot, samples):
+        """
+        Computes and caches the report for each of SAMPLES in
+        turn, for GET_CACHE_REPORT.
+        """
+        for sample in samples:
+            report = self.compute_buckets(dt_joined, incl_all, use_snapshot, sample=sample)
+            self.cache_report(version, dt_joined, incl_all, use_snapshot, report)
+
+    @for_reporting
+    def timeseries(self, since=None, period='day'):
+        """
+        Returns (dates, [{'name': bucket name, 'counts':
+        [n]}]) with the number of Users assigned to each
+        bucket on each day (or week, starting on Monday, if
+        PERIOD is 'week') since SINCE, with a 0 for periods
+        when nobody was assigned. Days are UTC days.
+
+        One query, grouped by bucket and day, however long
+        the range.
+        """
+        assert period in ('day', 'week')
+        since = Experiment.check_dt_joined(self.cre, since)
+        if timezone.is_aware(since):
+            since = since.astimezone(timezone.utc)
+        qn = connection.ops.quote_name
+        day_sql = connection.ops.date_trunc_sql('day', '%s.%s' % (qn(ExperimentUser._meta.db_table), qn('cre')))
+        rows = ExperimentUser.objects.filter(experiment=self, cre__gte=since) \
+            .extra(select={'day': day_sql}).values('day', 'bucket') \
+            .annotate(n=Count('id')).order_by()
+
+        def period_start(day):
+            return day - timedelta(days=day.weekday()) if period == 'week' else day
+
+        dates = [period_start(day) for day in days_in_range(since, timezone.now().astimezone(timezone.utc))]
+        dates = sorted(set(dates))
+        idxs = dict((dt, idx) for idx, dt in enumerate(dates))
+        bucket_names = dict(self.buckets.values_list('id', 'name'))
+        counts = dict((name, [0] * len(dates)) for name in bucket_names.values())
+        for row in rows:
+            idx = idxs.get(period_start(db_date(row['day'])))
+            # xxx - ignores anyone assigned in the future, i.e. clock skew
+            if idx is not None:
+                counts[bucket_names[row['bucket']]][idx] += row['n']
+        return dates, [{'name': name, 'counts': counts[name]} for name in sorted(counts)]
+
+    @for_reporting
+    def compute_conversions(self, dt_joined=None, sample=None):
+        """
+        Returns {bucket name: {conversion name: (nConverted,
+        total)}}, i.e. how many of the Users in each bucket
+        (who joined after DT_JOINED) had each kind of
+        Conversion after they were assigned, and the sum of
+        those Conversions' VALUEs.
+
+        If SAMPLE, only counts that sample of the Users (see
+        sample_sql), without scaling up.
+
+        One grouped query for every bucket and conversion
+        name, so adding new kinds of Conversion doesn't add
+        queries.
+        """
+        qn = connection.ops.quote_name
+        sql = 'SELECT b.name, c.name, COUNT(DISTINCT c.user_id), SUM(c.value) ' \
+            'FROM %s eu ' \
+            'JOIN %s b ON b.id = eu.bucket_id ' \
+            'JOIN %s c ON c.user_id = eu.user_id AND c.cre >= eu.cre ' \
+            'WHERE eu.experiment_id = %%s' % (
+            qn(ExperimentUser._meta.db_table), qn(Bucket._meta.db_table), qn(Conversion._meta.db_table))
+        params = [self.id]
+        if dt_joined:
+            sql += ' AND eu.date_joined >= %s'
+            params.append(dt_joined)
+        if sample and sample < 1:
+            sql += ' AND ' + sample_sql('eu.user_id', sample)
+        sql += ' GROUP BY b.name, c.name'
+        # raw SQL doesn't go through the router by itself
+        cursor = connections[router.db_for_read(ExperimentUser)].cursor()
+        cursor.execute(sql, params)
+        conversions = {}
+        for bucket_name, name, nConverted, total in cursor.fetchall():
+            conversions.setdefault(bucket_name, {})[name] = (nConverted, total or 0)
+        return conversions
+
+    def add_conversions(self, buckets, dt_joined=None, sample=None):
+        """
+        Adds a CONVERSIONS list to each of BUCKETS (from
+        COMPUTE_BUCKETS), with a dict for each kind of
+        Conversion, in name order, e.g.
+
+          {'name': 'purchase', 'nConverted': 3, 'pct': 30.0,
+           'pct_low': 21.0, 'pct_high': 39.0,
+           'total': 45.0, 'per_user': 4.5, 'pct_max': True}
+
+        where PCT and PER_USER are out of the bucket's
+        NUSERSSAMPLED (i.e. NUSERS, unless SAMPLE), and the
+        %_MAX keys work like CALC_MAXES.
+
+        If SAMPLE, NCONVERTED and TOTAL are scaled-up
+        estimates, and PCT_LOW to PCT_HIGH is a 95% interval
+        for PCT.
+        """
+        conversions = self.compute_conversions(dt_joined, sample)
+        # 'All' is the sum of the buckets, since no User is in two
+        conversions['All'] = {}
+        for bucket_name, d in conversions.items():
+            if bucket_name == 'All':
+                continue
+            for name, (nConverted, total) in d.items():
+                all_nConverted, all_total = conversions['All'].get(name, (0, 0))
+                conversions['All'][name] = (all_nConverted + nConverted, all_total + total)
+        names = sorted(conversions['All'])
+
+        for bucket in buckets:
+            d = conversions.get(bucket['name'], {})
+            bucket['conversions'] = []
+            for name in names:
+                nConverted, total = d.get(name, (0, 0))
+                nUsers = bucket['nUsersSampled']
+                pct = percent(nConverted, nUsers)
+                per_user = total / float(nUsers) if nUsers else 0
+                if sample and sample < 1:
+                    pct_low, pct_high = percent_ci(nConverted, nUsers)
+                    nConverted, total = int(round(nConverted / sample)), total / sample
+                else:
+                    pct_low = pct_high = pct
+                bucket['conversions'].append({'name': name,
+                                              'nConverted': nConverted,
+                                              'pct': pct,
+                                              'pct_low': pct_low,
+                                              'pct_high': pct_high,
+                                              'total': total,
+                                              'per_user': per_user,})
+        for idx in range(len(names)):
+            Experiment.calc_maxes([bucket['conversions'][idx] for bucket in buckets])
+        return buckets
+
+
+class Bucket(models.Model):
+    """
+    One of the variants (e.g. 'control') in an Experiment.
+
+    These get created the first time anyone is assigned to
+    them (see ExperimentUser.get_cache_create_tuple), so that
+    ExperimentUsers can refer to them by id rather than
+    repeating the name on every row.
+    """
+    experiment = models.ForeignKey(Experiment, related_name='buckets')
+    name = models.CharField(max_length=100)
+    cre = models.DateTimeField(default=timezone.now, editable=False)
+    weight = models.PositiveIntegerField(default=1,
+                                         help_text="Relative share of new users to assign here. 0 to stop assigning any")
+
+    class Meta:
+        ordering = ('experiment', 'name',)
+        unique_together = ('experiment', 'name',)
+
+    def __unicode__(self):
+        return unicode(self.name)
+
+    @staticmethod
+    def mckey(expt_id):
+        return generate_mckey('buckets', {'expt_id': expt_id})
+
+    @staticmethod
+    def get_cache_create_weights(expt_id, names):
+        """
+        Returns the cached {name: (id, weight)} dict for all
+        of Experiment EXPT_ID's Buckets, first creating any
+        of NAMES that don't exist yet.
+
+        Invalidated whenever a Bucket changes (see
+        bucket_changed).
+        """
+        mckey = Bucket.mckey(expt_id)
+        weights = cache.get(mckey)
+        if weights is not None and all(name in weights for name in names):
+            return weights
+        for name in names:
+            Bucket.objects.get_or_create(experiment_id=expt_id, name=name)
+        weights = dict((name, (id, weight)) for id, name, weight in
+                       Bucket.objects.filter(experiment=expt_id).values_list('id', 'name', 'weight'))
+        cache.set(mckey, weights, sett.CACHE_EXPIRY['EXPERIMENT'])
+        return weights
+
+    @staticmethod
+    def get_cache_create_hashed(expt_id, salt, user_key, names):
+        """
+        Returns (id, name) of the Bucket out of NAMES that
+        USER_KEY hashes to in Experiment EXPT_ID (see
+        hash_bucket), creating the Buckets if need be.
+        """
+        weights = Bucket.get_cache_create_weights(expt_id, names)
+        name = hash_bucket(salt, user_key, [(name, weights[name][1]) for name in sorted(set(names))])
+        return weights[name][0], name
+
 
 class ExperimentUser(models.Model):
     """
@@ -260,37 +1036,272 @@ class ExperimentUser(models.Model):
     """
     user = models.ForeignKey('auth.User', related_name='exptusers')
     experiment = models.ForeignKey(Experiment, related_name='exptusers')
-    bucket = models.CharField(max_length=100)
+    bucket = models.ForeignKey(Bucket, related_name='exptusers')
     cre = models.DateTimeField(default=timezone.now, editable=False)
+    # copied from User.date_joined when they're assigned, so
+    # that reports don't have to join auth_user (see
+    # Experiment.compute_bucket). None for rows from before
+    # this existed - see the backfill_date_joined command
+    date_joined = models.DateTimeField(null=True, editable=False)
 
     class Meta:
         ordering = ('-id',) # CRE isn't indexed, because we want to make this fast to create
         unique_together = ('experiment', 'user',)
+        index_together = (('experiment', 'date_joined',),)
     
     def __unicode__(self):
         return u"%s in bucket %s of experiment %s" % (self.user, self.bucket, self.experiment.name)
 
     @staticmethod
-    def get_cache_create(expt, user, buckets):
-        mckey = generate_mckey('experiment', locals())
+    def mckey(expt_id, user_id):
+        # BUCKETS aren't part of the key, since they only
+        # matter when the ExperimentUser is first created
+        return generate_mckey('experimentuser', {'expt_id': expt_id, 'user_id': user_id})
+
+    def as_cache_tuple(self):
+        return (EXPERIMENTUSER_CACHE_VERSION, self.id, self.bucket.name, self.bucket_id)
+
+    @staticmethod
+    def get_cache_create_tuple(expt_id, user, buckets, salt):
+        """
+        Returns the cached (version, id, bucket, bucket_id) tuple for
+        USER in Experiment EXPT_ID, assigning them to one of
+        BUCKETS if they aren't in it yet (see hash_bucket -
+        SALT is the Experiment's).
+        """
+        mckey = ExperimentUser.mckey(expt_id, user.id)
         cached = cache.get(mckey)
-        if cached:
+        if is_cache_tuple(cached, EXPERIMENTUSER_CACHE_VERSION):
             return cached
 
-        exptuser, created = ExperimentUser.objects.get_or_create(experiment=expt, user=user)
-        # exptuser.bucket should never be None, but we want to be sure.
-        if created or exptuser.bucket is None:
-            exptuser.bucket = random.choice(buckets)
-            exptuser.save()
+        try:
+            exptuser = ExperimentUser.objects.select_related('bucket') \
+                .get(experiment=expt_id, user=user)
+        except ExperimentUser.DoesNotExist:
+            bucket_id, bucket = Bucket.get_cache_create_hashed(expt_id, salt, user.id, buckets)
+            exptuser, created = ExperimentUser.objects.get_or_create(
+                experiment_id=expt_id, user=user,
+                defaults={'bucket_id': bucket_id, 'date_joined': user.date_joined})
+            if created:
+                # save AS_CACHE_TUPLE a query
+                exptuser.bucket = Bucket(id=bucket_id, experiment_id=expt_id, name=bucket)
             # create a property of Experiment.name with value of bucket_name
             # see http://support.kissmetrics.com/advanced/a-b-testing/running-an-a-b-test (at the bottom)
             # km_set(user, {expt.name: exptuser.bucket})
 
-        cache.set(mckey, exptuser, sett.CACHE_EXPIRY['EXPERIMENTUSER'])
-        return exptuser
+        cached = exptuser.as_cache_tuple()
+        cache.set(mckey, cached, sett.CACHE_EXPIRY['EXPERIMENTUSER'])
+        return cached
+
+    @staticmethod
+    def get_cache_create(expt, user, buckets):
+        """
+        Like GET_CACHE_CREATE_TUPLE, but returns an
+        ExperimentUser.
+
+        N.B. CRE isn't cached, so it'll be None - refetch the
+        ExperimentUser if you need it.
+        """
+        version, id, bucket, bucket_id = ExperimentUser.get_cache_create_tuple(expt.id, user, buckets, expt.salt)
+        return ExperimentUser(id=id, experiment=expt, user=user,
+                              bucket=Bucket(id=bucket_id, experiment=expt, name=bucket), cre=None)
+
+    @staticmethod
+    def merge_anonymous(user, anon_buckets):
+        """
+        Puts USER into the buckets they were in while they
+        were anonymous, i.e. ANON_BUCKETS {expt_id: (bucket_id,
+        bucket name)} from AnonymousIdMiddleware, with one
+        bulk INSERT. Experiments they're already in are left
+        alone, as are any that have since been deleted. If
+        another request puts them into some of the same ones
+        in the meantime (e.g. a double-submitted login), it
+        falls back to GET_OR_CREATE for each.
+
+        Returns the number of ExperimentUsers created.
+        """
+        if not anon_buckets:
+            return 0
+        # check the Buckets (and their Experiments) still exist
+        bucket_ids = [bucket_id for bucket_id, name in anon_buckets.values()]
+        valid = set(Bucket.objects.filter(id__in=bucket_ids).values_list('experiment', 'id'))
+        existing = set(ExperimentUser.objects.filter(user=user, experiment__in=anon_buckets.keys())
+                       .values_list('experiment', flat=True))
+        eus = [ExperimentUser(user=user, experiment_id=expt_id, bucket_id=bucket_id, date_joined=user.date_joined)
+               for expt_id, (bucket_id, name) in anon_buckets.items()
+               if (expt_id, bucket_id) in valid and expt_id not in existing]
+        sid = transaction.savepoint()
+        try:
+            ExperimentUser.objects.bulk_create(eus)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            eus = [eu for eu in eus
+                   if ExperimentUser.objects.get_or_create(
+                       experiment_id=eu.experiment_id, user=user,
+                       defaults={'bucket_id': eu.bucket_id, 'date_joined': eu.date_joined})[1]]
+        Experiment.note_assignments([eu.experiment_id for eu in eus])
+        return len(eus)
+
+    @staticmethod
+    def experiment_ids_for_users(user_ids, chunk_size=500):
+        """
+        Returns the set of Experiment ids that USER_IDS are
+        in, CHUNK_SIZE Users per query.
+        """
+        user_ids = list(set(user_ids))
+        expt_ids = set()
+        for start in range(0, len(user_ids), chunk_size):
+            expt_ids.update(ExperimentUser.objects.filter(user__in=user_ids[start:start + chunk_size])
+                            .values_list('experiment', flat=True).distinct())
+        return expt_ids
 
     @staticmethod
     def get_latest(expt):
         return ExperimentUser.objects.filter(experiment=expt).order_by('-cre')[0]
 
 
+# Send this with EXPERIMENT_IDS after changing lots of rows that
+# go into those Experiments' reports at once, e.g. with
+# bulk_create() or QuerySet.update(), which don't send
+# post_save. It bumps their versions, invalidating any cached
+# reports (see Experiment.get_cache_versions).
+experiment_data_changed = Signal(providing_args=['experiment_ids'])
+
+def bump_experiment_versions(sender, experiment_ids, **kwargs):
+    Experiment.bump_versions(experiment_ids)
+experiment_data_changed.connect(bump_experiment_versions)
+
+
+def experiment_changed(sender, instance, **kwargs):
+    # N.B. QuerySet.update() doesn't send signals, so call
+    # invalidate_config() yourself after one
+    Experiment.invalidate_config()
+    Experiment.bump_versions([instance.id])
+post_save.connect(experiment_changed, sender=Experiment)
+post_delete.connect(experiment_changed, sender=Experiment)
+
+
+def bucket_changed(sender, instance, **kwargs):
+    cache.delete(Bucket.mckey(instance.experiment_id))
+    Experiment.objects.filter(id=instance.experiment_id).update(mod=timezone.now())
+    Experiment.invalidate_config()
+    Experiment.bump_versions([instance.experiment_id])
+post_save.connect(bucket_changed, sender=Bucket)
+post_delete.connect(bucket_changed, sender=Bucket)
+
+
+def exptuser_changed(sender, instance, created=False, **kwargs):
+    # new assignments only need noting, which is nearly free -
+    # anything else (e.g. a change of bucket) is a real change
+    if created:
+        Experiment.note_assignments([instance.experiment_id])
+    else:
+        Experiment.bump_versions([instance.experiment_id])
+post_save.connect(exptuser_changed, sender=ExperimentUser)
+post_delete.connect(exptuser_changed, sender=ExperimentUser)
+
+
+class Exposure(models.Model):
+    """
+    How many times anyone was shown BUCKET on DAY (UTC).
+
+    Loaded in bulk from the exposure log segments by the
+    ingest_exposures management command (see exposures.py),
+    rather than written per exposure.
+    """
+    experiment = models.ForeignKey(Experiment, related_name='exposures')
+    bucket = models.ForeignKey(Bucket, related_name='exposures')
+    day = models.DateField()
+    n = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ('-day',)
+        unique_together = ('bucket', 'day',)
+        index_together = (('experiment', 'day',),)
+
+    def __unicode__(self):
+        return u"%i exposures to bucket %s on %s" % (self.n, self.bucket, self.day)
+
+    @staticmethod
+    def add_counts(counts):
+        """
+        Adds COUNTS {(bucket_id, day): n} onto the Exposure
+        rows, creating any that don't exist yet in one
+        bulk_create. Counts for Buckets that no longer exist
+        get dropped.
+
+        Returns the number of exposures added.
+        """
+        bucket_expts = dict(Bucket.objects.filter(id__in=set(bucket_id for bucket_id, day in counts))
+                            .values_list('id', 'experiment'))
+        new = []
+        nAdded = 0
+        for (bucket_id, day), n in sorted(counts.items()):
+            if bucket_id not in bucket_expts:
+                continue
+            nAdded += n
+            if not Exposure.objects.filter(bucket=bucket_id, day=day).update(n=F('n') + n):
+                new.append(Exposure(experiment_id=bucket_expts[bucket_id], bucket_id=bucket_id, day=day, n=n))
+        Exposure.objects.bulk_create(new)
+        experiment_data_changed.send(sender=Exposure, experiment_ids=bucket_expts.values())
+        return nAdded
+
+
+class Conversion(models.Model):
+    """
+    Something a User did that an Experiment might make more
+    or less likely, e.g. NAME='signup', or NAME='purchase'
+    with VALUE=the amount.
+
+    Reports count the Conversions after each User was
+    assigned to a bucket (see Experiment.compute_conversions).
+    Record them in bulk with RECORD_MANY where you can.
+    """
+    user = models.ForeignKey('auth.User', related_name='conversions')
+    name = models.CharField(max_length=100)
+    cre = models.DateTimeField(default=timezone.now)
+    value = models.FloatField(default=1)
+
+    class Meta:
+        ordering = ('-id',)
+        # for the join in Experiment.compute_conversions
+        index_together = (('user', 'cre',),)
+
+    def __unicode__(self):
+        return u"%s %s (%s) at %s" % (self.user, self.name, self.value, self.cre)
+
+    @staticmethod
+    def record(user, name, value=1, cre=None):
+        conversion = Conversion.objects.create(user=user, name=name, value=value, cre=cre or timezone.now())
+        experiment_data_changed.send(sender=Conversion,
+                                     experiment_ids=ExperimentUser.experiment_ids_for_users([user.id]))
+        return conversion
+
+    @staticmethod
+    def record_many(conversions, batch_size=1000):
+        """
+        Records CONVERSIONS, a list of dicts of Conversion
+        fields, e.g.
+
+          Conversion.record_many([{'user_id': 1, 'name': 'signup'},
+                                  {'user_id': 2, 'name': 'purchase', 'value': 9.99}])
+
+        with one INSERT per BATCH_SIZE. Returns the number
+        recorded.
+        """
+        objs = [Conversion(**d) for d in conversions]
+        Conversion.objects.bulk_create(objs, batch_size=batch_size)
+        experiment_data_changed.send(sender=Conversion, experiment_ids=ExperimentUser.experiment_ids_for_users(
+                [obj.user_id for obj in objs]))
+        return len(objs)
+
+
+def merge_anonymous_exptusers(sender, request, user, **kwargs):
+    anon_buckets = getattr(request, 'anon_buckets', None)
+    if anon_buckets:
+        ExperimentUser.merge_anonymous(user, anon_buckets)
+        # they're in the db now, so empty the cookie
+        anon_buckets.clear()
+        request.anon_buckets_changed = True
+user_logged_in.connect(merge_anonymous_exptusers)
@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+"""
+Sends the reads for reports to a replica, so that however hard
+the reports hammer the db, they don't slow down assigning users
+to buckets (Experiment.setup etc.), which only ever uses the
+primary.
+
+Wrap the reporting code in reporting() or @for_reporting, e.g.
+
+    with reporting():
+        buckets, dt_joined = expt.compute_buckets()
+
+(Experiment.compute_buckets and the other report methods
+already are), and set settings.REPORTING_DATABASE to the
+replica's alias. Writes always go to the primary, even inside
+reporting().
+
+If the replica can't be reached, reads go to the primary
+instead, and it gets checked again after
+settings.REPORTING_CHECK_SECONDS.
+
+N.B. reports from a replica can lag slightly behind the primary.
+"""
+
+logger = logging.getLogger(__name__)
+
+# per thread, so e.g. the dashboard's threads each need their own
+_local = threading.local()
+
+# alias -> (when it was checked, whether it was up)
+_health = {}
+
+
+@contextmanager
+def reporting():
+    """
+    Sends the reads inside it to settings.REPORTING_DATABASE
+    (in this thread). Can be nested.
+    """
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+
+
+def for_reporting(func):
+    """
+    Decorator that runs FUNC inside reporting().
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        with reporting():
+            return func(*args, **kwargs)
+    return wrapped
+
+
+def in_reporting():
+    return getattr(_local, 'depth', 0) > 0
+
+
+def is_available(alias):
+    """
+    Whether we can run queries on db ALIAS, checked at most
+    once every settings.REPORTING_CHECK_SECONDS (per
+    process).
+    """
+    checked = _health.get(alias)
+    if checked and time.time() - checked[0] < settings.REPORTING_CHECK_SECONDS:
+        return checked[1]
+    try:
+        connections[alias].cursor().execute('SELECT 1')
+        up = True
+    except Exception:
+        logger.warning('Database %s is unavailable, reporting from the primary', alias, exc_info=True)
+        connections[alias].close()
+        up = False
+    _health[alias] = (time.time(), up)
+    return up
+
+
+class ReportingRouter(object):
+    """
+    Add 'abracadjabra.routers.ReportingRouter' to
+    settings.DATABASE_ROUTERS. Only has an opinion about
+    reads inside reporting().
+    """
+    def db_for_read(self, model, **hints):
+        alias = settings.REPORTING_DATABASE
+        if alias and in_reporting() and is_available(alias):
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # they're the same data, so an object read from the
+        # replica can point to one from the primary
+        alias = settings.REPORTING_DATABASE
+        if alias and set([obj1._state.db, obj2._state.db]) <= set(['default', alias]):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        return None
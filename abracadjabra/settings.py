@@ -17,9 +17,18 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'abracadjabra.sqlite',
-    }
+    },
+    # a read replica of 'default' for reports to use, see
+    # REPORTING_DATABASE. Locally, it's just the same file
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'abracadjabra.sqlite',
+    },
 }
 
+# see routers.py
+DATABASE_ROUTERS = ['abracadjabra.routers.ReportingRouter']
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -98,6 +107,8 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'abracadjabra.utils.utils.RequestMemoMiddleware',
+    'abracadjabra.middleware.AnonymousIdMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -161,4 +172,80 @@ LOGGING = {
 CACHE_EXPIRY = {
     'EXPERIMENT': 3600,
     'EXPERIMENTUSER': 3600,
+    # exact COUNT(*)s for filtered admin changelists, see utils.admin
+    'ADMIN_COUNT': 300,
+    # SoftDeletable.active_ids(), also invalidated on save/delete
+    'ACTIVE_IDS': 3600,
+    # invalidated whenever an Experiment or Bucket changes
+    'EXPERIMENT_CONFIG': 86400,
+    # these are keyed by the Experiment's version (see
+    # Experiment.get_cache_versions), so they never go stale -
+    # they can stay until they get evicted
+    'EXPERIMENT_VERSION': 30 * 86400,
+    'BUCKET_BITMAPS': 7 * 86400,
+    'EXPERIMENT_REPORT': 7 * 86400,
+    # how long the dashboard can keep showing a stale row, see
+    # DASHBOARD_SOFT_EXPIRY
+    'DASHBOARD_SUMMARY': 86400,
 }
+
+# prime the cache with all the active Experiments when a worker
+# starts, along with the ExperimentUsers assigned in the last N days
+# (see wsgi.py and Experiment.warm_cache)
+WARM_CACHE_ON_STARTUP = True
+WARM_CACHE_EXPTUSERS_DAYS = 1
+
+# size of the thread pool for refreshing stale cmcd(soft_expiry=...)
+# values, see utils.utils.run_in_background
+BACKGROUND_THREADS = 4
+
+# shared secret that callers of the JSON assignment app must send
+# in an X-Abracadjabra-Secret header (see assign.py). The app
+# refuses every request while this is empty
+ASSIGN_SECRET = ''
+
+# cookies for bucketing anonymous visitors (see middleware.py)
+ANON_ID_COOKIE_NAME = 'abracadjabra_anon'
+ANON_BUCKETS_COOKIE_NAME = 'abracadjabra_buckets'
+ANON_COOKIE_AGE = 365 * 24 * 60 * 60
+
+# where each process writes its exposure log segments for the
+# ingest_exposures command to load, e.g. '/var/spool/abracadjabra'
+# (see exposures.py). None turns exposure logging off
+EXPOSURE_LOG_DIR = None
+EXPOSURE_FLUSH_SECONDS = 5
+# close a segment off for ingesting once it's this old or big
+EXPOSURE_SEGMENT_SECONDS = 300
+EXPOSURE_SEGMENT_BYTES = 16 * 1024 * 1024
+
+# where the refresh_snapshots command writes its columnar
+# snapshots of ExperimentUsers, for the detail view to count
+# buckets from rather than the db (see snapshots.py). None turns
+# snapshots off. Needs numpy
+SNAPSHOT_DIR = None
+
+# new assignments only invalidate cached reports once per this
+# many seconds, so that assigning Users hardly ever touches the
+# cache (see Experiment.get_cache_versions)
+VERSION_ASSIGNMENT_SECONDS = 60
+
+# the dashboard computes each active Experiment's report in its
+# own thread (and db connection), giving up on any still running
+# after DASHBOARD_TIMEOUT seconds (see dashboard.py)
+DASHBOARD_THREADS = 4
+DASHBOARD_TIMEOUT = 60
+# after this many seconds, a dashboard row gets recomputed in the
+# background, while the old one is still shown
+DASHBOARD_SOFT_EXPIRY = 300
+
+# the alias in DATABASES for reports to read from (see routers.py),
+# e.g. 'replica'. None reads from the primary
+REPORTING_DATABASE = None
+# how long to wait before checking an unavailable
+# REPORTING_DATABASE again (or an available one, for being down)
+REPORTING_CHECK_SECONDS = 30
+
+# the detail page shows a report from a sample of users first (see
+# Experiment.get_cache_report), unless that shows there are fewer
+# users than this, in which case it just computes the exact one
+APPROX_REPORT_MIN_USERS = 100000
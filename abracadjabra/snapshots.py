@@ -0,0 +1,204 @@
+import calendar
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+from routers import for_reporting
+from utils.models import queryset_iterator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Columnar snapshots of each Experiment's ExperimentUsers, so
+that reports can count buckets without scanning the
+ExperimentUser table every time (see
+Experiment.compute_buckets(use_snapshot=True)).
+
+Each Experiment gets a directory in settings.SNAPSHOT_DIR with
+one raw binary file per column (see COLUMNS), loaded
+memory-mapped, plus a meta.json with the number of rows, the
+max ExperimentUser id seen so far and the Bucket id for each
+bucket index.
+
+The refresh_snapshots management command only fetches the
+ExperimentUsers added since the max id, and appends them to
+the column files, so run it from cron as often as you like.
+Rows can commit out of id order (a slow transaction can hold a
+lower id), so each refresh also looks again at the last
+OVERLAP_IDS ids, skipping the ones it already has (listed in
+meta['tail_ids']). ExperimentUsers are never updated in the
+normal run of things - but if you change old rows
+(e.g. backfill_date_joined), run it with --full.
+
+Needs numpy. Without it (or without a snapshot), reports just
+fall back to the db.
+"""
+
+SNAPSHOT_VERSION = 2
+
+# (column, dtype). Times are unix seconds, with -1 for a NULL
+# DATE_JOINED. BUCKET is an index into meta['bucket_ids']
+COLUMNS = (('id', 'int64'),
+           ('user_id', 'int64'),
+           ('bucket', 'int32'),
+           ('cre', 'int64'),
+           ('date_joined', 'int64'),
+           )
+
+META_NAME = 'meta.json'
+
+# how far below the max id each refresh looks again, for rows
+# that committed late
+OVERLAP_IDS = 1000
+
+
+def to_timestamp(dt):
+    """
+    Returns DT as unix seconds (or -1 for None), treating
+    naive datetimes as being in the default timezone.
+    """
+    if dt is None:
+        return -1
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.get_default_timezone())
+    return calendar.timegm(dt.utctimetuple())
+
+
+def snapshot_dir(expt_id):
+    return os.path.join(settings.SNAPSHOT_DIR, 'experiment_%i' % expt_id)
+
+
+def column_path(path, column):
+    return os.path.join(path, column + '.bin')
+
+
+def _save_atomic(path, write):
+    # readers never see a half-written file
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.rename(tmp, path)
+
+
+def load_meta(expt_id):
+    """
+    Returns the meta.json for Experiment EXPT_ID's snapshot,
+    or None if there's no (current) snapshot.
+    """
+    try:
+        with open(os.path.join(snapshot_dir(expt_id), META_NAME), 'rb') as f:
+            meta = json.load(f)
+    except IOError:
+        return None
+    if meta.get('version') != SNAPSHOT_VERSION:
+        return None
+    return meta
+
+
+def load_snapshot(expt_id, mmap=True):
+    """
+    Returns (meta, {column: array}) for Experiment EXPT_ID,
+    or None if there's no (current) snapshot or no
+    numpy. The arrays are read-only memory maps if MMAP.
+    """
+    if np is None or not settings.SNAPSHOT_DIR:
+        return None
+    meta = load_meta(expt_id)
+    if meta is None:
+        return None
+    path = snapshot_dir(expt_id)
+    n = meta['n']
+    # a refresh may have appended to the columns since we
+    # read META, so ignore anything past its N. numpy can't
+    # memory-map an empty array
+    arrays = dict((column, np.memmap(column_path(path, column), dtype=dtype, mode='r', shape=(n,))
+                   if mmap and n else np.fromfile(column_path(path, column), dtype=dtype, count=n))
+                  for column, dtype in COLUMNS)
+    return meta, arrays
+
+
+@for_reporting
+def refresh_snapshot(expt, full=False, chunk_size=10000):
+    """
+    Appends the ExperimentUsers for EXPT added since the
+    last refresh to its snapshot (or rebuilds it from
+    scratch if FULL). Returns the number of rows added.
+    """
+    if np is None:
+        raise ImproperlyConfigured('Snapshots need numpy')
+    if not settings.SNAPSHOT_DIR:
+        raise ImproperlyConfigured('Set settings.SNAPSHOT_DIR to use snapshots')
+    path = snapshot_dir(expt.id)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    meta = None if full else load_meta(expt.id)
+    rebuild = meta is None
+    if rebuild:
+        meta = {'version': SNAPSHOT_VERSION, 'n': 0, 'max_id': 0, 'bucket_ids': [], 'tail_ids': []}
+    bucket_idxs = dict((bucket_id, idx) for idx, bucket_id in enumerate(meta['bucket_ids']))
+    seen = set(meta['tail_ids'])
+
+    rows = dict((column, []) for column, dtype in COLUMNS)
+    eus = expt.exptusers.filter(id__gt=meta['max_id'] - OVERLAP_IDS).values_list(
+        'id', 'user', 'bucket', 'cre', 'date_joined')
+    for eu_id, user_id, bucket_id, cre, date_joined in queryset_iterator(eus, chunk_size):
+        if eu_id in seen:
+            continue
+        if bucket_id not in bucket_idxs:
+            bucket_idxs[bucket_id] = len(meta['bucket_ids'])
+            meta['bucket_ids'].append(bucket_id)
+        rows['id'].append(eu_id)
+        rows['user_id'].append(user_id)
+        rows['bucket'].append(bucket_idxs[bucket_id])
+        rows['cre'].append(to_timestamp(cre))
+        rows['date_joined'].append(to_timestamp(date_joined))
+    nAdded = len(rows['id'])
+    if not nAdded and not rebuild:
+        return 0
+
+    for column, dtype in COLUMNS:
+        array = np.array(rows[column], dtype=dtype)
+        if rebuild:
+            _save_atomic(column_path(path, column), lambda f: array.tofile(f))
+        else:
+            with open(column_path(path, column), 'r+b') as f:
+                # throw away anything a failed refresh appended
+                # after the last complete row
+                f.truncate(meta['n'] * array.itemsize)
+                f.seek(0, os.SEEK_END)
+                array.tofile(f)
+    meta['n'] += nAdded
+    meta['max_id'] = max([meta['max_id']] + rows['id'])
+    meta['tail_ids'] = sorted(eu_id for eu_id in seen.union(rows['id'])
+                              if eu_id > meta['max_id'] - OVERLAP_IDS)
+    meta['refreshed'] = int(time.time())
+    # write META last, so readers only see the new rows once
+    # every column has them
+    _save_atomic(os.path.join(path, META_NAME),
+                 lambda f: json.dump(meta, f))
+    return nAdded
+
+
+def count_buckets(expt_id, since=None):
+    """
+    Returns {bucket id: number of Users} for Experiment
+    EXPT_ID from its snapshot, only counting Users who joined
+    after SINCE. Returns None if there's no snapshot.
+    """
+    snapshot = load_snapshot(expt_id)
+    if snapshot is None:
+        return None
+    meta, arrays = snapshot
+    buckets = arrays['bucket']
+    if since is not None:
+        buckets = buckets[arrays['date_joined'] >= to_timestamp(since)]
+    counts = np.bincount(buckets, minlength=len(meta['bucket_ids']))
+    return dict(zip(meta['bucket_ids'], counts.tolist()))
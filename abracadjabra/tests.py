@@ -1,14 +1,47 @@
 import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import pickle
+from multiprocessing import TimeoutError
+from StringIO import StringIO
 
 from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.validation import validate
 from django.contrib.auth.models import User, AnonymousUser
-from django.test import TestCase
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection, connections
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
 
-from abracadjabra.models import Experiment, ExperimentUser
+from abracadjabra.models import Bucket, Conversion, Experiment, ExperimentUser, Exposure, \
+    EXPERIMENTUSER_CACHE_VERSION, SAMPLE_HASH_MODULUS, SAMPLE_HASH_MULTIPLIER, hash_bucket
+from abracadjabra import assign, exports, exposures, models, routers, snapshots, views
+from abracadjabra.admin import ExperimentUserAdmin
+from abracadjabra.bitmaps import Bitmap, crosstab, overlap_matrix
+from abracadjabra import dashboard
+from abracadjabra.dashboard import fan_out
+from abracadjabra.management.commands import normalise_buckets
+from abracadjabra.middleware import AnonymousIdMiddleware
 import abracadjabra.settings as exptsett
 from utils.dt import recent_week, recent_month
-from utils.tests import BaseTests
-from utils.utils import percent
+import utils.models
+import utils.utils
+from utils.models import as_objects
+from utils.tests import BaseTests, as_ids
+from utils.utils import percent, cmcd, generate_mckey, request_memo, \
+    run_in_background, wait_for_background, RequestMemoMiddleware
   
 
 ##############################################################################
@@ -26,6 +59,11 @@ class ExperimentTests(BaseTests):
             users.append(user)
         return users
 
+    def create_exptuser(self, user, expt, bucket):
+        bucket, created = Bucket.objects.get_or_create(experiment=expt, name=bucket)
+        return ExperimentUser.objects.create(user=user, experiment=expt, bucket=bucket,
+                                             date_joined=user.date_joined)
+
             
     def test_experiment_setup(self):
         self.assertEqual(Experiment.objects.filter(name='E1').count(), 0)
@@ -43,9 +81,9 @@ class ExperimentTests(BaseTests):
         self.assertEqual(Experiment.objects.filter(name='E1').count(), 1)
         self.assertEqual(ExperimentUser.objects.count(), nUsers)
         
-        buckets = {'B1a': ExperimentUser.objects.filter(bucket='B1a').count(),
-                   'B1b': ExperimentUser.objects.filter(bucket='B1b').count(),
-                   'B1c': ExperimentUser.objects.filter(bucket='B1c').count(),}
+        buckets = {'B1a': ExperimentUser.objects.filter(bucket__name='B1a').count(),
+                   'B1b': ExperimentUser.objects.filter(bucket__name='B1b').count(),
+                   'B1c': ExperimentUser.objects.filter(bucket__name='B1c').count(),}
         # confirm that new users are getting assigned to buckets randomly
         tol = 100 # each bucket should have within TOL users of the others. ARBITRARY
         self.assertTrue(max(buckets.values()) - min(buckets.values()) <= tol)
@@ -56,22 +94,80 @@ class ExperimentTests(BaseTests):
         self.assertEqual(Experiment.setup(user, 'E1', ['B1a', 'B1b', 'B1c']), None)
         
 
+    def test_anonymous(self):
+        cache.clear()
+        mw = AnonymousIdMiddleware()
+        factory = RequestFactory()
+        anon = AnonymousUser()
+        names = ['a', 'b', 'c']
+        request = factory.get('/')
+        mw.process_request(request)
+        bucket = Experiment.setup(anon, 'E1', names, request=request)
+        expt = Experiment.objects.get(name='E1')
+        self.assertEqual(bucket, hash_bucket(expt.salt, request.anon_id, [('a', 1), ('b', 1), ('c', 1)]))
+        # once the Experiment and Buckets exist, other visitors cost nothing
+        for i in range(5):
+            other = factory.get('/')
+            mw.process_request(other)
+            with self.assertNumQueries(0):
+                Experiment.setup(anon, 'E1', names, request=other)
+        self.assertEqual(ExperimentUser.objects.count(), 0)
+
+        # the cookies bring the same visitor back to the same bucket,
+        # even if the weights have changed since
+        response = mw.process_response(request, HttpResponse())
+        request = factory.get('/')
+        request.COOKIES = dict((k, v.value) for k, v in response.cookies.items())
+        mw.process_request(request)
+        self.assertEqual(request.anon_buckets, {expt.id: (Bucket.objects.get(name=bucket).id, bucket)})
+        Bucket.objects.filter(name=bucket).update(weight=0)
+        cache.clear()
+        self.assertEqual(Experiment.setup(anon, 'E1', names, request=request), bucket)
+
+        # and they keep it when they log in
+        user = self.create_user('good_user1')
+        user_logged_in.send(sender=User, request=request, user=user)
+        self.assertEqual(ExperimentUser.objects.get(user=user).bucket.name, bucket)
+        self.assertEqual(Experiment.setup(user, 'E1', names, request=request), bucket)
+        response = mw.process_response(request, HttpResponse())
+        self.assertEqual(response.cookies[settings.ANON_BUCKETS_COOKIE_NAME].value, '')
+
+        # another request getting them into one of the
+        # Experiments first doesn't stop the rest
+        expt2 = Experiment.objects.create(name='E2')
+        bucket2 = Bucket.objects.create(experiment=expt2, name='x')
+        user2 = self.create_user('good_user2')
+        anon_buckets = {expt.id: (Bucket.objects.get(name=bucket).id, bucket),
+                        expt2.id: (bucket2.id, 'x'),}
+
+        def racing_bulk_create(objs, *args, **kwargs):
+            self.create_exptuser(user2, expt2, 'x')
+            return bulk_create(objs, *args, **kwargs)
+        bulk_create = ExperimentUser.objects.bulk_create
+        ExperimentUser.objects.bulk_create = racing_bulk_create
+        try:
+            self.assertEqual(ExperimentUser.merge_anonymous(user2, anon_buckets), 1)
+        finally:
+            del ExperimentUser.objects.bulk_create
+        self.assertEqual(sorted(ExperimentUser.objects.filter(user=user2).values_list('experiment', flat=True)),
+                         sorted([expt.id, expt2.id]))
+
     def test_bucket_names(self):
         expt = Experiment.objects.create(name='E1')
         users = list(self.populate_users())
         self.assertEqual(expt.bucket_names(), [])
-        eu = ExperimentUser.objects.create(user=users.pop(), experiment=expt, bucket='bucket1')
+        eu = self.create_exptuser(users.pop(), expt, 'bucket1')
         self.assertEqual(expt.bucket_names(), ['bucket1'])
-        eu = ExperimentUser.objects.create(user=users.pop(), experiment=expt, bucket='bucket2')
+        eu = self.create_exptuser(users.pop(), expt, 'bucket2')
         self.assertEqual(expt.bucket_names(), ['bucket1', 'bucket2'])
-        eu = ExperimentUser.objects.create(user=users.pop(), experiment=expt, bucket='bucket1')
+        eu = self.create_exptuser(users.pop(), expt, 'bucket1')
         self.assertEqual(expt.bucket_names(), ['bucket1', 'bucket2'])
-        eu = ExperimentUser.objects.create(user=users.pop(), experiment=expt, bucket='bucket3')
+        eu = self.create_exptuser(users.pop(), expt, 'bucket3')
         self.assertEqual(expt.bucket_names(), ['bucket1', 'bucket2', 'bucket3'])
-        eu = ExperimentUser.objects.create(user=users.pop(), experiment=expt, bucket='bucket2')
+        eu = self.create_exptuser(users.pop(), expt, 'bucket2')
         self.assertEqual(expt.bucket_names(), ['bucket1', 'bucket2', 'bucket3'])
 
-        eu = ExperimentUser.objects.create(user=users.pop(), experiment=expt, bucket='All')
+        eu = self.create_exptuser(users.pop(), expt, 'All')
         with self.assertRaises(AssertionError):
             expt.bucket_names()
         
@@ -85,25 +181,429 @@ class ExperimentTests(BaseTests):
         bad_user1 = self.create_user('_bad_user1') # anon
         bad_user2 = self.create_user('bad_user2')
         extra_user = self.create_user('extra_user') # not part of Experiment
-        eu = ExperimentUser.objects.create(user=good_user1, experiment=expt, bucket='good')
-        eu = ExperimentUser.objects.create(user=good_user2, experiment=expt, bucket='good')
-        eu = ExperimentUser.objects.create(user=good_user3, experiment=expt, bucket='good')
-        eu = ExperimentUser.objects.create(user=bad_user1, experiment=expt, bucket='bad')
-        eu = ExperimentUser.objects.create(user=bad_user2, experiment=expt, bucket='bad')
+        eu = self.create_exptuser(good_user1, expt, 'good')
+        eu = self.create_exptuser(good_user2, expt, 'good')
+        eu = self.create_exptuser(good_user3, expt, 'good')
+        eu = self.create_exptuser(bad_user1, expt, 'bad')
+        eu = self.create_exptuser(bad_user2, expt, 'bad')
         good_bucket = expt.compute_bucket('good')
         self.assertEqual(good_bucket['nUsers'], 3)
         bad_bucket = expt.compute_bucket('bad')
         self.assertEqual(bad_bucket['nUsers'], 2)
+        all_bucket = expt.compute_bucket('All')
+        self.assertEqual(all_bucket['nUsers'], 5)
+        self.assertEqual(expt.compute_bucket('All', users=User.objects.filter(
+                    username__contains='good'))['nUsers'], 3)
 
         # now, if we pretend these users joined ages ago and
         # filter by DT_JOINED, none of them should count
-        good_users = expt.users_in_bucket('good')
-        for user in good_users:
-            user.date_joined -= datetime.timedelta(days=365)
-            user.save()
+        ExperimentUser.objects.filter(experiment=expt, bucket__name='good') \
+            .update(date_joined=timezone.now() - datetime.timedelta(days=365))
         good_bucket = expt.compute_bucket('good', dt_joined=recent_week())
         self.assertEqual(good_bucket['nUsers'], 0)
+        all_bucket = expt.compute_bucket('All', dt_joined=recent_week())
+        self.assertEqual(all_bucket['nUsers'], 2)
+
+    def test_snapshots(self):
+        expt = Experiment.objects.create(name='E1')
+        users = self.populate_users()
+        for user in users[:3]:
+            self.create_exptuser(user, expt, 'b1')
+        for user in users[3:5]:
+            self.create_exptuser(user, expt, 'b2')
+        snapshot_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(SNAPSHOT_DIR=snapshot_dir):
+                # no snapshot yet, so it falls back to the db
+                buckets, dt_joined = expt.compute_buckets(incl_all=True, use_snapshot=True)
+                self.assertEqual([bucket['nUsers'] for bucket in buckets], [3, 2, 5])
+                if snapshots.np is None:
+                    self.skipTest('needs numpy')
+
+                self.assertEqual(snapshots.refresh_snapshot(expt), 5)
+                buckets, dt_joined = expt.compute_buckets(incl_all=True, use_snapshot=True)
+                self.assertEqual([bucket['nUsers'] for bucket in buckets], [3, 2, 5])
+                self.assertEqual(buckets[0]['users_str'], '')
+
+                # only the new rows get added
+                late = self.create_exptuser(users[5], expt, 'b2')
+                self.create_exptuser(users[6], expt, 'b2')
+                # as if LATE's transaction hadn't committed yet
+                late.delete()
+                self.assertEqual(snapshots.refresh_snapshot(expt), 1)
+                late.save()
+                self.assertEqual(snapshots.refresh_snapshot(expt), 1)
+                self.assertEqual(snapshots.refresh_snapshot(expt), 0)
+                self.assertEqual(snapshots.count_buckets(expt.id), {
+                        Bucket.objects.get(name='b1').id: 3,
+                        Bucket.objects.get(name='b2').id: 4})
+                # appended to, and nothing else
+                path = snapshots.column_path(snapshots.snapshot_dir(expt.id), 'id')
+                self.assertEqual(os.path.getsize(path), 7 * 8)
+
+                # changing old rows needs a full refresh
+                ExperimentUser.objects.filter(bucket__name='b1') \
+                    .update(date_joined=timezone.now() - datetime.timedelta(days=365))
+                call_command('refresh_snapshots', full=True, stdout=StringIO())
+                buckets, dt_joined = expt.compute_buckets(dt_joined=recent_week(), incl_all=True,
+                                                          use_snapshot=True)
+                self.assertEqual([bucket['nUsers'] for bucket in buckets], [0, 4, 4])
+        finally:
+            shutil.rmtree(snapshot_dir)
+
+    def test_bitmaps(self):
+        bitmap = Bitmap.from_ids([3, 1, 700, 8])
+        self.assertEqual(list(bitmap), [1, 3, 8, 700])
+        self.assertEqual(len(bitmap), 4)
+        self.assertTrue(700 in bitmap)
+        self.assertFalse(7 in bitmap)
+        other = Bitmap.from_ids([8, 9])
+        self.assertEqual(list(bitmap & other), [8])
+        self.assertEqual(list(bitmap | other), [1, 3, 8, 9, 700])
+        self.assertEqual(list(bitmap - other), [1, 3, 700])
+        self.assertFalse(Bitmap.from_ids([]))
+        self.assertEqual(len(Bitmap.from_ids([])), 0)
+        # counted across several chunks
+        ids = range(0, 2000000, 7)
+        big = Bitmap.from_ids(ids)
+        self.assertEqual(len(big), len(ids))
+        # and only once
+        self.assertEqual(big._len, len(ids))
+        self.assertEqual(len(big & big), len(ids))
+        self.assertEqual(pickle.loads(pickle.dumps(bitmap)), bitmap)
+
+        users = self.populate_users()
+        expt1 = Experiment.objects.create(name='E1')
+        expt2 = Experiment.objects.create(name='E2')
+        for idx, user in enumerate(users):
+            self.create_exptuser(user, expt1, 'a' if idx % 2 else 'b')
+            if idx < 6:
+                self.create_exptuser(user, expt2, 'x' if idx % 2 else 'y')
+        versions = Experiment.get_cache_versions([expt1.id, expt2.id])
+        bitmaps1 = Experiment.get_cache_bucket_bitmaps(expt1.id, versions[expt1.id])
+        self.assertEqual(sorted(bitmaps1['a']), sorted(u.id for u in users[1::2]))
+        # cached
+        with self.assertNumQueries(0):
+            self.assertEqual(Experiment.get_cache_bucket_bitmaps(expt1.id, versions[expt1.id]), bitmaps1)
+        bitmaps2 = Experiment.get_cache_bucket_bitmaps(expt2.id, versions[expt2.id])
+        matrix = overlap_matrix([(expt1, bitmaps1), (expt2, bitmaps2)])
+        self.assertEqual([(expt, nUsers, overlaps) for expt, nUsers, overlaps in matrix],
+                         [(expt1, 10, [10, 6]), (expt2, 6, [6, 6])])
+        # E2 follows E1's buckets exactly, so they interact
+        self.assertEqual(crosstab(bitmaps1, bitmaps2), [('a', 'x', 3, 1.5), ('a', 'y', 0, 1.5),
+                                                        ('b', 'x', 0, 1.5), ('b', 'y', 3, 1.5)])
 
+        request = RequestFactory().get(reverse('experiment_overlap'))
+        request.user = User.objects.create(username='staff', is_staff=True)
+        response = views.overlap_vw(request)
+        self.assertContains(response, '60%')
+        response = views.overlap_detail_vw(request, expt1.id, expt2.id)
+        self.assertContains(response, '1.5')
+
+    def test_timeseries(self):
+        now = timezone.now()
+        expt = Experiment.objects.create(name='E1')
+        Experiment.objects.filter(id=expt.id).update(cre=now - datetime.timedelta(days=20))
+        expt = Experiment.objects.get(id=expt.id)
+        users = self.populate_users()
+        for user, bucket, days_ago in [(users[0], 'b1', 10), (users[1], 'b1', 10),
+                                       (users[2], 'b2', 3), (users[3], 'b2', 0)]:
+            eu = self.create_exptuser(user, expt, bucket)
+            ExperimentUser.objects.filter(id=eu.id).update(cre=now - datetime.timedelta(days=days_ago))
+
+        with self.assertNumQueries(2):
+            dates, buckets = expt.timeseries(since=recent_month)
+        self.assertEqual(len(dates), 21)
+        self.assertEqual(dates[-1], now.astimezone(timezone.utc).date())
+        self.assertEqual([bucket['name'] for bucket in buckets], ['b1', 'b2'])
+        b1, b2 = [bucket['counts'] for bucket in buckets]
+        self.assertEqual(b1[10], 2)
+        self.assertEqual(b2[17] + b2[20], 2)
+        self.assertEqual(sum(b1 + b2), 4)
+
+        dates, buckets = expt.timeseries(since=recent_month, period='week')
+        self.assertTrue(all(dt.weekday() == 0 for dt in dates))
+        self.assertEqual([sum(bucket['counts']) for bucket in buckets], [2, 2])
+
+        request = RequestFactory().get('/', {'period': 'week', 'since': 'recent_month'})
+        request.user = User.objects.create(username='staff', is_staff=True)
+        d = json.loads(views.experiment_timeseries_vw(request, expt.id).content)
+        self.assertEqual(d['period'], 'week')
+        self.assertEqual(d['dates'], [dt.isoformat() for dt in dates])
+        for params in ({'period': 'year'}, {'since': 'yesterday'}):
+            request = RequestFactory().get('/', params)
+            request.user = User.objects.get(username='staff')
+            self.assertEqual(views.experiment_timeseries_vw(request, expt.id).status_code, 400)
+
+    def test_export(self):
+        expt = Experiment.objects.create(name='E1')
+        users = self.populate_users()
+        for user, bucket in [(users[0], 'b1'), (users[1], u'b\xe9'), (users[2], 'b1')]:
+            self.create_exptuser(user, expt, bucket)
+        Conversion.record(users[0], 'purchase')
+
+        # the bucket names, then a chunk at a time
+        rows = exports.assignment_rows(expt, chunk_size=2)
+        with self.assertNumQueries(2):
+            first = rows.next()
+        self.assertEqual(first[:3], (ExperimentUser.objects.get(user=users[0]).id, users[0].id, 'b1'))
+        # it's only in reporting() while it's fetching
+        self.assertFalse(routers.in_reporting())
+        # and picks up a Bucket added since it started
+        self.create_exptuser(users[3], expt, 'b3')
+        self.assertEqual([row[2] for row in rows], [u'b\xe9', 'b1', 'b3'])
+
+        lines = list(exports.export('assignments', expt, 'csv'))
+        self.assertEqual(lines[0], 'id,user_id,bucket,cre,date_joined\r\n')
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(u'b\xe9'.encode('utf-8') in lines[2])
+        d = json.loads(list(exports.export('assignments', expt, 'ndjson'))[1])
+        self.assertEqual((d['user_id'], d['bucket']), (users[1].id, u'b\xe9'))
+
+        buckets = [json.loads(line) for line in exports.export('buckets', expt, 'ndjson')]
+        b1 = [bucket for bucket in buckets if bucket['bucket'] == 'b1']
+        self.assertEqual([(b['conversion'], b['nUsers'], b['nConverted']) for b in b1],
+                         [('purchase', 2, 1)])
+        self.assertEqual(sorted(set(b['bucket'] for b in buckets)), ['All', 'b1', 'b3', u'b\xe9'])
+        self.assertRaises(ValueError, exports.export, 'users', expt, 'csv')
+
+        request = RequestFactory().get('/')
+        request.user = User.objects.create(username='staff', is_staff=True)
+        resp = views.experiment_export_vw(request, expt.id, 'assignments', 'csv')
+        self.assertEqual(resp['Content-Type'], 'text/csv')
+        self.assertEqual(''.join(resp.streaming_content), ''.join(lines))
+        request = RequestFactory().get('/', {'dt_joined': 'forever'})
+        request.user = User.objects.get(username='staff')
+        self.assertEqual(views.experiment_export_vw(request, expt.id, 'buckets', 'csv').status_code, 400)
+
+    def test_dashboard(self):
+        def sleep(secs):
+            if secs < 0:
+                raise ValueError(secs)
+            time.sleep(secs)
+            return secs
+
+        # failures get logged
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        dashboard.logger.addHandler(handler)
+        try:
+            results = list(fan_out(sleep, [0.3, 0, -1], threads=3, timeout=5))
+            # in the order they finished
+            self.assertEqual([(item, result) for item, result, exception in results],
+                             [(0, 0), (-1, None), (0.3, 0.3)])
+            self.assertTrue(isinstance(results[1][2], ValueError))
+            results = list(fan_out(sleep, [0, 2], threads=2, timeout=0.5))
+            self.assertEqual(results[0], (0, 0, None))
+            self.assertEqual(results[1][:2], (2, None))
+            self.assertTrue(isinstance(results[1][2], TimeoutError))
+            self.assertEqual(list(fan_out(sleep, [0, -1], threads=0))[0], (0, 0, None))
+        finally:
+            dashboard.logger.removeHandler(handler)
+        self.assertEqual([record.exc_info[0] for record in records], [ValueError, ValueError])
+
+        cache.clear()
+        expt = Experiment.objects.create(name='E1')
+        for user in self.populate_users():
+            self.create_exptuser(user, expt, 'b1')
+        request = RequestFactory().get('/')
+        request.user = User.objects.create(username='staff', is_staff=True)
+        # the threads wouldn't see the test db
+        with self.settings(DASHBOARD_THREADS=0):
+            response = views.dashboard_vw(request)
+            self.assertTrue(response.streaming)
+            content = ''.join(response.streaming_content)
+            self.assertTrue('E1' in content)
+            self.assertTrue('b1: 10' in content)
+            # the rows are cached, stale or not
+            with self.assertNumQueries(1):
+                ''.join(views.dashboard_vw(request).streaming_content)
+
+    def test_conversions(self):
+        expt = Experiment.objects.create(name='E1')
+        users = [User.objects.create(username='user%i' % i) for i in range(5)]
+        for user in users[:3]:
+            self.create_exptuser(user, expt, 'a')
+        for user in users[3:]:
+            self.create_exptuser(user, expt, 'b')
+        before = timezone.now() - datetime.timedelta(days=1)
+        self.assertEqual(Conversion.record_many(
+                [{'user': users[0], 'name': 'purchase', 'value': 10},
+                 {'user': users[0], 'name': 'purchase', 'value': 5},
+                 {'user': users[1], 'name': 'signup'},
+                 {'user': users[3], 'name': 'purchase', 'value': 2},
+                 # from before they were assigned, so doesn't count
+                 {'user': users[4], 'name': 'purchase', 'value': 100, 'cre': before},]), 5)
+
+        # one query for all the buckets' conversions, however many kinds there are
+        with self.assertNumQueries(1):
+            self.assertEqual(expt.compute_conversions(),
+                             {'a': {'purchase': (1, 15), 'signup': (1, 1)}, 'b': {'purchase': (1, 2)}})
+
+        buckets, dt_joined = expt.compute_buckets(incl_all=True)
+        a, b, all_ = buckets
+        self.assertEqual([c['name'] for c in a['conversions']], ['purchase', 'signup'])
+        self.assertEqual(b['conversions'][0]['pct'], 50)
+        self.assertEqual(a['conversions'][0]['per_user'], 5)
+        self.assertTrue(a['conversions'][0]['per_user_max'])
+        self.assertEqual(b['conversions'][1]['nConverted'], 0)
+        self.assertEqual(all_['conversions'][0]['total'], 17)
+
+    def test_sampled_report(self):
+        cache.clear()
+        expt = Experiment.objects.create(name='E1')
+        users = [User.objects.create(username='user%i' % i) for i in range(40)]
+        for idx, user in enumerate(users):
+            self.create_exptuser(user, expt, 'a' if idx % 2 else 'b')
+        Conversion.record_many([{'user': user, 'name': 'purchase'} for user in users[:20]])
+        # the same users as SAMPLE_SQL picks
+        sampled = [user for user in users
+                   if (user.id * SAMPLE_HASH_MULTIPLIER) % SAMPLE_HASH_MODULUS < SAMPLE_HASH_MODULUS / 2]
+        nConverted = len([user for user in sampled if user in users[:20]])
+
+        bucket = expt.compute_bucket('All', sample=0.5)
+        self.assertEqual(bucket['nUsersSampled'], len(sampled))
+        self.assertEqual(bucket['nUsers'], 2 * len(sampled))
+        self.assertTrue(bucket['nUsers_low'] < bucket['nUsers'] < bucket['nUsers_high'])
+        buckets, dt_joined = expt.compute_buckets(incl_all=True, sample=0.5)
+        purchase = buckets[-1]['conversions'][0]
+        self.assertEqual(purchase['nConverted'], 2 * nConverted)
+        self.assertEqual(purchase['pct'], percent(nConverted, len(sampled)))
+        self.assertTrue(purchase['pct_low'] <= purchase['pct'] <= purchase['pct_high'])
+        # exact
+        buckets, dt_joined = expt.compute_buckets(incl_all=True)
+        self.assertEqual(buckets[-1]['nUsers_low'], 40)
+        self.assertEqual(buckets[-1]['conversions'][0]['pct_high'], 50)
+
+        # small, so it's exact straight away
+        buckets, dt_joined = expt.get_cache_report()
+        self.assertEqual(buckets[0]['sample'], 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(expt.get_cache_report()[0], buckets)
+
+        cache.clear()
+        with self.settings(APPROX_REPORT_MIN_USERS=0):
+            buckets, dt_joined = expt.get_cache_report()
+            self.assertEqual(buckets[0]['sample'], Experiment.REPORT_SAMPLES[0])
+            # the background thread can't see the test db, so
+            # do its job here
+            wait_for_background()
+            version, dt_joined, report, report_version, samples = expt.cached_report()
+            self.assertEqual(samples, Experiment.REPORT_SAMPLES[1:])
+            expt.refine_report(version, dt_joined, False, False, samples)
+            buckets, dt_joined = expt.get_cache_report()
+            self.assertEqual(buckets[0]['sample'], 1)
+            self.assertEqual(sum(bucket['nUsers'] for bucket in buckets), 40)
+
+    def test_versions(self):
+        cache.clear()
+        models._assigned_periods.clear()
+        # rather than waiting for VERSION_ASSIGNMENT_SECONDS to pass
+        period = [1000]
+        old_assignment_period = Experiment.__dict__['assignment_period']
+        Experiment.assignment_period = staticmethod(lambda t=None: period[0])
+        try:
+            expt = Experiment.objects.create(name='E1')
+            users = self.populate_users()
+            # a new bucket is a change in itself
+            Bucket.objects.create(experiment=expt, name='b')
+            self.create_exptuser(users[0], expt, 'a')
+            version = Experiment.get_cache_version(expt.id)
+            self.assertEqual(Experiment.get_cache_version(expt.id), version)
+            buckets, dt_joined = expt.get_cache_report()
+            with self.assertNumQueries(0):
+                expt.get_cache_report()
+
+            def bumped():
+                new_version = Experiment.get_cache_version(expt.id)
+                self.assertNotEqual(new_version, version)
+                return new_version
+
+            def nUsers(buckets):
+                return sum(bucket['nUsers'] for bucket in buckets)
+
+            # more assignments in the same period don't touch the cache
+            self.create_exptuser(users[1], expt, 'b')
+            self.assertEqual(Experiment.get_cache_version(expt.id), version)
+            # but once it's over, the report gets recomputed
+            period[0] += 1
+            version = bumped()
+            # and until then, the old one's still served
+            with self.assertNumQueries(0):
+                buckets, dt_joined = expt.get_cache_report()
+            self.assertEqual(nUsers(buckets), 1)
+            # the background thread can't see the test db
+            wait_for_background()
+            version, dt_joined, report, report_version, samples = expt.cached_report()
+            self.assertEqual(samples, [1])
+            expt.refine_report(version, dt_joined, False, False, samples)
+            buckets, dt_joined = expt.get_cache_report()
+            self.assertEqual(nUsers(buckets), 2)
+            # the first assignment in a period is noted straight
+            # away, and a merge is assignments too
+            ExperimentUser.merge_anonymous(users[2], {expt.id: (Bucket.objects.get(name='a').id, 'a')})
+            version = bumped()
+            self.create_exptuser(users[3], expt, 'b')
+            self.assertEqual(Experiment.get_cache_version(expt.id), version)
+            period[0] += 1
+            version = bumped()
+            # conversions invalidate it straight away, one at a
+            # time or in bulk
+            Conversion.record(users[0], 'purchase')
+            version = bumped()
+            Conversion.record_many([{'user': users[1], 'name': 'purchase'}])
+            version = bumped()
+            # but not for Users who aren't in it
+            Conversion.record(users[5], 'purchase')
+            self.assertEqual(Experiment.get_cache_version(expt.id), version)
+            expt.save()
+            version = bumped()
+            # e.g. if it got evicted, it starts again past the old ones
+            cache.delete(Experiment.version_mckey(expt.id))
+            version = bumped()
+        finally:
+            Experiment.assignment_period = old_assignment_period
+
+    def test_conditional_get(self):
+        cache.clear()
+        models._assigned_periods.clear()
+        expt = Experiment.objects.create(name='E1')
+        users = self.populate_users()
+        self.create_exptuser(users[0], expt, 'a')
+        staff = User.objects.create(username='staff', is_staff=True)
+
+        def staff_request(**headers):
+            request = RequestFactory().get('/', **headers)
+            request.user = staff
+            return request
+
+        def validators():
+            return views.experiment_detail_validators(staff_request(), expt.id)
+
+        # nothing computed yet
+        etag, last_modified = validators()
+        self.assertEqual(last_modified, None)
+        expt.get_cache_report(use_snapshot=bool(settings.SNAPSHOT_DIR))
+        etag, last_modified = validators()
+        self.assertTrue(last_modified >= expt.mod)
+        # a 304, without computing the report
+        with self.assertNumQueries(1):
+            resp = views.experiment_detail_vw(staff_request(HTTP_IF_NONE_MATCH='"%s"' % etag), expt.id)
+        self.assertEqual(resp.status_code, 304)
+        # until something changes, and then the stale report
+        # being served has no Last-Modified
+        Conversion.record(users[0], 'purchase')
+        new_etag, last_modified = validators()
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(last_modified, None)
+        self.assertEqual(views.experiment_detail_validators(RequestFactory().get('/'), 0), (None, None))
+
+        etag, last_modified = views.experiments_validators(staff_request())
+        resp = views.experiments_vw(staff_request(HTTP_IF_NONE_MATCH='"%s"' % etag))
+        self.assertEqual(resp.status_code, 304)
+        Experiment.objects.create(name='E2')
+        self.assertNotEqual(views.experiments_validators(staff_request())[0], etag)
 
     def test_calc_maxes(self):
         """
@@ -177,4 +677,515 @@ class ExperimentTests(BaseTests):
         self.assertEqual(eu11, ExperimentUser.get_cache_create(expt=e1a, user=user1, buckets=buckets2))
         # self.assertEqual(eu23.)
 
+    def test_warm_cache(self):
+        users = self.populate_users()
+        e1 = Experiment.objects.create(name='E1')
+        e2 = Experiment.objects.create(name='E2', status=Experiment.INACTIVE_STATUS)
+        old_eu = self.create_exptuser(users[5], e1, 'b1')
+        ExperimentUser.objects.filter(id=old_eu.id).update(
+            cre=datetime.datetime(2010, 1, 1, tzinfo=timezone.utc))
+        # only these 5 recent ones should get cached
+        for user in users[:5]:
+            self.create_exptuser(user, e1, 'b1')
+        self.create_exptuser(users[0], e2, 'b2')
+        cache.clear()
+
+        self.assertEqual(Experiment.warm_cache(exptusers_since=recent_week(), chunk_size=2), (1, 5))
+        with self.assertNumQueries(0):
+            self.assertEqual(Experiment.get_cache_create('E1'), e1)
+            eu = ExperimentUser.get_cache_create(e1, users[0], ['b1', 'b2'])
+            self.assertEqual(eu.bucket.name, 'b1')
+        # inactive Experiments don't get warmed
+        with self.assertNumQueries(1):
+            Experiment.get_cache_create('E2')
+
+    def test_cache_tuples(self):
+        user = self.create_user('good_user1')
+        expt = Experiment.get_cache_create('E1')
+        eu = ExperimentUser.get_cache_create(expt, user, ['b1'])
+        self.assertEqual(cache.get(Experiment.mckey('E1')), expt.as_cache_tuple())
+        self.assertEqual(cache.get(ExperimentUser.mckey(expt.id, user.id)),
+                         (EXPERIMENTUSER_CACHE_VERSION, eu.id, 'b1', eu.bucket.id))
+        self.assertEqual(Experiment.setup(user, 'E1', ['b2']), 'b1')
+
+        # whole Model instances (the old format) get ignored
+        cache.set(Experiment.mckey('E1'), Experiment.objects.get(name='E1'))
+        with self.assertNumQueries(1):
+            self.assertEqual(Experiment.get_cache_create_tuple('E1'), expt.as_cache_tuple())
+
+
+    def test_hash_bucket(self):
+        buckets = [('a', 1), ('b', 0), ('c', 3)]
+        picked = [hash_bucket('s4lt', user_id, buckets) for user_id in range(2000)]
+        self.assertEqual(picked, [hash_bucket('s4lt', user_id, buckets) for user_id in range(2000)])
+        self.assertEqual(picked.count('b'), 0)
+        self.assertTrue(1300 < picked.count('c') < 1700)
+        # changing the salt reshuffles
+        self.assertNotEqual(picked, [hash_bucket('s4lt2', user_id, buckets) for user_id in range(2000)])
+
+        user = self.create_user('good_user1')
+        expt = Experiment.objects.create(name='E1')
+        Bucket.objects.create(experiment=expt, name='b1', weight=0)
+        self.assertEqual(Experiment.setup(user, 'E1', ['b1', 'b2']), 'b2')
+        self.assertEqual(Bucket.objects.get(name='b2').weight, 1)
+
+    @override_settings(ASSIGN_SECRET='s3cret')
+    def test_config_vw(self):
+        cache.clear()
+        user = self.create_user('good_user1')
+        Experiment.setup(user, 'E1', ['control', 'test'])
+        Experiment.objects.create(name='E2', status=Experiment.INACTIVE_STATUS)
+        url = reverse('experiment_config')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        resp = self.client.get(url, HTTP_X_ABRACADJABRA_SECRET='s3cret')
+        self.assertEqual(resp.status_code, 200)
+        config = json.loads(resp.content)
+        expt = Experiment.objects.get(name='E1')
+        self.assertEqual(config['experiments'], [{'id': expt.id, 'name': 'E1', 'salt': expt.salt,
+                                                  'buckets': [['control', 1], ['test', 1]]}])
+        # clients can work out the same bucket themselves
+        self.assertEqual(hash_bucket(expt.salt, user.id, config['experiments'][0]['buckets']),
+                         Experiment.setup(user, 'E1', ['control', 'test']))
+
+        etag = resp['ETag']
+        with self.assertNumQueries(0):
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+        Bucket.objects.filter(name='test').update(weight=3)
+        Bucket.objects.get(name='control').save()
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag, HTTP_X_ABRACADJABRA_SECRET='s3cret')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertEqual(json.loads(resp.content)['experiments'][0]['buckets'], [['control', 1], ['test', 3]])
+
+        # in the same (code point) order as the server, whatever the db's collation
+        names = ['beta', 'Alpha', u'\xe9t\xe9', 'alpha']
+        Experiment.setup(user, 'E3', names)
+        expt = Experiment.objects.get(name='E3')
+        resp = self.client.get(url, HTTP_X_ABRACADJABRA_SECRET='s3cret')
+        buckets = json.loads(resp.content)['experiments'][1]['buckets']
+        self.assertEqual([name for name, weight in buckets], sorted(names))
+        self.assertEqual(hash_bucket(expt.salt, user.id, buckets), Experiment.setup(user, 'E3', names))
+
+    def test_exptuser_admin(self):
+        User.objects.create_superuser('admin', 'admin@admin.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        expt = Experiment.objects.create(name='E1')
+        eus = [self.create_exptuser(user, expt, 'b1') for user in self.populate_users()]
+        newest_first = [eu.id for eu in reversed(eus)]
+
+        model_admin = admin.site._registry[ExperimentUser]
+        # what admin.autodiscover() checks when DEBUG is on
+        for model, registered in admin.site._registry.items():
+            validate(registered.__class__, model)
+        model_admin.list_per_page = 4
+        try:
+            url = '/admin/abracadjabra/experimentuser/?experiment__id__exact=%i' % expt.id
+            cl = self.client.get(url).context['cl']
+            self.assertEqual(cl.result_count, 10)
+            self.assertEqual(as_ids(cl.result_list, sort=False), newest_first[:4])
+
+            # just the session, the user and the page itself - the
+            # counts are cached, and there are no queries per row
+            with self.assertNumQueries(3):
+                resp = self.client.get(url + '&before_id=%i' % cl.next_before_id)
+            cl = resp.context['cl']
+            self.assertEqual(as_ids(cl.result_list, sort=False), newest_first[4:8])
+            cl = self.client.get(url + '&before_id=%i' % cl.next_before_id).context['cl']
+            self.assertEqual(as_ids(cl.result_list, sort=False), newest_first[8:])
+            self.assertEqual(cl.next_before_id, None)
+        finally:
+            model_admin.list_per_page = ExperimentUserAdmin.list_per_page
+
+    def test_as_objects(self):
+        e1 = Experiment.objects.create(name='E1')
+        e2 = Experiment.objects.create(name='E2')
+        e3 = Experiment.objects.create(name='E3')
+        with self.assertNumQueries(1):
+            self.assertEqual(as_objects(Experiment, [e2.id, e1, e3.id, e2.id, e1.id]),
+                             [e2, e1, e3])
+        self.assertEqual(as_objects(Experiment, [e2.id, e1, e2.id], uniquify=False),
+                         [e2, e1, e2])
+        self.assertEqual(as_objects(Experiment, e3.id), [e3])
+        with self.assertRaises(Experiment.DoesNotExist):
+            as_objects(Experiment, [e1.id, e3.id + 1])
+
+    def test_queryset_manager(self):
+        e1 = Experiment.objects.create(name='E1')
+        e2 = Experiment.objects.create(name='E2', status=Experiment.INACTIVE_STATUS)
+        # QuerySet methods are exposed on the managers themselves
+        self.assertTrue('pickle_pks' in Experiment.objects.__dict__)
+        self.assertTrue('pickle_pks' in Experiment.active.__dict__)
+        self.assertEqual(Experiment.active.pickle_pks().count(), 1)
+        self.assertEqual(Experiment.objects.db_manager('default').pickle_pks.__self__.db, 'default')
+        # chaining doesn't leak into the cached base query
+        self.assertEqual(list(Experiment.active.filter(name='E2')), [])
+        self.assertEqual(list(Experiment.active.all()), [e1])
+        self.assertEqual(list(Experiment.inactive.all()), [e2])
+        # and on related managers too
+        user = User.objects.create(username='user1')
+        self.create_exptuser(user, e1, 'b1')
+        self.assertEqual(list(user.experiments.pickle_pks()), [e1])
+
+    def test_active_ids(self):
+        cache.clear()
+        e1 = Experiment.objects.create(name='E1')
+        e2 = Experiment.objects.create(name='E2', status=Experiment.INACTIVE_STATUS)
+        self.assertEqual(Experiment.active_ids(), frozenset([e1.id]))
+        with self.assertNumQueries(0):
+            self.assertEqual(Experiment.active_ids(), frozenset([e1.id]))
+        e2.status = Experiment.ACTIVE_STATUS
+        e2.save()
+        self.assertEqual(Experiment.active_ids(), frozenset([e1.id, e2.id]))
+        e1.delete()
+        self.assertEqual(Experiment.active_ids(), frozenset([e2.id]))
+
+    def test_pickle_pks(self):
+        expts = [Experiment.objects.create(name='E%i' % i) for i in range(5)]
+        qs = Experiment.objects.filter(name__startswith='E').order_by('-id')[:4]
+        full = pickle.dumps(qs, pickle.HIGHEST_PROTOCOL)
+        compact = pickle.dumps(qs.pickle_pks(), pickle.HIGHEST_PROTOCOL)
+        self.assertTrue(len(compact) < len(full))
+        self.assertFalse('E3' in compact)
+
+        expts[2].delete()
+        unpickled = pickle.loads(compact)
+        old_chunk_size = utils.models.PICKLE_PKS_CHUNK_SIZE
+        utils.models.PICKLE_PKS_CHUNK_SIZE = 2
+        try:
+            # agrees with iterating, i.e. without the deleted one
+            with self.assertNumQueries(2):
+                self.assertEqual(unpickled.count(), 3)
+            with self.assertNumQueries(2):
+                self.assertEqual(as_ids(unpickled, sort=False),
+                                 [expts[4].id, expts[3].id, expts[1].id])
+        finally:
+            utils.models.PICKLE_PKS_CHUNK_SIZE = old_chunk_size
+        # pickles the same way again, without going back to the db
+        with self.assertNumQueries(0):
+            self.assertEqual(len(pickle.loads(pickle.dumps(unpickled))._pks), 4)
+
+
+##############################################################################
+class CommandTests(TransactionTestCase):
+    """
+    These need a TransactionTestCase, since the commands
+    commit (and on SQLite, introspecting the schema commits).
+    """
+    def tearDown(self):
+        cache.clear()
+
+    def test_backfill_date_joined(self):
+        user1 = User.objects.create(username='user1', date_joined=recent_month())
+        user2 = User.objects.create(username='user2')
+        expt = Experiment.objects.create(name='E1')
+        self.assertEqual(Experiment.setup(user1, 'E1', ['b1']), 'b1')
+        self.assertEqual(ExperimentUser.objects.get(user=user1).date_joined, user1.date_joined)
+        eu2 = ExperimentUser.objects.create(user=user2, experiment=expt,
+                                            bucket=Bucket.objects.get(name='b1'))
+        self.assertEqual(eu2.date_joined, None)
+        call_command('backfill_date_joined', stdout=StringIO())
+        self.assertEqual(ExperimentUser.objects.get(id=eu2.id).date_joined, user2.date_joined)
+
+    def test_normalise_buckets(self):
+        user1 = User.objects.create(username='user1')
+        user2 = User.objects.create(username='user2')
+        expt = Experiment.objects.create(name='E1')
+        # the table as it was, with the bucket names inline
+        table = ExperimentUser._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute('DROP TABLE %s' % table)
+        cursor.execute('CREATE TABLE %s (id integer NOT NULL PRIMARY KEY, '
+                       'user_id integer NOT NULL, experiment_id integer NOT NULL, '
+                       'bucket varchar(100) NOT NULL, cre datetime NOT NULL, date_joined datetime NULL, '
+                       'UNIQUE (experiment_id, user_id))' % table)
+        cursor.execute('CREATE INDEX %s_experiment_id ON %s (experiment_id)' % (table, table))
+        cursor.execute('INSERT INTO %s (user_id, experiment_id, bucket, cre) VALUES (%%s, %%s, %%s, %%s)' % table,
+                       [user1.id, expt.id, 'b1', timezone.now()])
+        # anywhere but SQLite, it needs ALTER_NULL_SQL for the
+        # backend, and stops before changing anything without it
+        command = normalise_buckets.Command()
+        self.assertEqual(command.alter_null_sql('postgresql', 'eu', 'bucket', 'varchar(100)', True),
+                         'ALTER TABLE "eu" ALTER COLUMN "bucket" DROP NOT NULL')
+        self.assertEqual(command.alter_null_sql('mysql', 'eu', 'bucket_id', 'integer', False),
+                         'ALTER TABLE "eu" MODIFY "bucket_id" integer NOT NULL')
+        connections['default'].vendor = 'oracle'
+        try:
+            self.assertRaises(CommandError, call_command, 'normalise_buckets', stdout=StringIO())
+        finally:
+            del connections['default'].vendor
+        self.assertFalse('bucket_id' in utils.models.table_columns(table))
+        call_command('normalise_buckets', stdout=StringIO())
+        self.assertEqual(ExperimentUser.objects.get(user=user1).bucket.name, 'b1')
+        self.assertFalse('bucket' in utils.models.table_columns(table))
+        # new rows don't need the old column
+        self.assertEqual(Experiment.setup(user2, 'E1', ['b1']), 'b1')
+        self.assertEqual(ExperimentUser.objects.count(), 2)
+        # and it's safe to run again
+        call_command('normalise_buckets', stdout=StringIO())
+
+    def test_export_experiment(self):
+        user = User.objects.create(username='user1')
+        Experiment.objects.create(name='E1')
+        Experiment.setup(user, 'E1', ['b1'])
+        expt = Experiment.objects.get(name='E1')
+        out = StringIO()
+        call_command('export_experiment', str(expt.id), format='ndjson', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['user_id'], user.id)
+        out = StringIO()
+        call_command('export_experiment', str(expt.id), buckets=True, dt_joined='recent_month', stdout=out)
+        self.assertTrue(out.getvalue().startswith('bucket,nUsers,'))
+
+    def test_ingest_exposures(self):
+        log_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(EXPOSURE_LOG_DIR=log_dir):
+                user = User.objects.create(username='user1')
+                request = RequestFactory().get('/')
+                AnonymousIdMiddleware().process_request(request)
+                for i in range(3):
+                    bucket = Experiment.setup(user, 'E1', ['b1', 'b2'])
+                Experiment.setup(AnonymousUser(), 'E1', ['b1', 'b2'], request=request)
+                self.assertEqual(exposures.flush(), 4)
+                # not closed off yet
+                self.assertEqual(exposures.complete_segments(), [])
+                exposures.flush(rotate=True)
+                segments = exposures.complete_segments()
+                self.assertEqual(len(segments), 1)
+                with open(segments[0], 'a') as f:
+                    f.write('[1,2\n')
+
+                # the bad line gets skipped, and logged
+                records = []
+                handler = logging.Handler()
+                handler.emit = records.append
+                exposures.logger.addHandler(handler)
+                try:
+                    call_command('ingest_exposures', stdout=StringIO())
+                finally:
+                    exposures.logger.removeHandler(handler)
+                self.assertEqual([record.levelno for record in records], [logging.WARNING])
+                self.assertTrue('[1,2' in records[0].getMessage())
+                self.assertEqual(os.listdir(log_dir), [])
+                expt = Experiment.objects.get(name='E1')
+                self.assertEqual(expt.count_exposures(timezone.now())['All'], 4)
+                self.assertTrue(Exposure.objects.get(bucket__name=bucket).n >= 3)
+                # nothing left to load twice
+                call_command('ingest_exposures', stdout=StringIO())
+                buckets, dt_joined = expt.compute_buckets(incl_all=True)
+                self.assertEqual(sum(b['nExposures'] for b in buckets if b['name'] != 'All'), 4)
+                self.assertEqual(buckets[-1]['nExposures'], 4)
+        finally:
+            shutil.rmtree(log_dir)
+
+    def test_create_status_indexes(self):
+        table = Experiment._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = %s AND sql LIKE %s", [table, '%"status"%'])
+        names = [row[0] for row in cursor.fetchall()]
+        # the plain index from syncdb, and the partial ones from post_syncdb
+        self.assertEqual(len(names), 3)
+        for name in names:
+            cursor.execute('DROP INDEX %s' % name)
+
+        out = StringIO()
+        call_command('create_status_indexes', stdout=out)
+        self.assertEqual(out.getvalue().count('Created index'), 3)
+        out = StringIO()
+        call_command('create_status_indexes', stdout=out)
+        self.assertEqual(out.getvalue(), '')
+
+        sql, params = Experiment.active.values_list('id').query.sql_with_params()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        self.assertTrue('INDEX' in ' '.join(unicode(row[-1]) for row in cursor.fetchall()))
+
+
+##############################################################################
+@override_settings(ASSIGN_SECRET='s3cret')
+class AssignTests(BaseTests):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='user1')
+
+    def call(self, d, secret='s3cret', method='POST', length=None):
+        body = d if isinstance(d, str) else json.dumps(d)
+        environ = {'REQUEST_METHOD': method,
+                   'CONTENT_LENGTH': str(len(body)) if length is None else length,
+                   'wsgi.input': StringIO(body),
+                   'HTTP_X_ABRACADJABRA_SECRET': secret,}
+        started = []
+        body = ''.join(assign.application(environ, lambda status, headers: started.append((status, dict(headers)))))
+        status, headers = started[0]
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        return int(status.split()[0]), json.loads(body)
+
+    def test_setup_many(self):
+        expts_buckets = {'E1': ['a', 'b'], 'E2': ['c']}
+        self.assertEqual(Experiment.setup_many(self.user, expts_buckets)['E2'], 'c')
+        buckets = Experiment.setup_many(self.user.id, expts_buckets)
+        self.assertEqual(buckets['E1'], Experiment.setup(self.user, 'E1', ['a', 'b']))
+        with self.assertNumQueries(0):
+            self.assertEqual(Experiment.setup_many(self.user.id, expts_buckets), buckets)
+
+    def test_assign(self):
+        status, d = self.call({'user_id': self.user.id,
+                               'experiments': {'E1': ['a', 'b'], 'E2': ['c']}})
+        self.assertEqual(status, 200)
+        self.assertEqual(d['buckets']['E2'], 'c')
+        self.assertEqual(d['buckets']['E1'], ExperimentUser.objects.get(experiment__name='E1').bucket.name)
+        self.assertEqual(self.call({'user_id': self.user.id + 1, 'experiments': {'E1': ['a']}})[0], 404)
+
+    def test_bad_requests(self):
+        d = {'user_id': self.user.id, 'experiments': {'E1': ['a']}}
+        self.assertEqual(self.call(d, secret='wrong')[0], 403)
+        with self.settings(ASSIGN_SECRET=''):
+            self.assertEqual(self.call(d, secret='')[0], 403)
+        self.assertEqual(self.call(d, method='GET')[0], 405)
+        self.assertEqual(self.call('{not json')[0], 400)
+        self.assertEqual(self.call(d, length='lots')[0], 400)
+        self.assertEqual(self.call(d, length='-1')[0], 400)
+        self.assertEqual(self.call({'user_id': 'user1', 'experiments': {}})[0], 400)
+        self.assertEqual(self.call({'user_id': self.user.id, 'experiments': {'E1': []}})[0], 400)
+        # True is an int in Python, but it isn't user 1
+        self.assertEqual(self.call({'user_id': True, 'experiments': {'E1': ['a']}})[0], 400)
+        for experiments in ({'E1': [None]}, {'E1': [1]}, {'E1': ['']}, {'E1': ['a' * 101]},
+                            {'': ['a']}, {'E' * 101: ['a']}):
+            self.assertEqual(self.call({'user_id': self.user.id, 'experiments': experiments})[0], 400)
+        self.assertEqual(Bucket.objects.count(), 0)
+        self.assertEqual(ExperimentUser.objects.count(), 0)
+
+
+##############################################################################
+class ReportingRouterTests(BaseTests):
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+        routers._health.clear()
+        self.expt = Experiment.objects.create(name='E1')
+        Bucket.objects.create(experiment=self.expt, name='b1')
+        # make the replica's copy different, so we can tell
+        # which one got read
+        replica_expt = Experiment(id=self.expt.id, name='E1', cre=self.expt.cre, salt=self.expt.salt)
+        replica_expt.save(using='replica')
+        for name in ('b1', 'b2'):
+            Bucket.objects.using('replica').create(experiment=replica_expt, name=name)
+
+    def test_reports_read_replica(self):
+        self.assertEqual(self.expt.bucket_names(), ['b1'])
+        with self.settings(REPORTING_DATABASE='replica'):
+            self.assertEqual(self.expt.bucket_names(), ['b1', 'b2'])
+            with routers.reporting():
+                self.assertEqual(Bucket.objects.filter(experiment=self.expt).count(), 2)
+            # only inside reporting()
+            self.assertEqual(Bucket.objects.filter(experiment=self.expt).count(), 1)
+
+            # assigning never touches the replica
+            user = User.objects.create(username='user1')
+            self.assertEqual(Experiment.setup(user, 'E1', ['b1']), 'b1')
+            self.assertEqual(ExperimentUser.objects.count(), 1)
+            self.assertEqual(ExperimentUser.objects.using('replica').count(), 0)
+
+    def test_replica_unavailable(self):
+        replica = connections['replica']
+        def cursor():
+            raise Exception('replica is down')
+        replica.cursor = cursor
+        try:
+            with self.settings(REPORTING_DATABASE='replica', REPORTING_CHECK_SECONDS=0):
+                self.assertEqual(self.expt.bucket_names(), ['b1'])
+                del replica.cursor
+                # checked again, since REPORTING_CHECK_SECONDS has passed
+                self.assertEqual(self.expt.bucket_names(), ['b1', 'b2'])
+        finally:
+            replica.__dict__.pop('cursor', None)
+
+
+##############################################################################
+# counts how many times the cmcd-wrapped functions below actually run
+ncalls = {'nothing': 0, 'double': 0, 'report': 0,}
+
+@cmcd(arg_names=('x',), expiry=60)
+def cached_nothing(x):
+    ncalls['nothing'] += 1
+    return None
+
+@cmcd(arg_names=('x',), expiry=60, memo=True)
+def cached_double(x):
+    ncalls['double'] += 1
+    return 2 * x
+
+@cmcd(prefix='report', arg_names=('x',), expiry=60, soft_expiry=30)
+def cached_report(x):
+    ncalls['report'] += 1
+    return 'fresh %i' % x
+
+
+class CmcdTests(BaseTests):
+    def setUp(self):
+        ncalls['nothing'] = 0
+        ncalls['double'] = 0
+        ncalls['report'] = 0
+
+    def test_falsy_values_cached(self):
+        self.assertEqual(cached_nothing(x=1), None)
+        self.assertEqual(cached_nothing(x=1), None)
+        self.assertEqual(ncalls['nothing'], 1)
+        self.assertEqual(cached_double(x=0), 0)
+        self.assertEqual(cached_double(x=0), 0)
+        self.assertEqual(ncalls['double'], 1)
+
+    def test_many(self):
+        self.assertEqual(cached_double(x=2), 4)
+        self.assertEqual(cached_double.many([{'x': 1}, {'x': 2}, {'x': 3}, {'x': 1}]),
+                         [2, 4, 6, 2])
+        # x=2 was already in the cache, and x=1 only gets computed once
+        self.assertEqual(ncalls['double'], 3)
+        self.assertEqual(cached_double.many([{'x': 3}, {'x': 1}]), [6, 2])
+        self.assertEqual(ncalls['double'], 3)
+
+    def test_request_memo(self):
+        middleware = RequestMemoMiddleware()
+        middleware.process_request(None)
+        self.assertEqual(cached_double(x=5), 10)
+        # even once it's gone from the cache, we remember it
+        # for the rest of this request
+        cache.clear()
+        self.assertEqual(cached_double(x=5), 10)
+        self.assertEqual(ncalls['double'], 1)
+        middleware.process_response(None, None)
+        self.assertEqual(request_memo(), None)
+        self.assertEqual(cached_double(x=5), 10)
+        self.assertEqual(ncalls['double'], 2)
+
+    def test_stale_while_revalidate(self):
+        self.assertEqual(cached_report(x=1), 'fresh 1')
+        self.assertEqual(cached_report(x=1), 'fresh 1')
+        self.assertEqual(ncalls['report'], 1)
+        # pretend the soft expiry has passed - we should get
+        # the stale value straight back, while it refreshes
+        cache.set(generate_mckey('report', {'x': 1}), (0, 'stale 1'), 60)
+        self.assertEqual(cached_report(x=1), 'stale 1')
+        wait_for_background()
+        self.assertEqual(ncalls['report'], 2)
+        self.assertEqual(cached_report(x=1), 'fresh 1')
+        self.assertEqual(cached_report.many([{'x': 1}, {'x': 2}]), ['fresh 1', 'fresh 2'])
 
+    def test_background_failures_logged(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        utils.utils.log.addHandler(handler)
+        try:
+            result = run_in_background('fail', lambda: 1 / 0)
+            wait_for_background()
+        finally:
+            utils.utils.log.removeHandler(handler)
+        self.assertRaises(ZeroDivisionError, result.get)
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0].exc_info)
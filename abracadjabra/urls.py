@@ -10,6 +10,14 @@ admin.autodiscover()
 urlpatterns = patterns('abracadjabra.views',
     url(r'^$', 'experiments_vw', name='experiment_experiments'),
     url(r'^%s/$' % ure.experiment_id, 'experiment_detail_vw', name='experiment_detail'),
+    url(r'^%s/timeseries.json$' % ure.experiment_id, 'experiment_timeseries_vw', name='experiment_timeseries'),
+    url(r'^%s/(?P<what>assignments|buckets)\.(?P<fmt>csv|ndjson)$' % ure.experiment_id, 'experiment_export_vw',
+        name='experiment_export'),
+    url(r'^config.json$', 'config_vw', name='experiment_config'),
+    url(r'^dashboard/$', 'dashboard_vw', name='experiment_dashboard'),
+    url(r'^overlap/$', 'overlap_vw', name='experiment_overlap'),
+    url(r'^overlap/%s/(?P<other_experiment_id>%s)/$' % (ure.experiment_id, ure.id_re), 'overlap_detail_vw',
+        name='experiment_overlap_detail'),
     # url(r'^analysis/%s/$' % ure.analysis_slug, 'analysis_detail_vw', name='experiment_analysis_detail'),
 
     url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
@@ -0,0 +1,138 @@
+import hashlib
+
+from django.conf import settings as sett
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+
+"""
+Admin helpers for tables too big for the standard changelist,
+whose COUNT(*) and OFFSET paging get slower the bigger the
+table. e.g.
+
+    class ThingAdmin(HugeTableAdmin, admin.ModelAdmin):
+        list_select_related = ('owner',)
+        ...
+
+See abracadjabra.admin.ExperimentUserAdmin.
+"""
+
+# below this, estimates are too rough to be worth it, and COUNT(*) is cheap anyway
+MIN_ESTIMATED_COUNT = 10000
+
+# ?before_id=ID - see KeysetChangeList
+KEYSET_VAR = 'before_id'
+
+
+def estimated_count(model, using='default'):
+    """
+    Returns the database's own estimate of the number of
+    rows in MODEL's table (kept up to date by
+    ANALYZE/autovacuum), without scanning it. Returns None
+    if the backend doesn't keep one (e.g. SQLite).
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT table_rows FROM information_schema.tables ' \
+            'WHERE table_schema = DATABASE() AND table_name = %s'
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses ESTIMATED_COUNT for unfiltered querysets, and
+    otherwise caches the COUNT(*) for
+    settings.CACHE_EXPIRY['ADMIN_COUNT'] seconds.
+    """
+    def _get_count(self):
+        if self._count is None:
+            qs = self.object_list
+            if not qs.query.where:
+                estimate = estimated_count(qs.model, qs.db)
+                if estimate is not None and estimate >= MIN_ESTIMATED_COUNT:
+                    self._count = estimate
+                    return self._count
+            mckey = 'ADMIN_COUNT__' + hashlib.md5(str(qs.query)).hexdigest()
+            self._count = cache.get(mckey)
+            if self._count is None:
+                self._count = qs.count()
+                cache.set(mckey, self._count, sett.CACHE_EXPIRY['ADMIN_COUNT'])
+        return self._count
+    count = property(_get_count)
+
+
+class KeysetChangeList(ChangeList):
+    """
+    For changelists ordered by -id, pages with
+    ?before_id=ID (i.e. WHERE id < ID) rather than ?p=N
+    (i.e. OFFSET N * list_per_page), so that every page is
+    an index range scan, however deep you go.
+
+    Falls back to normal paging if you sort by a column.
+    """
+    def get_query_set(self, request):
+        # take BEFORE_ID out before it gets treated as a filter
+        self.before_id = self.params.pop(KEYSET_VAR, None)
+        self.keyset = ORDER_VAR not in self.params and \
+            list(self._get_default_ordering()) in (['-id'], ['-pk'])
+        return super(KeysetChangeList, self).get_query_set(request)
+
+    def get_results(self, request):
+        if not self.keyset:
+            return super(KeysetChangeList, self).get_results(request)
+
+        paginator = self.model_admin.get_paginator(request, self.query_set, self.list_per_page)
+        self.result_count = paginator.count
+        if not self.query_set.query.where:
+            self.full_result_count = self.result_count
+        else:
+            self.full_result_count = self.model_admin.get_paginator(
+                request, self.root_query_set, self.list_per_page).count
+
+        result_list = self.query_set
+        if self.before_id:
+            try:
+                result_list = result_list.filter(pk__lt=int(self.before_id))
+            except ValueError:
+                pass
+        self.result_list = result_list[:self.list_per_page]
+        rows = list(self.result_list)
+        self.next_before_id = rows[-1].pk if len(rows) == self.list_per_page else None
+        self.newest_url = self.get_query_string()
+        if self.next_before_id:
+            self.older_url = self.get_query_string({KEYSET_VAR: self.next_before_id})
+
+        self.can_show_all = False
+        self.multi_page = True
+        self.paginator = paginator
+
+
+class HugeTableAdmin(object):
+    """
+    Mix in before admin.ModelAdmin. Set SELECT_RELATED_FIELDS
+    to the ForeignKeys in LIST_DISPLAY to avoid a query per
+    row (LIST_SELECT_RELATED has to be a bool, and True
+    follows every ForeignKey), and use RAW_ID_FIELDS rather
+    than LIST_FILTER for ForeignKeys with lots of rows.
+    """
+    paginator = EstimatedCountPaginator
+    change_list_template = 'admin/keyset_change_list.html'
+    select_related_fields = ()
+
+    def queryset(self, request):
+        qs = super(HugeTableAdmin, self).queryset(request)
+        if self.select_related_fields:
+            qs = qs.select_related(*self.select_related_fields)
+        return qs
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
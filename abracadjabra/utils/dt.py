@@ -29,6 +29,19 @@ def serialize_datetimes(d, level=0):
 def datetime_to_date(dt):
     return date(year=dt.year, month=dt.month, day=dt.day)
 
+def db_date(value):
+    """
+    Returns a DATE for VALUE, a truncated date from the
+    db (e.g. from connection.ops.date_trunc_sql), which
+    comes back as a string from SQLite but a datetime from
+    other backends.
+    """
+    if isinstance(value, basestring):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
 def date_to_datetime(dt):
     if isinstance(dt, datetime):
         return dt
@@ -1,7 +1,16 @@
-from django.db import models
+from array import array
+import types
+
+from django.conf import settings as sett
+from django.core.cache import cache
+from django.core.management.color import no_style
+from django.db import connections, models
+from django.db.models import signals
 from django.db.models.query import QuerySet
 from django.shortcuts import _get_queryset
 
+from utils import generate_mckey
+
 """
 This adds two main pieces of functionality:
 
@@ -19,51 +28,102 @@ class QuerySetManager(models.Manager):
     We got this from a django snippet by Simon Willison
     http://www.djangosnippets.org/snippets/734/
     http://stackoverflow.com/questions/809210/django-manager-chaining
+
+    Any public QuerySet methods that the Manager doesn't
+    already have (e.g. your own chainable filtering methods)
+    get exposed on the Manager once, when the model class is
+    prepared, so you don't need to precede them with .all().
+    Managers made later (e.g. related managers) fall back to
+    __getattr__.
     """
+    def contribute_to_class(self, model, name):
+        super(QuerySetManager, self).contribute_to_class(model, name)
+        if not model._meta.abstract:
+            # model.QuerySet may not have been added yet
+            signals.class_prepared.connect(self._expose_queryset_methods,
+                                           sender=model, weak=False)
+
+    def _expose_queryset_methods(self, sender=None, **kwargs):
+        self._exposed = []
+        qs_class = getattr(self.model, 'QuerySet', None)
+        if qs_class is None:
+            return
+        for name in dir(qs_class):
+            if name.startswith('_') or hasattr(self.__class__, name):
+                continue
+            if callable(getattr(qs_class, name)):
+                self.__dict__[name] = types.MethodType(_queryset_proxy(name), self)
+                self._exposed.append(name)
+
+    def __getattr__(self, name):
+        # related managers (e.g. user.experiments) are made per
+        # instance, after class_prepared, so they look the
+        # QuerySet methods up as they go instead
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get_query_set(), name)
+
+    def db_manager(self, using):
+        # rebind the exposed methods to the copy
+        obj = super(QuerySetManager, self).db_manager(using)
+        for name in getattr(self, '_exposed', ()):
+            obj.__dict__[name] = types.MethodType(_queryset_proxy(name), obj)
+        return obj
+
     def get_query_set(self):
         # any model that uses this manager needs to define an 
         # internal 'QuerySet' class
-        return self.model.QuerySet(self.model)
-        
-    def __getattr__(self, name):
-        # we need this so that we can call functions 
-        # (e.g. get_or_create) that are part of the Manager rather 
-        # than the QuerySet. otherwise, you need to precede your 
-        # custom chainable functions with .all()
-        #
-        # however, if you don't have the name.startswith check, then you'll
-        # end up seeing this (apparently) innocuous warning:
-        # Exception RuntimeError: 'maximum recursion depth exceeded in __subclasscheck__'
-        # http://bugs.python.org/issue5508
-        if name.startswith('__'):
-            return super(QuerySetManager, self).__getattr__(name)
-        else:
-            return getattr(self.get_query_set(), name)
-        
-    
-class ActiveManager(QuerySetManager):
+        return self.model.QuerySet(self.model, using=self._db)
+
+
+def _queryset_proxy(name):
+    def proxy(self, *args, **kwargs):
+        return getattr(self.get_query_set(), name)(*args, **kwargs)
+    proxy.__name__ = name
+    return proxy
+
+
+class FilteredQuerySetManager(QuerySetManager):
+    """
+    Base for managers that always apply the same filter
+    (see filter_query_set). Builds the filtered Query once,
+    and then just clones it, rather than re-resolving the
+    lookups on every call.
+    """
+    def contribute_to_class(self, model, name):
+        self._base_query = None
+        super(FilteredQuerySetManager, self).contribute_to_class(model, name)
+
+    def filter_query_set(self, qs):
+        raise NotImplementedError
+
+    def get_query_set(self):
+        if self._base_query is None:
+            self._base_query = self.filter_query_set(
+                super(FilteredQuerySetManager, self).get_query_set()).query
+        return self.model.QuerySet(self.model, query=self._base_query.clone(), using=self._db)
+
+
+class ActiveManager(FilteredQuerySetManager):
     """
     Thing.active.all() returns just those Things with
     STATUS==ACTIVE_STATUS.
 
-    Update: We're excluding INACTIVE_STATUS rather than filtering
-    for ACTIVE_STATUS because we're hoping that the index
-    will work better if it only matches a small proportion
-    of rows.
+    Update: We used to exclude INACTIVE_STATUS, but the
+    planner can't use an index for a NOT, so we're back to
+    filtering for ACTIVE_STATUS (see create_status_indexes).
     """
-    def get_query_set(self):
-        return super(ActiveManager, self).get_query_set().exclude(
-            status=self.model.INACTIVE_STATUS)
+    def filter_query_set(self, qs):
+        return qs.filter(status=self.model.ACTIVE_STATUS)
 
 
-class InactiveManager(QuerySetManager):
+class InactiveManager(FilteredQuerySetManager):
     """
     Thing.inactive.all() returns just those Things with
     STATUS==INACTIVE_STATUS.
     """
-    def get_query_set(self):
-        return super(InactiveManager, self).get_query_set().filter(
-            status=self.model.INACTIVE_STATUS)
+    def filter_query_set(self, qs):
+        return qs.filter(status=self.model.INACTIVE_STATUS)
 
 # class RememberingQuerySet(QuerySet):
 #     """
@@ -139,6 +199,15 @@ class InactiveManager(QuerySetManager):
 #         return ret_list
 
 
+# see SoftDeletableQuerySet.pickle_pks()
+PICKLE_PKS_CHUNK_SIZE = 1000
+
+
+def _new_model_queryset(model):
+    # unpickling helper for SoftDeletableQuerySet.__reduce__
+    return model.QuerySet.__new__(model.QuerySet)
+
+
 class SoftDeletableQuerySet(QuerySet):
     """
     Inherit from this in your SoftDeletable model's nested
@@ -154,13 +223,45 @@ class SoftDeletableQuerySet(QuerySet):
             objects = QuerySetManager()
             class QuerySet(SoftDeletableQuerySet):
                 ...
+
+    By default, pickling pulls the whole QuerySet into
+    memory and pickles every object in it. For big
+    QuerySets, call pickle_pks() first, so that just the
+    query and an array of primary keys get pickled, e.g.
+
+        cache.set(mckey, Thing.objects.filter(...).pickle_pks())
+
+    The objects then get fetched PICKLE_PKS_CHUNK_SIZE at a
+    time when the unpickled QuerySet is iterated over (so
+    any that have since been deleted get skipped).
     """
+    _pickle_pks = False
+    # only set on QuerySets unpickled from pickle_pks()
+    _pks = None
+
+    def pickle_pks(self):
+        return self._clone(_pickle_pks=True)
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_pickle_pks', self._pickle_pks)
+        return super(SoftDeletableQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def __reduce__(self):
+        # a nested Model.QuerySet class can't be pickled by
+        # name, so reconstruct it from the model instead
+        if getattr(self.model, 'QuerySet', None) is type(self):
+            return (_new_model_queryset, (self.model,), self.__getstate__())
+        return super(SoftDeletableQuerySet, self).__reduce__()
+
     def __getstate__(self):
         """
         Allows the QuerySet to be pickled.
 
         Based on django's QuerySet in query.py.
         """
+        if self._pickle_pks:
+            return self._getstate_pks()
+
         # Force the cache to be fully populated.
         len(self)
 
@@ -168,6 +269,54 @@ class SoftDeletableQuerySet(QuerySet):
         obj_dict['_iter'] = None
         return obj_dict
 
+    def _getstate_pks(self):
+        if self._pks is not None:
+            pks = self._pks
+        elif self._result_cache is not None and not self._iter:
+            pks = [obj.pk for obj in self._result_cache]
+        else:
+            pks = list(self.values_list('pk', flat=True))
+        if all(isinstance(pk, (int, long)) for pk in pks):
+            # much more compact than pickling a list of ints
+            pks = array('l', pks)
+
+        obj_dict = self.__dict__.copy()
+        obj_dict['_iter'] = None
+        obj_dict['_result_cache'] = None
+        obj_dict['_pks'] = pks
+        return obj_dict
+
+    def iterator(self):
+        if self._pks is None:
+            return super(SoftDeletableQuerySet, self).iterator()
+        return self._iter_pks()
+
+    def _pks_chunks(self):
+        """
+        Yields (pks, QuerySet of the objects with those pks)
+        for each chunk of the pickled pks.
+        """
+        for start in range(0, len(self._pks), PICKLE_PKS_CHUNK_SIZE):
+            pks = list(self._pks[start:start + PICKLE_PKS_CHUNK_SIZE])
+            qs = self._clone()
+            qs.query.clear_limits()
+            qs.query.clear_ordering(force_empty=True)
+            yield pks, qs.filter(pk__in=pks)
+
+    def _iter_pks(self):
+        for pks, qs in self._pks_chunks():
+            objs = dict((obj.pk, obj) for obj in qs)
+            for pk in pks:
+                if pk in objs:
+                    yield objs[pk]
+
+    def count(self):
+        if self._pks is not None and self._result_cache is None:
+            # leaving out any that have been deleted since, the
+            # same as iterating does
+            return sum(qs.count() for pks, qs in self._pks_chunks())
+        return super(SoftDeletableQuerySet, self).count()
+
 
 class SoftDeletable(models.Model):
     """
@@ -191,6 +340,7 @@ class SoftDeletable(models.Model):
         )
     status = models.IntegerField(choices=STATUS_CHOICES,
                                  default=ACTIVE_STATUS,
+                                 db_index=True,
                                  help_text="Only ACTIVE objects will be used")
 
     objects = QuerySetManager()
@@ -200,6 +350,113 @@ class SoftDeletable(models.Model):
     class Meta:
         abstract = True
 
+    @classmethod
+    def active_ids_mckey(cls):
+        return generate_mckey('active_ids', {'model': cls._meta.db_table})
+
+    @classmethod
+    def active_ids(cls):
+        """
+        Returns a frozenset of the ids of all the ACTIVE
+        objects, cached until one of them is saved or
+        deleted.
+
+        N.B. QuerySet.update() doesn't send any signals, so
+        call invalidate_active_ids() yourself after one.
+        """
+        mckey = cls.active_ids_mckey()
+        ids = cache.get(mckey)
+        if ids is None:
+            ids = frozenset(cls.active.values_list('id', flat=True))
+            cache.set(mckey, ids, sett.CACHE_EXPIRY['ACTIVE_IDS'])
+        return ids
+
+    @classmethod
+    def invalidate_active_ids(cls):
+        cache.delete(cls.active_ids_mckey())
+
+
+def _invalidate_active_ids(sender, **kwargs):
+    sender.invalidate_active_ids()
+
+
+def _connect_softdeletable_signals(sender, **kwargs):
+    if issubclass(sender, SoftDeletable) and not sender._meta.abstract:
+        signals.post_save.connect(_invalidate_active_ids, sender=sender)
+        signals.post_delete.connect(_invalidate_active_ids, sender=sender)
+signals.class_prepared.connect(_connect_softdeletable_signals)
+
+
+def supports_partial_indexes(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 8, 0)
+    return False
+
+
+def index_exists(name, using='default'):
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT 1 FROM pg_indexes WHERE indexname = %s'
+    elif connection.vendor == 'sqlite':
+        sql = 'SELECT 1 FROM sqlite_master WHERE type = \'index\' AND name = %s'
+    else:
+        raise NotImplementedError(connection.vendor)
+    cursor = connection.cursor()
+    cursor.execute(sql, [name])
+    return cursor.fetchone() is not None
+
+
+def create_status_indexes(model, using='default', partial_only=False):
+    """
+    Makes sure SoftDeletable MODEL's table has:
+
+    - the plain index on status (syncdb only creates this
+      for new tables), unless PARTIAL_ONLY
+
+    - where the backend supports them (Postgres and SQLite
+      3.8+), a partial index on id for each status value,
+      so that the ACTIVE and INACTIVE managers only ever
+      read the (small) index for their own rows
+
+    Returns the names of the indexes it created. It's safe
+    to run this more than once.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    status = model._meta.get_field('status')
+    cursor = connection.cursor()
+    created = []
+
+    if not partial_only:
+        indexes = connection.introspection.get_indexes(cursor, table)
+        if status.column not in indexes:
+            for sql in connection.creation.sql_indexes_for_field(model, status, no_style()):
+                cursor.execute(sql)
+            created.append('%s.%s' % (table, status.column))
+
+    if supports_partial_indexes(connection):
+        pk = model._meta.pk.column
+        for val, label in model.STATUS_CHOICES:
+            name = '%s_%s_%i_%s' % (table, status.column, val, pk)
+            if index_exists(name, using):
+                continue
+            cursor.execute('CREATE INDEX %s ON %s (%s) WHERE %s = %i' %
+                           (qn(name), qn(table), qn(pk), qn(status.column), val))
+            created.append(name)
+    return created
+
+
+def _create_partial_status_indexes(sender, created_models=(), db='default', **kwargs):
+    # syncdb creates the plain status index itself, after this
+    for model in created_models:
+        if issubclass(model, SoftDeletable):
+            create_status_indexes(model, using=db, partial_only=True)
+signals.post_syncdb.connect(_create_partial_status_indexes)
+
 
 def as_objects(model, objs, uniquify=True):
     """
@@ -215,6 +472,9 @@ def as_objects(model, objs, uniquify=True):
       things = as_objects(Thing, things)
 
     If UNIQUIFY, will throw away any duplicates. Now preserves order.
+
+    Looks up all the slugs with one query, and all the ids
+    with another, however many there are.
     """
     if objs is None:
         return None
@@ -226,7 +486,13 @@ def as_objects(model, objs, uniquify=True):
     # QuerySet??? maybe with a .distinct()???
     if not isinstance(objs, (list, QuerySet)):
         objs = [objs]
-    
+
+    slugs = [obj for obj in objs if isinstance(obj, (str, unicode))]
+    ids = [obj for obj in objs if isinstance(obj, int)]
+    objs_by_slug = dict((obj.slug, obj) for obj in model.objects.filter(slug__in=slugs)) \
+        if slugs else {}
+    objs_by_id = model.objects.in_bulk(ids) if ids else {}
+
     # list with the new version of OBJS
     new_objs = []
     # keep track of things, so that we can uniquify
@@ -235,9 +501,9 @@ def as_objects(model, objs, uniquify=True):
     # of them might just be slugs)
     for obj in objs:
         if isinstance(obj, (str, unicode)):
-            obj = model.objects.get(slug=obj)
+            obj = get_or_raise(model, objs_by_slug, 'slug', obj)
         elif isinstance(obj, int):
-            obj = model.objects.get(id=obj)
+            obj = get_or_raise(model, objs_by_id, 'id', obj)
         else:
             pass # just keep the original OBJ
         if uniquify:
@@ -250,6 +516,75 @@ def as_objects(model, objs, uniquify=True):
     return new_objs
 
 
+def get_or_raise(model, d, field, val):
+    """
+    Returns D[VAL], or raises MODEL.DoesNotExist, as
+    MODEL.objects.get(FIELD=VAL) would have done.
+    """
+    try:
+        return d[val]
+    except KeyError:
+        raise model.DoesNotExist(
+            "%s matching query does not exist. Lookup parameters were %s" %
+            (model._meta.object_name, {field: val}))
+
+
+def queryset_iterator(qs, chunk_size=1000, reverse=False):
+    """
+    Iterates over QS in chunks of CHUNK_SIZE, in order of
+    primary key (descending if REVERSE), so memory stays
+    flat however big QS is.
+
+    Each chunk is fetched with 'pk > last_pk' rather than
+    an OFFSET, so every query is an index range scan, even
+    deep into a huge table.
+
+    Works for Model instances, VALUES querysets (if they
+    include 'id') and VALUES_LIST querysets (if the pk is
+    the first field).
+    """
+    for chunk in queryset_chunks(qs, chunk_size, reverse):
+        for row in chunk:
+            yield row
+
+
+def queryset_chunks(qs, chunk_size=1000, reverse=False):
+    """
+    Like QUERYSET_ITERATOR, but yields a list of rows per
+    chunk. Each chunk's query runs when you ask for it, so
+    e.g. wrap the NEXT() in routers.reporting() to send it
+    to the reporting db.
+    """
+    qs = qs.order_by('-pk' if reverse else 'pk')
+    last_pk = None
+    while True:
+        chunk = qs
+        if last_pk is not None:
+            chunk = chunk.filter(**{'pk__lt' if reverse else 'pk__gt': last_pk})
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        yield chunk
+        row = chunk[-1]
+        if isinstance(row, models.Model):
+            last_pk = row.pk
+        elif isinstance(row, dict):
+            last_pk = row['id']
+        else:
+            last_pk = row[0]
+
+
+def table_columns(table, using='default'):
+    """
+    Returns a list of the column names in database TABLE,
+    e.g. to check whether a hand-written schema change has
+    already been applied.
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    return [row[0] for row in connection.introspection.get_table_description(cursor, table)]
+
+
 def get_first(model, *args, **kwargs):
     """
     e.g. Thing.get_first(word='word', defn='defn')
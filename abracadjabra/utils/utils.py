@@ -2,7 +2,10 @@ from functools import update_wrapper
 import inspect
 import logging
 import re
+import threading
+import time
 import urllib
+from multiprocessing.pool import ThreadPool
 
 import django
 from django.contrib.auth.models import User
@@ -11,7 +14,7 @@ from django.db.models.query import QuerySet
 from django.conf import settings as sett
 from django.conf.urls import *
 from django.core.cache import cache
-from django.db import models
+from django.db import close_connection, models
 from django.http import Http404
 from django.utils.datastructures import SortedDict
 
@@ -526,7 +529,96 @@ def generate_mckey(prefix, d):
     return prefix_pieces
 
 
-def cmcd(prefix=None, arg_names=(), expiry=None):
+# cache.get() returns None for a miss, so CMCD stores this in
+# place of a None return value to tell the two apart
+CMCD_NONE = '__CMCD_NONE__'
+
+# see RequestMemoMiddleware
+_request_memo = threading.local()
+
+
+def request_memo():
+    """
+    Returns the dict that cmcd(memo=True) functions use to
+    remember their values for the current request, or None
+    if we're not inside a request (e.g. in the shell, or if
+    RequestMemoMiddleware isn't installed).
+    """
+    return getattr(_request_memo, 'd', None)
+
+
+# see run_in_background()
+_background_pool = None
+_background_pending = {}
+_background_lock = threading.Lock()
+
+
+def run_in_background(mckey, func, *args, **kwargs):
+    """
+    Runs FUNC(*ARGS, **KWARGS) in a shared pool of
+    background threads (settings.BACKGROUND_THREADS), unless
+    there's already one pending for MCKEY, in which case it
+    won't run again. Returns a multiprocessing AsyncResult.
+
+    Each thread gets its own database connection, which
+    gets closed once FUNC is done.
+    """
+    global _background_pool
+
+    def run():
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            # nobody's waiting on the AsyncResult to see it
+            log.exception('Background %s failed', mckey)
+            raise
+        finally:
+            with _background_lock:
+                del _background_pending[mckey]
+            close_connection()
+
+    with _background_lock:
+        if mckey in _background_pending:
+            return _background_pending[mckey]
+        if _background_pool is None:
+            _background_pool = ThreadPool(sett.BACKGROUND_THREADS)
+        result = _background_pool.apply_async(run)
+        _background_pending[mckey] = result
+    return result
+
+
+def wait_for_background(timeout=None):
+    """
+    Blocks until everything that was pending in
+    RUN_IN_BACKGROUND has finished, e.g. so that a
+    management command doesn't exit halfway through a
+    refresh.
+    """
+    with _background_lock:
+        pending = _background_pending.values()
+    for result in pending:
+        result.wait(timeout)
+
+
+class RequestMemoMiddleware(object):
+    """
+    Remembers the values of cmcd(memo=True) functions for
+    the duration of a request, so that calling the same
+    function with the same arguments several times while
+    rendering a page only costs one cache round-trip.
+
+    Add 'abracadjabra.utils.utils.RequestMemoMiddleware' to
+    MIDDLEWARE_CLASSES.
+    """
+    def process_request(self, request):
+        _request_memo.d = {}
+
+    def process_response(self, request, response):
+        _request_memo.d = None
+        return response
+
+
+def cmcd(prefix=None, arg_names=(), expiry=None, memo=False, soft_expiry=None):
     """Caches the return value of func based on the cache key generated by
     generate_mckey. The prefix argument to the `generate_mckey` is
     determined from the module and the name of the function if `prefix` is
@@ -539,21 +631,41 @@ def cmcd(prefix=None, arg_names=(), expiry=None):
     take keyword arguments, and the arguments we're generating the cache
     from must be specified.
 
+    Falsy return values (0, [], None etc.) are cached too,
+    so they don't get recomputed on every call.
+
+    The wrapped function gets a `many` attribute for
+    resolving lots of argument sets at once, with a single
+    cache.get_many() and set_many(), e.g.
+
+      totals = user_total.many([{'user': u1}, {'user': u2}])
+
+    If MEMO, values are also remembered for the rest of the
+    current request (see RequestMemoMiddleware).
+
+    If SOFT_EXPIRY (in seconds) is set, values older than
+    that are still returned straight away, but get
+    recomputed in the background (see run_in_background),
+    so callers only block if nothing is cached at all. In
+    that case, EXPIRY is how long a stale value can keep
+    being served. Useful for slow report functions.
+
     NOTE: prefix must be defined in settings.CACHE_EXPIRY, OR set expiry=EXPIRY_TIME, e.g.
 
-    See utils.tests for usage.
+    See abracadjabra.tests.CmcdTests for usage.
     """
 
     def dec(func, prefix=prefix, arg_names=arg_names, expiry=expiry):
-        if expiry is None:
-            if prefix == None:
-                prefix = ".".join((func.__module__, func.__name__))
+        if prefix == None:
+            prefix = ".".join((func.__module__, func.__name__))
+        prefix = prefix.upper()
 
-            prefix = prefix.upper()
+        if expiry is None:
             if prefix not in sett.CACHE_EXPIRY:
                 raise Exception("Prefix %s must be defined in settings.CACHE_EXPIRY if expiry is not specified" % prefix)
 
             expiry = sett.CACHE_EXPIRY[prefix]
+        assert soft_expiry is None or soft_expiry < expiry
 
         fspec = inspect.getargspec(func)
         pos_args = fspec.args
@@ -569,29 +681,94 @@ def cmcd(prefix=None, arg_names=(), expiry=None):
         else:
             noargs = True
 
-        def f(*args, **kwargs):
+        def get_mckey(args, kwargs):
             if not noargs:
                 all_args = dict(default_args)
                 all_args.update(dict((n, v) for n, v in zip(pos_args, args)))
                 all_args.update(kwargs)
                 d = dict((k, all_args.get(k, None)) for k in arg_names)
             else:
-                all_args = {}
                 d = {}
+            return generate_mckey(prefix, d)
+
+        def from_cache(cached):
+            """
+            Returns (VAL, STALE).
+            """
+            if soft_expiry:
+                # stored as (STALE_AFTER, VAL)
+                return cached[1], time.time() > cached[0]
+            return (None if cached == CMCD_NONE else cached), False
+
+        def to_cache(val):
+            if soft_expiry:
+                return (time.time() + soft_expiry, val)
+            return CMCD_NONE if val is None else val
+
+        def refresh(mckey, args, kwargs):
+            val = func(*args, **kwargs)
+            cache.set(mckey, to_cache(val), expiry)
+            return val
 
-            mckey = generate_mckey(prefix, d)
-            cached = cache.get(mckey)
-
-            if cached:
-                return cached
+        def f(*args, **kwargs):
+            mckey = get_mckey(args, kwargs)
 
-            val = func(*args, **kwargs)
+            memo_d = request_memo() if memo else None
+            if memo_d is not None and mckey in memo_d:
+                return memo_d[mckey]
 
-            cache.set(mckey, val, expiry)
+            cached = cache.get(mckey)
+            if cached is not None:
+                val, stale = from_cache(cached)
+                if stale:
+                    run_in_background(mckey, refresh, mckey, args, kwargs)
+            else:
+                val = refresh(mckey, args, kwargs)
 
+            if memo_d is not None:
+                memo_d[mckey] = val
             return val
 
-        return update_wrapper(f, func)
+        def many(kwargs_list):
+            """
+            Like calling the function once for each dict of
+            kwargs in KWARGS_LIST, but with one get_many() and
+            one set_many() for the lot. Returns a list of
+            values, in the same order as KWARGS_LIST.
+            """
+            mckeys = [get_mckey((), kwargs) for kwargs in kwargs_list]
+
+            memo_d = request_memo() if memo else None
+            vals = {}
+            if memo_d is not None:
+                vals.update((k, memo_d[k]) for k in mckeys if k in memo_d)
+
+            missing = [k for k in unique(mckeys) if k not in vals]
+            if missing:
+                stale = set()
+                for mckey, cached in cache.get_many(missing).items():
+                    vals[mckey], is_stale = from_cache(cached)
+                    if is_stale:
+                        stale.add(mckey)
+                for mckey, kwargs in zip(mckeys, kwargs_list):
+                    if mckey in stale:
+                        run_in_background(mckey, refresh, mckey, (), kwargs)
+                        stale.remove(mckey)
+
+            to_set = {}
+            for mckey, kwargs in zip(mckeys, kwargs_list):
+                if mckey not in vals:
+                    vals[mckey] = func(**kwargs)
+                    to_set[mckey] = to_cache(vals[mckey])
+            if to_set:
+                cache.set_many(to_set, expiry)
+
+            if memo_d is not None:
+                memo_d.update(vals)
+            return [vals[mckey] for mckey in mckeys]
+
+        f = update_wrapper(f, func)
+        f.many = many
+        return f
 
     return dec
-
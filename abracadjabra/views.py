@@ -1,16 +1,43 @@
+import hashlib
+import json
+from multiprocessing import TimeoutError
+
+from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
-from django.db.models import Sum, Count
-from django.http import Http404
+from django.db.models import Count, Max, Sum
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, \
+    StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.views.decorators.http import condition, require_GET
 
+from assign import check_secret
+from bitmaps import crosstab, overlap_matrix
+from dashboard import experiment_summaries
 from exceptions import SlugAttributeError
-from models import Experiment, ExperimentUser
+from exports import FORMATS as EXPORT_FORMATS, export
+from models import Experiment, ExperimentUser, report_sample
 from utils.dt import dt_ranges, recent_day, recent_week
+from utils.utils import percent
+
 
+def experiments_validators(request):
+    # every Experiment save bumps MOD, and deleting one
+    # changes the count
+    if not hasattr(request, '_experiments_validators'):
+        stats = Experiment.objects.aggregate(Max('mod'), Count('id'))
+        etag = hashlib.md5('%s:%s:%s' % (stats['mod__max'].isoformat() if stats['mod__max'] else '',
+                                         stats['id__count'],
+                                         request.user.id)).hexdigest()
+        request._experiments_validators = etag, stats['mod__max']
+    return request._experiments_validators
 
 @staff_member_required
+@condition(etag_func=lambda request: experiments_validators(request)[0],
+           last_modified_func=lambda request: experiments_validators(request)[1])
 def experiments_vw(request):
     active_experiments = Experiment.active.all()
     inactive_experiments = Experiment.inactive.all()
@@ -27,21 +54,206 @@ def experiments_vw(request):
                               context_instance=RequestContext(request))
 
 
+def experiment_detail_validators(request, experiment_id):
+    """
+    Returns (ETag, Last-Modified) for EXPERIMENT_DETAIL_VW,
+    so that polling it gets a 304 without recomputing the
+    report. Only a query by pk and cache lookups.
+
+    The ETag changes with the Experiment's version (see
+    Experiment.get_cache_versions), its MOD, which report
+    Experiment.get_cache_report would show (its version and
+    how far it's been refined) and the hour, since that's
+    when the date range moves on.
+
+    There's only a Last-Modified once the report is exact
+    and up to date, because refining it doesn't change the
+    data, so If-Modified-Since alone would keep the rough
+    version.
+    """
+    if not hasattr(request, '_detail_validators'):
+        request._detail_validators = None, None
+        dt_joined_str = request.GET.get('dt_joined', 'recent_week')
+        try:
+            expt = Experiment.objects.get(id=experiment_id)
+        except Experiment.DoesNotExist:
+            expt = None
+        if expt is not None and dt_joined_str in dt_ranges:
+            use_snapshot = bool(settings.SNAPSHOT_DIR)
+            version, dt_joined, report, report_version, samples = expt.cached_report(
+                dt_ranges[dt_joined_str][0], use_snapshot=use_snapshot)
+            sample = report_sample(report) if report else None
+            hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+            etag = hashlib.md5('%s:%s:%s:%s:%s:%s:%s:%s:%s' % (
+                    expt.id, version, report_version, expt.mod.isoformat(),
+                    sample, use_snapshot, dt_joined_str, hour.isoformat(),
+                    request.user.id)).hexdigest()
+            last_modified = None
+            if report_version == version and sample == 1:
+                last_modified = max(expt.mod, Experiment.version_time(version), hour)
+            request._detail_validators = etag, last_modified
+    return request._detail_validators
+
 @staff_member_required
+@condition(etag_func=lambda request, experiment_id: experiment_detail_validators(request, experiment_id)[0],
+           last_modified_func=lambda request, experiment_id: experiment_detail_validators(request, experiment_id)[1])
 def experiment_detail_vw(request, experiment_id):
     dt_joined_str = request.GET.get('dt_joined', 'recent_week')
     dt_joined = dt_ranges[dt_joined_str][0] # e.g. recent_week()
     # use .objects to allow inactive Experiments to still be viewable
     expt = get_object_or_404(Experiment, id=experiment_id)
-    buckets, dt_joined = expt.compute_buckets(dt_joined=dt_joined)
+    # from a sample of users at first, for huge Experiments
+    buckets, dt_joined = expt.get_cache_report(dt_joined=dt_joined,
+                                               use_snapshot=bool(settings.SNAPSHOT_DIR))
+    sample = buckets[0]['sample'] if buckets else 1
+    # one row per kind of Conversion, with a cell per bucket
+    conversion_rows = [{'name': conversion['name'],
+                        'buckets': [bucket['conversions'][idx] for bucket in buckets],}
+                       for idx, conversion in enumerate(buckets[0]['conversions'])]
     last_exptuser = ExperimentUser.get_latest(expt)
     return render_to_response('abracadjabra/experiment_detail.html',
                               {'expt': expt,
                                'buckets': buckets,
+                               'conversion_rows': conversion_rows,
                                'dt_joined': dt_joined,
+                               'approximate': sample < 1,
+                               'sample_pct': 100 * sample,
                                'last_ran': last_exptuser.cre,},
                               context_instance=RequestContext(request))
 
+@staff_member_required
+def dashboard_vw(request):
+    """
+    A row of stats for each active Experiment, computed in
+    parallel (see dashboard.py), and streamed to the page as
+    each one finishes, so the first rows show up long before
+    the slowest one is done.
+    """
+    dt_joined_str = request.GET.get('dt_joined', 'recent_week')
+    if dt_joined_str not in dt_ranges:
+        raise Http404
+    expts = list(Experiment.active.all())
+    context = {'nExperiments': len(expts),
+               'dt_joined_str': dt_joined_str,
+               'timeout': settings.DASHBOARD_TIMEOUT,}
+
+    def rows():
+        yield render_to_string('abracadjabra/dashboard_header.html', context)
+        for expt, summary, exception in experiment_summaries(expts, dt_joined_str):
+            yield render_to_string('abracadjabra/dashboard_row.html',
+                                   {'expt': expt,
+                                    'summary': summary,
+                                    'timed_out': isinstance(exception, TimeoutError),
+                                    'failed': exception is not None,})
+        yield '</table>\n'
+
+    return StreamingHttpResponse(rows())
+
+@staff_member_required
+def experiment_timeseries_vw(request, experiment_id):
+    """
+    JSON of how many Users were assigned to each bucket
+    each day (or ?period=week), for charting on the detail
+    page. ?since= is one of dt_ranges, and goes by when
+    they were assigned, not when they joined. See
+    Experiment.timeseries.
+    """
+    expt = get_object_or_404(Experiment, id=experiment_id)
+    period = request.GET.get('period', 'day')
+    since_str = request.GET.get('since', 'recent_month')
+    if period not in ('day', 'week') or since_str not in dt_ranges:
+        return HttpResponseBadRequest()
+    dates, buckets = expt.timeseries(since=dt_ranges[since_str][0], period=period)
+    return HttpResponse(json.dumps({'experiment': expt.id,
+                                    'period': period,
+                                    'dates': [dt.isoformat() for dt in dates],
+                                    'buckets': buckets,}),
+                        content_type='application/json')
+
+@staff_member_required
+def experiment_export_vw(request, experiment_id, what, fmt):
+    """
+    Streams WHAT ('assignments' or 'buckets') for an
+    Experiment as CSV or NDJSON, however many rows there
+    are. Pass ?dt_joined= to only export Users who joined in
+    that range. See exports.py.
+    """
+    expt = get_object_or_404(Experiment, id=experiment_id)
+    dt_joined_str = request.GET.get('dt_joined')
+    if dt_joined_str and dt_joined_str not in dt_ranges:
+        return HttpResponseBadRequest()
+    dt_joined = dt_ranges[dt_joined_str][0] if dt_joined_str else None
+    resp = StreamingHttpResponse(export(what, expt, fmt, dt_joined), content_type=EXPORT_FORMATS[fmt])
+    resp['Content-Disposition'] = 'attachment; filename=experiment_%i_%s.%s' % (expt.id, what, fmt)
+    return resp
+
+@staff_member_required
+def overlap_vw(request):
+    """
+    How many Users each pair of active Experiments have in
+    common, from their cached bucket bitmaps.
+    """
+    expts = list(Experiment.active.order_by('id'))
+    versions = Experiment.get_cache_versions([expt.id for expt in expts])
+    bitmaps = Experiment.get_cache_bucket_bitmaps.many([{'expt_id': expt.id, 'version': versions[expt.id]}
+                                                        for expt in expts])
+    rows = [{'expt': expt,
+             'nUsers': nUsers,
+             'overlaps': [{'expt': other, 'n': n, 'pct': percent(n, nUsers)}
+                          for other, n in zip(expts, overlaps)],}
+            for expt, nUsers, overlaps in overlap_matrix(zip(expts, bitmaps))]
+    return render_to_response('abracadjabra/overlap.html',
+                              {'expts': expts,
+                               'rows': rows,},
+                              context_instance=RequestContext(request))
+
+@staff_member_required
+def overlap_detail_vw(request, experiment_id, other_experiment_id):
+    """
+    For the Users in both Experiments, how many are in each
+    pair of their buckets, against how many you'd expect if
+    the Experiments didn't interact.
+    """
+    expt = get_object_or_404(Experiment, id=experiment_id)
+    other = get_object_or_404(Experiment, id=other_experiment_id)
+    versions = Experiment.get_cache_versions([expt.id, other.id])
+    bitmaps, other_bitmaps = Experiment.get_cache_bucket_bitmaps.many([{'expt_id': expt.id, 'version': versions[expt.id]},
+                                                                       {'expt_id': other.id, 'version': versions[other.id]}])
+    cells = [{'bucket': bucket,
+              'other_bucket': other_bucket,
+              'n': n,
+              'nExpected': nExpected,}
+             for bucket, other_bucket, n, nExpected in crosstab(bitmaps, other_bitmaps)]
+    return render_to_response('abracadjabra/overlap_detail.html',
+                              {'expt': expt,
+                               'other': other,
+                               'cells': cells,},
+                              context_instance=RequestContext(request))
+
+def config_etag(request):
+    return Experiment.get_cache_config()[0]
+
+def config_last_modified(request):
+    return Experiment.get_cache_config()[1]
+
+@require_GET
+@condition(etag_func=config_etag, last_modified_func=config_last_modified)
+def config_vw(request):
+    """
+    The JSON config snapshot from
+    Experiment.get_cache_config(), for clients that assign
+    buckets themselves. Needs the same X-Abracadjabra-Secret
+    header as assign.py.
+
+    N.B. the secret gets checked after the ETag, so a 304
+    doesn't need it - it only confirms a snapshot you already
+    have.
+    """
+    if not check_secret(request.META):
+        return HttpResponseForbidden()
+    etag, last_modified, body = Experiment.get_cache_config()
+    return HttpResponse(body, content_type='application/json')
+
 @staff_member_required
 def analysis_detail_vw(request, analysis_slug):
     dt_joined_str = request.GET.get('dt_joined', 'recent_week')
@@ -27,6 +27,24 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "abracadjabra.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Prime the cache with all the active Experiments, so that the first wave of
+# traffic after a deploy or a memcached restart doesn't all miss at once.
+from django.conf import settings
+if settings.WARM_CACHE_ON_STARTUP:
+    import logging
+    from django.db import close_connection
+    from abracadjabra.models import Experiment
+    from abracadjabra.utils.dt import recent_day
+    days = settings.WARM_CACHE_EXPTUSERS_DAYS
+    try:
+        Experiment.warm_cache(exptusers_since=recent_day(days) if days else None)
+    except Exception:
+        # better to start with a cold cache than not to start at all
+        logging.getLogger(__name__).exception('Failed to warm the experiment cache')
+    finally:
+        # don't share this connection with any forked workers
+        close_connection()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)